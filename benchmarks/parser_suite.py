@@ -0,0 +1,256 @@
+"""
+Benchmark suite of the parsers over synthetic workbooks
+
+Generates synthetic workbooks for every parser type (see synthetic_workbooks.py), then times each parser end to end and
+by phase, as main() runs it:
+
+    open        loading the workbook and listing its sheets
+    decode      reading the worksheets into data frames, xl.parse
+    transform   the rest of parse(): melt, tagging, key building, column selection
+    prepare     concatenating the products and prepare_output
+    write       writing the output sheet into a new xlsx workbook
+
+Each parser is run --repeat times and the fastest run is kept. Results are written as JSON with the scale of the
+workbooks and the versions of the libraries. With --baseline, results are compared to a saved results file: a phase is
+a regression when it is slower than the baseline by more than --tolerance and by more than --min-seconds, and the
+suite exits with 1. --save-baseline writes the results as the new baseline.
+
+Usage: python benchmarks/parser_suite.py [--products 7] [--bands 5] [--ages 81] [--parser-type Dividend ...]
+                                         [--repeat 3] [--output results.json] [--baseline baseline.json]
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import openpyxl
+import pandas as pd
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from output_sinks import ExcelSink
+from rate_file_converter import PARSER_TYPES, get_input_dir, get_workbook_tasks, parser_factory, prepare_output
+from sheet_reader import StreamingExcelFile
+from synthetic_workbooks import generate
+
+# Version of the results layout, results of different versions are not compared
+RESULTS_VERSION = 1
+PHASES = ['open', 'decode', 'transform', 'prepare', 'write']
+
+
+class TimedExcelFile(StreamingExcelFile):
+    """
+    StreamingExcelFile adding the time spent opening the workbook and decoding sheets to a timing dictionary
+    """
+
+    def __init__(self, input_file, timings):
+        super().__init__(input_file)
+        self.timings = timings
+
+    @property
+    def sheet_names(self):
+        start = time.perf_counter()
+        sheet_names = super().sheet_names
+        self.timings['open'] += time.perf_counter() - start
+        return sheet_names
+
+    def parse(self, sheet_name, skiprows=0, **kwargs):
+        start = time.perf_counter()
+        df = super().parse(sheet_name, skiprows, **kwargs)
+        self.timings['decode'] += time.perf_counter() - start
+        return df
+
+
+def run_parser(parser_type, tasks, output_file, sheet_name):
+    """
+    Parse the workbooks of a parser type and write its output sheet, timing each phase
+    :param parser_type: Parser type string
+    :param tasks: List of (parser_type, input_file, product_name, first_row) tuples
+    :param output_file: Output workbook, replaced by an empty workbook first
+    :param sheet_name: Output sheet name
+    :return: ({phase: seconds, 'total': seconds}, output data frame)
+    """
+
+    wb = Workbook()
+    wb.save(output_file)
+
+    timings = dict.fromkeys(PHASES, 0.0)
+    start_run = time.perf_counter()
+    frames = []
+    for _, input_file, product_name, first_row in tasks:
+        start = time.perf_counter()
+        with TimedExcelFile(input_file, timings) as xl:
+            parser = parser_factory(parser_type)(input_file, product_name, first_row)
+            parser.set_workbook(xl)
+            frames.append(parser.parse())
+        timings['transform'] += time.perf_counter() - start
+    timings['transform'] -= timings['open'] + timings['decode']
+
+    start = time.perf_counter()
+    df_output = prepare_output(pd.concat(frames, sort=False))
+    timings['prepare'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ExcelSink(output_file, replace=True).write({sheet_name: df_output}, {sheet_name: {}})
+    timings['write'] = time.perf_counter() - start
+    timings['total'] = time.perf_counter() - start_run
+    return timings, df_output
+
+
+def run_suite(config_file, parser_types, repeat, work_dir):
+    """
+    Time every parser type over the workbooks of a configuration file
+    :param config_file: config.txt of the synthetic workbooks
+    :param parser_types: Parser types to time
+    :param repeat: Runs per parser type, the fastest is kept
+    :param work_dir: Directory receiving the output workbooks
+    :return: {parser_type: {'workbooks': n, 'sheets': n, 'rows': n, 'seconds': {phase: seconds}}}
+    """
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    results = {}
+    for parser_type in parser_types:
+        parser_config = config[parser_type]
+        tasks = get_workbook_tasks(parser_type, get_input_dir(config['IO'], parser_type), parser_config)
+        output_file = os.path.join(work_dir, f'{parser_type}.xlsx')
+        runs = [run_parser(parser_type, tasks, output_file, parser_config['Output_sheet_name'])
+                for _ in range(repeat)]
+        timings, df_output = min(runs, key=lambda run: run[0]['total'])
+        n_sheets = 0
+        for task in tasks:
+            with StreamingExcelFile(task[1]) as xl:
+                n_sheets += len(xl.sheet_names)
+        results[parser_type] = {
+            'workbooks': len(tasks),
+            'sheets': n_sheets,
+            'rows': len(df_output),
+            'seconds': {phase: round(seconds, 4) for phase, seconds in timings.items()},
+        }
+    return results
+
+
+def compare_results(results, baseline, tolerance, min_seconds):
+    """
+    Compare results to a baseline
+    :param results: Results dictionary of this run
+    :param baseline: Results dictionary of the baseline
+    :param tolerance: Relative slowdown allowed, 0.25 for 25%
+    :param min_seconds: Slowdown in seconds below which a phase is never a regression
+    :return: List of {'parser_type', 'phase', 'baseline', 'current', 'ratio'} of the regressions
+    """
+
+    if baseline.get('version') != RESULTS_VERSION:
+        raise ValueError(f"compare_results: Baseline results are version {baseline.get('version')}, "
+                         f"expected {RESULTS_VERSION}")
+    if baseline['scale'] != results['scale']:
+        raise ValueError(f"compare_results: Baseline scale {baseline['scale']} differs from {results['scale']}")
+
+    regressions = []
+    for parser_type, parser_results in results['parsers'].items():
+        if parser_type not in baseline['parsers']:
+            continue
+        base_seconds = baseline['parsers'][parser_type]['seconds']
+        for phase, seconds in parser_results['seconds'].items():
+            base = base_seconds.get(phase)
+            if base is None:
+                continue
+            if seconds > base * (1 + tolerance) and seconds - base > min_seconds:
+                regressions.append({'parser_type': parser_type, 'phase': phase, 'baseline': base, 'current': seconds,
+                                    'ratio': round(seconds / base, 2) if base else None})
+    return regressions
+
+
+def print_results(results, baseline=None):
+    """
+    Print a table of the phase timings, with the change against the baseline when given
+    """
+
+    print(f"{'parser':<16} {'books':>5} {'sheets':>6} {'rows':>8} " + ' '.join(f'{p:>9}' for p in PHASES + ['total']))
+    for parser_type, parser_results in results['parsers'].items():
+        seconds = parser_results['seconds']
+        print(f"{parser_type:<16} {parser_results['workbooks']:>5} {parser_results['sheets']:>6} "
+              f"{parser_results['rows']:>8} " + ' '.join(f'{seconds[p]:>9.3f}' for p in PHASES + ['total']))
+        if baseline and parser_type in baseline['parsers']:
+            base_seconds = baseline['parsers'][parser_type]['seconds']
+            ratios = [f'{seconds[p] / base_seconds[p]:>8.2f}x' if base_seconds.get(p) else f"{'-':>9}"
+                      for p in PHASES + ['total']]
+            print(f"{'  vs baseline':<39} " + ' '.join(ratios))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Time the parsers end to end and by phase on synthetic workbooks')
+    arg_parser.add_argument('--products', type=int, default=7, help='Number of products (default: %(default)s)')
+    arg_parser.add_argument('--bands', type=int, default=5, help='Number of bands, 1 to 5 (default: %(default)s)')
+    arg_parser.add_argument('--ages', type=int, default=81, help='Number of issue ages (default: %(default)s)')
+    arg_parser.add_argument('--parser-type', action='append', choices=PARSER_TYPES,
+                            help='Parser type to time, can be repeated (default: all)')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per parser, best is kept (default: %(default)s)')
+    arg_parser.add_argument('--workbook-dir',
+                            help='Directory of the synthetic workbooks, generated in a temporary directory if not '
+                                 'given. Reused when it holds a config.txt, the workbooks must then have the scale of '
+                                 '--products, --bands and --ages')
+    arg_parser.add_argument('--output', help='Results JSON file')
+    arg_parser.add_argument('--baseline', help='Results JSON file to compare with')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='Write the results to --baseline')
+    arg_parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Relative slowdown of a phase reported as a regression (default: %(default)s)')
+    arg_parser.add_argument('--min-seconds', type=float, default=0.05,
+                            help='Slowdown of a phase in seconds below which it is never a regression '
+                                 '(default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+    if args.save_baseline and not args.baseline:
+        arg_parser.error('--save-baseline needs --baseline')
+
+    parser_types = args.parser_type or PARSER_TYPES
+    scale = {'products': args.products, 'bands': args.bands, 'ages': args.ages}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        workbook_dir = args.workbook_dir or os.path.join(tmp_dir, 'workbooks')
+        config_file = os.path.join(workbook_dir, 'config.txt')
+        if not os.path.exists(config_file):
+            start = time.perf_counter()
+            generate(workbook_dir, parser_types=PARSER_TYPES, **scale)
+            print(f'Generated workbooks in {workbook_dir} in {time.perf_counter() - start:.1f}s')
+        results = {
+            'version': RESULTS_VERSION,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'scale': scale,
+            'repeat': args.repeat,
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'pandas': pd.__version__, 'numpy': np.__version__, 'openpyxl': openpyxl.__version__},
+            'parsers': run_suite(config_file, parser_types, args.repeat, tmp_dir),
+        }
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline, encoding='utf8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    for path in (args.output, args.baseline if args.save_baseline else None):
+        if path:
+            with open(path, 'w', encoding='utf8') as f:
+                json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print(f"Regression: {regression['parser_type']} {regression['phase']} "
+                  f"{regression['baseline']:.3f}s -> {regression['current']:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print('No regression against the baseline')
+
+
+if __name__ == '__main__':
+    main()
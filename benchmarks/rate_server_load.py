@@ -0,0 +1,131 @@
+"""
+Load test of the rate lookup server
+
+Opens concurrent keep-alive connections to a running rate_server.py, each sending single lookups (or batches of keys)
+for keys sampled from the served table, and reports the latency percentiles and the throughput. With --reload-every a
+reload is requested during the test, responses must keep coming from a complete snapshot while the tables are rebuilt.
+
+Usage:
+    python rate_server.py CashValuePerK --port 8765 &
+    python benchmarks/rate_server_load.py --table CashValuePerK [--connections 8] [--requests 2000] [--batch 0]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import numpy as np
+
+
+async def request(reader, writer, method, path, payload=None):
+    """
+    Send one request on a keep-alive connection
+    :return: (HTTP status, JSON response)
+    """
+
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def worker(host, port, table, keys, durations, n_requests, batch, rng, latencies, versions):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(n_requests):
+            rows = rng.integers(0, len(keys), max(batch, 1))
+            if batch:
+                payload = {'table': table, 'keys': [[keys[row][k] for row in rows] for k in range(len(keys[0]))]}
+                path = '/batch'
+                if durations:
+                    payload['durations'] = rng.integers(durations[0], durations[1] + 1, batch).tolist()
+            else:
+                payload = {'table': table, 'key': keys[rows[0]]}
+                path = '/lookup'
+                if durations:
+                    payload['duration'] = int(rng.integers(durations[0], durations[1] + 1))
+            start = time.perf_counter()
+            status, response = await request(reader, writer, 'POST', path, payload)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError(f'{path} answered {status}: {response}')
+            versions.add(response['version'])
+    finally:
+        writer.close()
+
+
+async def reloader(host, port, interval, stop):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                await request(reader, writer, 'POST', '/reload')
+    finally:
+        writer.close()
+
+
+async def run(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, tables = await request(reader, writer, 'GET', '/tables')
+    _, sample = await request(reader, writer, 'GET', f'/keys?table={args.table}&limit={args.keys}')
+    writer.close()
+    if args.table not in tables['tables']:
+        raise SystemExit(f"Table {args.table} is not served, served tables: {sorted(tables['tables'])}")
+    durations = tables['tables'][args.table]['durations']
+
+    latencies = []
+    versions = set()
+    stop = asyncio.Event()
+    reload_task = asyncio.create_task(reloader(args.host, args.port, args.reload_every, stop)) \
+        if args.reload_every else None
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(args.host, args.port, args.table, sample['keys'], durations, args.requests,
+                                  args.batch, np.random.default_rng(i), latencies, versions)
+                           for i in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    if reload_task is not None:
+        await reload_task
+    return np.array(latencies), elapsed, versions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Load test of rate_server.py')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='Server address (default: %(default)s)')
+    arg_parser.add_argument('--port', type=int, default=8765, help='Server port (default: %(default)s)')
+    arg_parser.add_argument('--table', required=True, help='Table to query, e.g. CashValuePerK')
+    arg_parser.add_argument('--connections', type=int, default=8, help='Concurrent connections (default: %(default)s)')
+    arg_parser.add_argument('--requests', type=int, default=2000,
+                            help='Requests per connection (default: %(default)s)')
+    arg_parser.add_argument('--batch', type=int, default=0,
+                            help='Keys per /batch request, 0 for single /lookup requests (default: %(default)s)')
+    arg_parser.add_argument('--keys', type=int, default=10000,
+                            help='Keys sampled from the table (default: %(default)s)')
+    arg_parser.add_argument('--reload-every', type=float, default=0,
+                            help='Seconds between reload requests during the test, 0 for none (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    latencies, elapsed, versions = asyncio.run(run(args))
+    latencies_ms = latencies * 1000
+    n_keys = len(latencies) * max(args.batch, 1)
+    print(f"{'requests':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>9} {'keys/s':>11} "
+          f"{'snapshots':>9}")
+    print(f'{len(latencies):>9} {np.percentile(latencies_ms, 50):>8.3f} {np.percentile(latencies_ms, 90):>8.3f} '
+          f'{np.percentile(latencies_ms, 99):>8.3f} {latencies_ms.max():>8.3f} {len(latencies) / elapsed:>9,.0f} '
+          f'{n_keys / elapsed:>11,.0f} {len(versions):>9}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
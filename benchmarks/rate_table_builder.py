@@ -0,0 +1,79 @@
+"""
+Benchmark of the output table assembly of the parsers
+
+Compares growing the output with pd.concat inside the sheet loop against RateTableBuilder for increasing sheet counts.
+Synthetic sheets have the shape of a dividend worksheet. The time per sheet stays flat for a linear method and grows
+with the sheet count for a quadratic one.
+
+Usage: python benchmarks/rate_table_builder.py [--sheets 25 50 100 200 400] [--rows 121] [--cols 121]
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rate_table import RateTableBuilder
+
+
+def make_sheets(n_sheets, n_rows, n_cols):
+    """
+    Synthetic worksheet data frames: an Age column followed by duration columns 1..n_cols
+    """
+
+    rng = np.random.default_rng(0)
+    sheet = pd.DataFrame({'Age': np.arange(n_rows)})
+    sheet = pd.concat([sheet, pd.DataFrame(rng.random((n_rows, n_cols)), columns=range(1, n_cols + 1))], axis=1)
+    return [(sheet, {'Gender': 'MFU'[i % 3], 'Band': 'B' + str(i % 5 + 1)}) for i in range(n_sheets)]
+
+
+def concat_loop(sheets):
+    output = pd.DataFrame([])
+    for df, tags in sheets:
+        df = df.copy()
+        for name, value in tags.items():
+            df[name] = value
+        output = pd.concat([output, df], sort=False)
+    return output.reset_index(drop=True)
+
+
+def builder(sheets):
+    table = RateTableBuilder()
+    for df, tags in sheets:
+        table.append(df, tags)
+    return table.build()
+
+
+def best_time(function, sheets, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(sheets)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Benchmark pd.concat in a loop against RateTableBuilder')
+    arg_parser.add_argument('--sheets', type=int, nargs='+', default=[25, 50, 100, 200, 400],
+                            help='Sheet counts (default: %(default)s)')
+    arg_parser.add_argument('--rows', type=int, default=121, help='Rows per sheet (default: %(default)s)')
+    arg_parser.add_argument('--cols', type=int, default=121, help='Duration columns per sheet (default: %(default)s)')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per measure, best is kept (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    print(f"{'sheets':>8} {'concat s':>10} {'ms/sheet':>10} {'builder s':>10} {'ms/sheet':>10} {'speedup':>8}")
+    for n_sheets in args.sheets:
+        sheets = make_sheets(n_sheets, args.rows, args.cols)
+        pd.testing.assert_frame_equal(concat_loop(sheets), builder(sheets))
+        t_concat = best_time(concat_loop, sheets, args.repeat)
+        t_builder = best_time(builder, sheets, args.repeat)
+        print(f'{n_sheets:>8} {t_concat:>10.3f} {t_concat / n_sheets * 1000:>10.2f} {t_builder:>10.3f} '
+              f'{t_builder / n_sheets * 1000:>10.2f} {t_concat / t_builder:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Check that StreamingExcelFile reads the same data frames as pd.ExcelFile.parse
+
+Writes a workbook of sheets mixing numbers, numeric text, booleans, dates, NA strings and Excel error values, then
+parses every sheet with both readers, whole and with usecols, with and without a SheetCache, and compares the data
+frames with assert_frame_equal. Workbooks given on the command line, or found in the given directories, are compared
+sheet by sheet too, with each --skiprows value. Exits with 1 when a data frame differs.
+
+Usage: python benchmarks/sheet_reader_check.py [workbook or directory ...] [--skiprows 0 3]
+"""
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import pandas as pd
+from openpyxl import Workbook
+from pandas.testing import assert_frame_equal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sheet_cache import SheetCache
+from sheet_reader import StreamingExcelFile
+
+# Rows of the mixed sheet: every column mixes numbers with another kind of cell, rows mix kinds so that both the
+# numeric fast path and the cell by cell path of the reader are taken
+MIXED_ROWS = [
+    ['number', 'numeric text', 'bool', 'text', 'bools', 'na text', 'error', 'date'],
+    [1, '12', True, 'x', True, 'n/a', 1.5, datetime.datetime(2020, 1, 2)],
+    [2, '13', '#N/A', 5, False, None, '#DIV/0!', '12'],
+    ['n/a', 3.5, False, 'NA', True, '7', None, 3],
+    [None] * 8,
+    [4, ' 5', 'nan', '', False, '-nan', 2, 'NULL'],
+]
+# Sheet of numbers only, with an NA string in a float column
+NUMERIC_ROWS = [['Age', 'Dur.1', 'Dur.2'], [1, 2.5, 3], [2, 'n/a', 4], [3, 1.25, '#N/A']]
+
+
+def write_mixed_workbook(path):
+    """
+    Write the workbook of mixed cells
+    :param path: Workbook file path
+    """
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Mixed'
+    for row in MIXED_ROWS:
+        ws.append(row)
+    ws = wb.create_sheet('Numeric')
+    for row in NUMERIC_ROWS:
+        ws.append(row)
+    wb.save(path)
+
+
+def compare(input_file, sheet_name, cache=None, **kwargs):
+    """
+    Compare the data frames of a sheet read by both readers
+    :return: Error message, None when they are equal
+    """
+
+    expected = pd.ExcelFile(input_file).parse(sheet_name, **kwargs)
+    with StreamingExcelFile(input_file, cache=cache) as xl:
+        result = xl.parse(sheet_name, **kwargs)
+    try:
+        assert_frame_equal(result, expected)
+    except AssertionError as error:
+        return f'{os.path.basename(input_file)} {sheet_name} {kwargs}: {error}'
+    return None
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Compare StreamingExcelFile with pd.ExcelFile.parse')
+    arg_parser.add_argument('paths', nargs='*', help='Workbooks or directories of workbooks to compare as well')
+    arg_parser.add_argument('--skiprows', type=int, nargs='+', default=[0],
+                            help='Rows above the header of the given workbooks (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mixed_file = os.path.join(tmp_dir, 'mixed.xlsx')
+        write_mixed_workbook(mixed_file)
+        cache = SheetCache(os.path.join(tmp_dir, 'cache'))
+        checks = []
+        for sheet_name in ('Mixed', 'Numeric'):
+            columns = [str(name) for name in (MIXED_ROWS if sheet_name == 'Mixed' else NUMERIC_ROWS)[0]]
+            for usecols in (None, columns[::2]):
+                # Twice with the cache: decoded, then read back from the cache
+                checks += [(mixed_file, sheet_name, sheet_cache, {'usecols': usecols})
+                           for sheet_cache in (None, cache, cache)]
+
+        files = []
+        for path in args.paths:
+            files += sorted(glob.glob(os.path.join(path, '**', '*.xlsx'), recursive=True)) if os.path.isdir(path) \
+                else [path]
+        for input_file in files:
+            for sheet_name in pd.ExcelFile(input_file).sheet_names:
+                checks += [(input_file, sheet_name, None, {'skiprows': skiprows}) for skiprows in args.skiprows]
+
+        errors = [error for error in (compare(input_file, sheet_name, cache, **kwargs)
+                                      for input_file, sheet_name, cache, kwargs in checks) if error]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for error in errors:
+        print(error)
+    print(f'{len(checks) - len(errors)} of {len(checks)} data frames equal')
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Synthetic rate workbooks for benchmarks
+
+Writes input workbooks for every parser type with the file names, sheet names and sheet layouts the parsers expect,
+filled with random rates, and a config.txt pointing at them. The workbooks scale in products, bands and issue ages:
+
+    Rate/       <tag> Premium Rate File.xlsx  Prem Male Band 2, WP Female Band 3, Prem Unisex (LP10 and HECV),
+                                              Sub_Classified_Prem_Female_TOB, Male CV(BOY), GCV (BOY) Male (LP10 and
+                                              LP12), Male UPNT CV (BOY) (HECV)
+    Reserve/    <tag> Initial Reserve.xlsx    Reserve Male, Reserve Female, Reserve Unisex
+    TAI_TR/     <tag> TAI TR.xlsx             Male NS, Male SM, ...
+    Dividend/   <tag> Dividend Scale.xlsx     DIV Male NT B2, PUA Qual SPNT, ... (no LP12)
+
+Rates of the duration sheets are left blank past the maturity age, like in the real files.
+
+Usage: python benchmarks/synthetic_workbooks.py output_dir [--products 7] [--bands 5] [--ages 81]
+"""
+import argparse
+import configparser
+import os
+import numpy as np
+from openpyxl import Workbook
+
+# File name tag and product of each workbook, in product order
+PRODUCT_TAGS = [('LP10', 'L10'), ('LP12', 'L12'), ('LP15', 'L15'), ('LP20', 'L20'), ('LP65', 'L65'), ('HECV', 'L85'),
+                ('L100', 'L100')]
+# Products without bands in the Prem and WP sheet names
+UNBANDED_PRODUCTS = ['L10', 'L12', 'L85']
+# Products without dividend scale
+NO_DIVIDEND_PRODUCTS = ['L12']
+GENDERS = [('Male', 'M'), ('Female', 'F'), ('Unisex', 'U')]
+DIVIDEND_GENDERS = ['Male', 'Female', 'Unisex', 'Qual']
+DIVIDEND_TYPES = ['DIV', 'PUA', 'RPU', 'LISR', 'ALIR']
+RISK_CLASSES = ['UPNT', 'SPNT', 'NT', 'SPT', 'TOB']
+TABLE_RATINGS = ['A', 'B', 'C', 'D', 'E', 'F', 'H', 'J', 'L', 'P']
+# Age at which the duration curves stop
+MATURITY_AGE = 121
+# Row of the header of the sheets of each parser type and product, as in the shipped config.txt
+FIRST_ROWS = {
+    'CurrPremPerK': {'L10': 6},
+    'WaiverPerK': {'L10': 6},
+    'CashValuePerK': {'L10': 6},
+    'BOYStateReserve': {},
+    'TAI_TR': {},
+    'Dividend': {},
+}
+FIRST_ROW_DEFAULTS = {'CurrPremPerK': 4, 'WaiverPerK': 4, 'CashValuePerK': 5, 'BOYStateReserve': 4, 'TAI_TR': 4,
+                      'Dividend': 6}
+# Row of the header of the Sub_Classified sheets, fixed in CurrPremPerkParser
+FIRST_ROW_SUB = 4
+# Input directory of each parser type, and the IO key naming it
+INPUT_DIRS = {
+    'Rate': ['CurrPremPerK', 'WaiverPerK', 'CashValuePerK'],
+    'Reserve': ['BOYStateReserve'],
+    'TAI_TR': ['TAI_TR'],
+    'Dividend': ['Dividend'],
+}
+OUTPUT_SHEET_NAMES = {
+    'CurrPremPerK': '^CurrPremPerK_v7_2021_Final',
+    'WaiverPerK': '^WaiverPerK_v7_2021_Final',
+    'CashValuePerK': '^CashValuePerK_v7_2021_Final',
+    'BOYStateReserve': '^BOYStateReserve_v7_2021_Final',
+    'TAI_TR': '^TAI_TR_v7_2021_Final',
+    'Dividend': '^Dividends_v7_2021_Final',
+}
+
+
+def get_first_row(parser_type, product_name):
+    return FIRST_ROWS[parser_type].get(product_name, FIRST_ROW_DEFAULTS[parser_type])
+
+
+def add_sheet(wb, sheet_name, first_row, header, ages, rates):
+    """
+    Append a worksheet: title rows, the header on first_row, then one row per issue age
+    :param wb: Write-only workbook
+    :param sheet_name: Sheet name
+    :param first_row: Row of the header, 1 based
+    :param header: Header values after the Age column
+    :param ages: Issue ages
+    :param rates: Rate block (ages, header), NaN cells are left blank
+    """
+
+    ws = wb.create_sheet(sheet_name)
+    ws.append([sheet_name])
+    for _ in range(first_row - 2):
+        ws.append([])
+    ws.append(['Age'] + list(header))
+    for age, row in zip(ages, rates.tolist()):
+        ws.append([age] + [None if value != value else value for value in row])
+
+
+def make_rates(rng, ages, durations=None, n_columns=None):
+    """
+    Random rates rounded to 4 decimals, duration curves are blank past the maturity age
+    :param rng: numpy Generator
+    :param ages: Issue ages
+    :param durations: Durations of the columns, None for columns without duration
+    :param n_columns: Number of columns when durations is None
+    :return: Rate block (ages, columns)
+    """
+
+    n_columns = len(durations) if durations is not None else n_columns
+    rates = np.round(rng.uniform(0.0, 1000.0, (len(ages), n_columns)), 4)
+    if durations is not None:
+        rates[np.add.outer(np.asarray(ages), np.asarray(durations)) > MATURITY_AGE] = np.nan
+    return rates
+
+
+def rate_workbook(path, product_name, bands, ages, rng):
+    """
+    Premium rate file: Prem, WP, Sub_Classified and CV sheets
+    """
+
+    wb = Workbook(write_only=True)
+    first_row = get_first_row('CurrPremPerK', product_name)
+    cv_first_row = get_first_row('CashValuePerK', product_name)
+    for gender, letter in GENDERS:
+        header = [letter + str(i) for i in range(1, 6)] + [letter + '0']
+        if product_name in UNBANDED_PRODUCTS:
+            sheet_bands = [None]
+        else:
+            # Band 1 only exists for L100
+            sheet_bands = [b for b in range(1, bands + 1) if b > 1 or product_name == 'L100'] or [2]
+        for prefix in ('Prem', 'WP'):
+            for band in sheet_bands:
+                name = f'{prefix} {gender}' + (f' Band {band}' if band else '')
+                add_sheet(wb, name, first_row, header, ages, make_rates(rng, ages, n_columns=len(header)))
+        for risk_class in ('NT', 'TOB'):
+            add_sheet(wb, f'Sub_Classified_Prem_{gender}_{risk_class}', FIRST_ROW_SUB, TABLE_RATINGS, ages,
+                      make_rates(rng, ages, n_columns=len(TABLE_RATINGS)))
+
+        if product_name in ('L10', 'L12'):
+            # L10 gets duration 122 from the parser, L12 has it in the sheet
+            durations = list(range(1, 122 if product_name == 'L10' else 123))
+            add_sheet(wb, f'GCV (BOY) {gender}', cv_first_row, durations, ages, make_rates(rng, ages, durations))
+        elif product_name == 'L85':
+            durations = list(range(0, 122))
+            for risk_class in RISK_CLASSES:
+                add_sheet(wb, f'{gender} {risk_class} CV (BOY)', cv_first_row, durations, ages,
+                          make_rates(rng, ages, durations))
+        else:
+            durations = list(range(0, 122))
+            add_sheet(wb, f'{gender} CV(BOY)', cv_first_row, durations, ages, make_rates(rng, ages, durations))
+    wb.save(path)
+
+
+def reserve_workbook(path, product_name, bands, ages, rng):
+    """
+    Initial reserve file: one sheet per gender
+    """
+
+    wb = Workbook(write_only=True)
+    durations = list(range(1, 122))
+    for gender, _ in GENDERS:
+        add_sheet(wb, f'Reserve {gender}', get_first_row('BOYStateReserve', product_name), durations, ages,
+                  make_rates(rng, ages, durations))
+    wb.save(path)
+
+
+def tai_tr_workbook(path, product_name, bands, ages, rng):
+    """
+    TAI TR file: one sheet per gender and smoking status
+    """
+
+    wb = Workbook(write_only=True)
+    durations = list(range(1, 122))
+    for gender, _ in GENDERS:
+        for status in ('NS', 'SM'):
+            add_sheet(wb, f'{gender} {status}', get_first_row('TAI_TR', product_name), durations, ages,
+                      make_rates(rng, ages, durations))
+    wb.save(path)
+
+
+def dividend_workbook(path, product_name, bands, ages, rng):
+    """
+    Dividend scale file: one sheet per dividend type, gender or market and risk class, DIV sheets per band
+    """
+
+    wb = Workbook(write_only=True)
+    durations = list(range(1, 122))
+    for dividend_type in DIVIDEND_TYPES:
+        for gender in DIVIDEND_GENDERS:
+            for risk_class in RISK_CLASSES:
+                sheet_bands = [f'B{b}' for b in range(1, bands + 1)] if dividend_type == 'DIV' else [None]
+                for band in sheet_bands:
+                    name = ' '.join(part for part in (dividend_type, gender, risk_class, band) if part)
+                    add_sheet(wb, name, get_first_row('Dividend', product_name), durations, ages,
+                              make_rates(rng, ages, durations))
+    wb.save(path)
+
+
+# Workbook writer and file name suffix of each input directory
+WORKBOOKS = {
+    'Rate': (rate_workbook, 'Premium Rate File'),
+    'Reserve': (reserve_workbook, 'Initial Reserve'),
+    'TAI_TR': (tai_tr_workbook, 'TAI TR'),
+    'Dividend': (dividend_workbook, 'Dividend Scale'),
+}
+
+
+def write_config(path, output_dir, parser_types):
+    """
+    Write the config.txt of the synthetic workbooks
+    :param path: Configuration file path
+    :param output_dir: Directory of the input directories, also receives the output workbook
+    :param parser_types: Parser types to configure
+    """
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['IO'] = {f'{name}.input_dir': os.path.join(output_dir, name) for name in INPUT_DIRS}
+    config['IO']['Output_file'] = os.path.join(output_dir, 'output.xlsx')
+    for parser_type in parser_types:
+        config[parser_type] = {f'{product_name}.data_first_row': str(get_first_row(parser_type, product_name))
+                               for _, product_name in PRODUCT_TAGS}
+        config[parser_type]['Output_sheet_name'] = OUTPUT_SHEET_NAMES[parser_type]
+    with open(path, 'w', encoding='utf8') as f:
+        config.write(f)
+
+
+def generate(output_dir, products=len(PRODUCT_TAGS), bands=5, ages=81, parser_types=None, seed=0):
+    """
+    Write the synthetic workbooks and their config.txt
+    :param output_dir: Output directory, created if missing
+    :param products: Number of products, taken in product order
+    :param bands: Number of bands of the banded sheets, 1 to 5
+    :param ages: Number of issue ages, from age 0
+    :param parser_types: Parser types whose workbooks are written, all by default
+    :param seed: Random seed, the same arguments always write the same rates
+    :return: Configuration file path
+    """
+
+    if not 1 <= products <= len(PRODUCT_TAGS):
+        raise ValueError(f'generate: products must be between 1 and {len(PRODUCT_TAGS)}')
+    if not 1 <= bands <= 5:
+        raise ValueError('generate: bands must be between 1 and 5')
+    parser_types = parser_types or list(OUTPUT_SHEET_NAMES)
+    rng = np.random.default_rng(seed)
+    age_list = list(range(ages))
+    for name, input_parser_types in INPUT_DIRS.items():
+        if not set(input_parser_types) & set(parser_types):
+            continue
+        input_dir = os.path.join(output_dir, name)
+        os.makedirs(input_dir, exist_ok=True)
+        workbook, suffix = WORKBOOKS[name]
+        for tag, product_name in PRODUCT_TAGS[:products]:
+            if name == 'Dividend' and product_name in NO_DIVIDEND_PRODUCTS:
+                continue
+            workbook(os.path.join(input_dir, f'{tag} {suffix}.xlsx'), product_name, bands, age_list, rng)
+
+    config_file = os.path.join(output_dir, 'config.txt')
+    write_config(config_file, output_dir, parser_types)
+    return config_file
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Write synthetic rate workbooks for every parser type')
+    arg_parser.add_argument('output_dir', help='Output directory')
+    arg_parser.add_argument('--products', type=int, default=len(PRODUCT_TAGS),
+                            help='Number of products, in product order (default: %(default)s)')
+    arg_parser.add_argument('--bands', type=int, default=5, help='Number of bands, 1 to 5 (default: %(default)s)')
+    arg_parser.add_argument('--ages', type=int, default=81, help='Number of issue ages (default: %(default)s)')
+    arg_parser.add_argument('--parser-type', action='append', choices=list(OUTPUT_SHEET_NAMES),
+                            help='Parser type whose workbooks are written, can be repeated (default: all)')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Random seed (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    config_file = generate(args.output_dir, args.products, args.bands, args.ages, args.parser_type, args.seed)
+    print(f'Wrote {config_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+
+class KeyCodes():
+    """
+    Integer coded composite keys
+
+    Every row holds the code of its key in keys, the key strings are only built once per distinct key and rows are
+    expanded to strings on demand by to_strings(). Rows with a missing component have code -1, like pd.factorize.
+    """
+
+    def __init__(self, codes, keys):
+        """
+        :param codes: Key code per row, -1 for missing keys
+        :param keys: Object array of the distinct key strings
+        """
+        self.codes = codes
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.codes)
+
+    def to_strings(self):
+        """
+        Key string of every row
+        :return: Object array, NaN for missing keys
+        """
+
+        strings = self.keys[np.maximum(self.codes, 0)] if len(self.keys) else np.full(len(self.codes), np.nan, object)
+        strings[self.codes < 0] = np.nan
+        return strings
+
+
+def encode_keys(template, *columns, text_columns=()):
+    """
+    Encode composite keys from a template and key component columns
+
+    Components are factorized into small integer codes and combined from left to right, each step only builds the
+    strings of the distinct key prefixes seen so far. The row by row work is integer arithmetic, strings are only
+    concatenated once per distinct prefix instead of once per row and component.
+    :param template: Key template with one {} placeholder per column, e.g. 'CP{}A,{},{}'
+    :param columns: Key component columns (series or arrays), values are formatted with str()
+    :param text_columns: Positions of the columns whose missing values are formatted as text like astype(str) does,
+        e.g. 'nan', instead of giving a missing key
+    :return: KeyCodes
+    """
+
+    literals = template.split('{}')
+    if len(literals) != len(columns) + 1:
+        raise ValueError(f"encode_keys: Template '{template}' expects {len(literals) - 1} columns, got {len(columns)}")
+
+    n_rows = len(columns[0]) if columns else 1
+    codes = np.zeros(n_rows, dtype=np.int64)
+    missing = np.zeros(n_rows, dtype=bool)
+    keys = np.array([literals[0]], dtype=object)
+    for position, (column, literal) in enumerate(zip(columns, literals[1:])):
+        column_codes, uniques = pd.factorize(column, use_na_sentinel=position not in text_columns)
+        missing |= column_codes < 0
+        column_codes = np.maximum(column_codes, 0)
+        column_strings = np.array([str(value) for value in uniques] or [''], dtype=object)
+
+        # Combine the prefix code with the component code, both are below the number of rows so it cannot overflow
+        pair_codes, _ = pd.factorize(codes * len(column_strings) + column_codes)
+        # Codes are numbered in order of appearance, so the running maximum steps up at the first row of each code
+        first = np.flatnonzero(np.diff(np.maximum.accumulate(pair_codes), prepend=-1))
+        keys = keys[codes[first]] + column_strings[column_codes[first]] + literal
+        codes = pair_codes.astype(np.int64)
+
+    codes[missing] = -1
+    return KeyCodes(codes, keys)
+
+
+def format_keys(template, *columns, text_columns=()):
+    """
+    Build composite key strings from a template and key component columns
+    :param template: Key template with one {} placeholder per column, e.g. 'CP{}A,{},{}'
+    :param columns: Key component columns (series or arrays), values are formatted with str()
+    :param text_columns: Positions of the columns whose missing values are formatted as text, see encode_keys
+    :return: Object array of key strings, NaN where a component is missing
+    """
+
+    return encode_keys(template, *columns, text_columns=text_columns).to_strings()
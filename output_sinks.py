@@ -0,0 +1,320 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from rate_store import write_store
+from rate_table import widen_float32
+from xlsx_package import SheetXmlWriter, check_sheet_name, get_header_style, write_sheet_parts
+
+
+def _import_pyarrow():
+    """
+    Import pyarrow, only needed by the Parquet and Arrow IPC sinks
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required by the parquet and arrow output sinks, install it with: "
+                          "pip install pyarrow")
+    return pyarrow
+
+
+class BaseSink():
+    """
+    Base output sink class
+
+    write() receives all output sheets of a run at once: {sheet_name: data frame} and {sheet_name: metadata}, where
+    metadata holds the parser type, the product list and the output sheet name of the table.
+    """
+
+    def write(self, outputs, metadata):
+        """
+        Write output data frames
+        :param outputs: {sheet_name: data frame}
+        :param metadata: {sheet_name: metadata dictionary}
+        """
+        raise NotImplementedError
+
+
+class ExcelSink(BaseSink):
+    """
+    Excel output sink, appends sheets to the output workbook
+
+    The sheets are written as new worksheet parts and injected into the xlsx package, the existing sheets are copied
+    without being loaded, so the cost of a write depends on the size of the written sheets only.
+    """
+
+    def __init__(self, output_file, replace=False):
+        """
+        :param output_file: Output workbook, must exist
+        :param replace: Replace the sheets that exist, raise ValueError otherwise
+        """
+        self.output_file = output_file
+        self.replace = replace
+
+    def write(self, outputs, metadata):
+        """
+        Write data frames into excel file with proper sheet names, in one pass
+        """
+
+        header_style = get_header_style(self.output_file)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sheet_parts = {}
+            for i, (sheet_name, df_output) in enumerate(outputs.items()):
+                sheet_parts[sheet_name] = os.path.join(tmp_dir, f'sheet{i}.xml')
+                # Column A is left empty, like to_excel with startcol=1
+                writer = SheetXmlWriter(sheet_parts[sheet_name], start_col=1)
+                writer.append_frame(widen_float32(df_output), header_style=header_style)
+                writer.close()
+            write_sheet_parts(self.output_file, sheet_parts, replace=self.replace, header_style=header_style)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _header_cell(ws, value):
+    """
+    Write-only cell styled like the header of to_excel: bold, thin borders, centered at the top
+    """
+
+    cell = WriteOnlyCell(ws, value=value)
+    side = Side(style='thin')
+    cell.font = Font(bold=True)
+    cell.border = Border(left=side, right=side, top=side, bottom=side)
+    cell.alignment = Alignment(horizontal='center', vertical='top')
+    return cell
+
+
+class StreamingExcelWriter():
+    """
+    Constant memory xlsx writer
+
+    Rows are streamed into a temporary file per worksheet as they are appended, so data frames can be written one
+    product at a time and released. Memory stays flat no matter how many products are written. A new output file is
+    created through an openpyxl write-only workbook, an existing one gets the sheets injected into its xlsx package on
+    close without its other sheets being loaded.
+    """
+
+    def __init__(self, output_file, replace=False):
+        """
+        :param output_file: Output workbook, created if missing
+        :param replace: Replace the sheets that exist in an existing workbook, raise ValueError otherwise
+        """
+        self.output_file = output_file
+        self.replace = replace
+        self.append_mode = os.path.exists(output_file)
+        if self.append_mode:
+            self.book = None
+            self.header_style = get_header_style(output_file)
+            self.tmp_dir = tempfile.mkdtemp()
+        else:
+            self.book = Workbook(write_only=True)
+        self.sheets = {}
+        self.columns = {}
+
+    def add_sheet(self, sheet_name):
+        """
+        Add an empty output sheet, sheets appear in the workbook in the order they are added
+        :param sheet_name: Output sheet name
+        """
+        check_sheet_name(sheet_name)
+        if any(name.casefold() == sheet_name.casefold() for name in self.sheets):
+            raise ValueError(f"StreamingExcelWriter: Sheet '{sheet_name}' is added twice, sheet names are not case "
+                             "sensitive")
+        if self.append_mode:
+            path = os.path.join(self.tmp_dir, f'sheet{len(self.sheets)}.xml')
+            self.sheets[sheet_name] = SheetXmlWriter(path)
+        else:
+            self.sheets[sheet_name] = self.book.create_sheet(sheet_name)
+
+    def append(self, sheet_name, df_output):
+        """
+        Append the rows of a data frame to an output sheet, the header is written with the first data frame
+        :param sheet_name: Output sheet name
+        :param df_output: Data frame with the columns of the previous data frames of the sheet
+        """
+
+        ws = self.sheets[sheet_name]
+        df_output = widen_float32(df_output)
+        columns = [str(column) for column in df_output.columns]
+        if sheet_name not in self.columns:
+            self.columns[sheet_name] = columns
+            # Column A is left empty, like to_excel with startcol=1
+            if self.append_mode:
+                ws.append([None] + list(df_output.columns), style=self.header_style)
+            else:
+                ws.append([None] + [_header_cell(ws, column) for column in df_output.columns])
+        elif columns != self.columns[sheet_name]:
+            raise ValueError("StreamingExcelWriter: Data frame columns do not match the header of sheet: " + sheet_name)
+
+        for row in df_output.itertuples(index=False, name=None):
+            ws.append((None,) + row)
+
+    def close(self):
+        """
+        Save the workbook
+        """
+        if not self.append_mode:
+            self.book.save(self.output_file)
+            return
+        try:
+            for writer in self.sheets.values():
+                writer.close()
+            write_sheet_parts(self.output_file, {sheet_name: writer.path for sheet_name, writer in self.sheets.items()},
+                              replace=self.replace, header_style=self.header_style)
+        finally:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class FileSink(BaseSink):
+    """
+    Base class of sinks writing one file per output sheet into a directory
+    """
+
+    # File extension of the sink
+    EXTENSION = ''
+
+    def __init__(self, output_dir):
+        """
+        :param output_dir: Output directory, created if missing
+        """
+        self.output_dir = output_dir
+
+    def get_path(self, sheet_name):
+        """
+        File path of an output sheet, characters that are not safe in file names are dropped
+        """
+        return os.path.join(self.output_dir, re.sub(r'[^A-Za-z0-9_.-]', '', sheet_name) + self.EXTENSION)
+
+    def write(self, outputs, metadata):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for sheet_name, df_output in outputs.items():
+            path = self.get_path(sheet_name)
+            # Write next to the target and rename, so readers never see a partial file
+            tmp_path = path + '.tmp'
+            self.write_file(tmp_path, df_output, metadata[sheet_name])
+            os.replace(tmp_path, path)
+
+    def write_file(self, path, df_output, metadata):
+        """
+        Write one output data frame
+        :param path: File path
+        :param df_output: Data frame
+        :param metadata: Metadata dictionary
+        """
+        raise NotImplementedError
+
+
+class ParquetSink(FileSink):
+    """
+    Parquet output sink, metadata is stored in the schema under the rate_file_parser key
+    """
+
+    EXTENSION = '.parquet'
+
+    def write_file(self, path, df_output, metadata):
+        pa = _import_pyarrow()
+        table = _to_arrow_table(pa, df_output, metadata)
+        pa.parquet.write_table(table, path)
+
+
+class ArrowIPCSink(FileSink):
+    """
+    Arrow IPC file (Feather v2) output sink, metadata is stored in the schema under the rate_file_parser key
+    """
+
+    EXTENSION = '.arrow'
+
+    def write_file(self, path, df_output, metadata):
+        pa = _import_pyarrow()
+        table = _to_arrow_table(pa, df_output, metadata)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+class CSVSink(FileSink):
+    """
+    CSV output sink, metadata is stored in a .json file next to the csv file
+    """
+
+    EXTENSION = '.csv'
+
+    def write(self, outputs, metadata):
+        super().write(outputs, metadata)
+        for sheet_name in outputs:
+            path = self.get_path(sheet_name) + '.json'
+            with open(path + '.tmp', 'w', encoding='utf8') as f:
+                json.dump(metadata[sheet_name], f, indent=2)
+            os.replace(path + '.tmp', path)
+
+    def write_file(self, path, df_output, metadata):
+        df_output.to_csv(path, index=False)
+
+
+class RateStoreSink(FileSink):
+    """
+    Memory mapped rate store output sink, one store directory per output sheet, see rate_store.RateStore
+    """
+
+    EXTENSION = '.rates'
+
+    def write(self, outputs, metadata):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for sheet_name, df_output in outputs.items():
+            # The store replaces its header last, readers never see a partial store
+            write_store(self.get_path(sheet_name), df_output, metadata[sheet_name])
+
+
+def _to_arrow_table(pa, df_output, metadata):
+    """
+    Convert a data frame into an arrow table carrying the metadata
+    """
+
+    table = pa.Table.from_pandas(df_output, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b'rate_file_parser'] = json.dumps(metadata).encode('utf8')
+    return table.replace_schema_metadata(schema_metadata)
+
+
+def get_metadata(parser_type, sheet_name, df_output):
+    """
+    Build the metadata of an output table
+    :param parser_type: Parser type string
+    :param sheet_name: Output sheet name, which carries the rate version
+    :param df_output: Output data frame
+    :return: Metadata dictionary
+    """
+
+    return {
+        'parser_type': parser_type,
+        'products': [str(product) for product in pd.unique(df_output['Product'])],
+        'sheet_name': sheet_name,
+        'columns': [str(column) for column in df_output.columns],
+        'rows': len(df_output)
+    }
+
+
+def sink_factory(sink_type):
+    """
+    Factory function to return file sink class based on input string
+    :param sink_type: Sink type string
+    :return: Sink class
+    """
+
+    sinks = {
+        'parquet': ParquetSink,
+        'arrow': ArrowIPCSink,
+        'csv': CSVSink,
+        'store': RateStoreSink
+    }
+
+    return sinks[sink_type]
@@ -0,0 +1,653 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import numpy as np
+import pandas as pd
+from key_engine import format_keys
+from rate_matrix import DURATION_PREFIX
+from rate_table import RateTableBuilder
+from run_report import check_budget, get_recorder, run_recorded, span
+from sheet_reader import StreamingExcelFile
+
+# Marker of a Lookup without default, which raises when nothing matches
+_REQUIRED = object()
+
+
+class Lookup():
+    """
+    Tag taken from the sheet name: the value of the first key of mapping found in the sheet name or in one of its
+    space separated tokens
+
+    A tuple value replicates the rows of the sheet once per value of the tuple.
+    """
+
+    def __init__(self, mapping, token=None, upper=False, default=_REQUIRED, name='get_value', products=None,
+                 otherwise=''):
+        """
+        :param mapping: {text: value}, keys are tried in order
+        :param token: Position of the token of the sheet name to look into, None for the whole sheet name
+        :param upper: Look into the upper cased text
+        :param default: Value when no key is found, ValueError is raised if not given
+        :param name: Name of the lookup in the error message
+        :param products: Products the lookup applies to, None for all products
+        :param otherwise: Value for the other products
+        """
+        self.mapping = mapping
+        self.token = token
+        self.upper = upper
+        self.default = default
+        self.name = name
+        self.products = products
+        self.otherwise = otherwise
+
+    def __call__(self, sheet, info, product_name):
+        """
+        :param sheet: Sheet name
+        :param info: Tokens of the sheet name
+        :param product_name: Product name
+        :return: Tag value
+        """
+
+        if self.products is not None and product_name not in self.products:
+            return self.otherwise
+        text = sheet if self.token is None else info[self.token]
+        if self.upper:
+            text = text.upper()
+        for key, value in self.mapping.items():
+            if key in text:
+                return value
+        if self.default is _REQUIRED:
+            raise ValueError(f"{self.name}: Please check the sheet name of input file. Program Terminated with value: "
+                             + text)
+        return self.default
+
+
+class Token():
+    """
+    Tag taken from a token of the sheet name, when the sheet name has the expected form
+    """
+
+    def __init__(self, index, n_tokens=None, contains=None, prefix='', default=''):
+        """
+        :param index: Position of the token
+        :param n_tokens: Number of tokens the sheet name must have
+        :param contains: Text the sheet name must contain
+        :param prefix: Text put before the token
+        :param default: Value for the other sheet names, a tuple replicates the rows once per value
+        """
+        self.index = index
+        self.n_tokens = n_tokens
+        self.contains = contains
+        self.prefix = prefix
+        self.default = default
+
+    def __call__(self, sheet, info, product_name):
+        if self.n_tokens is not None and len(info) != self.n_tokens:
+            return self.default
+        if self.contains is not None and self.contains not in sheet:
+            return self.default
+        return self.prefix + info[self.index]
+
+
+class HeaderPart():
+    """
+    Tag taken from the header of a melted column, e.g. the risk class digit of M1
+    """
+
+    def __init__(self, mapping=None, pattern=r'([A-Za-z]+)', part=2):
+        """
+        :param mapping: {part: value}, parts missing from the mapping are kept as they are
+        :param pattern: Pattern splitting the header, with a capturing group like str.split
+        :param part: Position of the part in the split header
+        """
+        self.mapping = mapping or {}
+        self.pattern = pattern
+        self.part = part
+
+    def __call__(self, label):
+        if not isinstance(label, str):
+            return np.nan
+        parts = re.split(self.pattern, label)
+        if len(parts) <= self.part:
+            return np.nan
+        return self.mapping.get(parts[self.part], parts[self.part])
+
+
+class Melt():
+    """
+    Reshape of a sheet into one row per issue age and value column, like pd.melt
+    """
+
+    def __init__(self, values, id_column='Age', variable='variable', value='value', header_tags=None):
+        """
+        :param values: Value columns, a list of names or a slice of the column positions
+        :param id_column: Column kept on every row
+        :param variable: Output column of the header of the value columns
+        :param value: Output column of the values
+        :param header_tags: {column: HeaderPart} of the columns taken from the header of the value columns
+        """
+        self.values = values
+        self.id_column = id_column
+        self.variable = variable
+        self.value = value
+        self.header_tags = header_tags or {}
+
+    def apply(self, df):
+        """
+        Melt a sheet, every header is tagged once and the values are taken column major from one block
+        :param df: Sheet data frame
+        :return: {column: array}
+        """
+
+        labels = df.columns[self.values].tolist() if isinstance(self.values, slice) else list(self.values)
+        n_rows = len(df)
+        columns = {
+            self.id_column: np.tile(df[self.id_column].to_numpy(), len(labels)),
+            self.variable: np.repeat(np.array(labels, dtype=object), n_rows),
+            self.value: df[labels].to_numpy().ravel(order='F'),
+        }
+        for name, tag in self.header_tags.items():
+            columns[name] = np.repeat(np.array([tag(label) for label in labels], dtype=object), n_rows)
+        return columns
+
+
+class Key():
+    """
+    Key column built from a template, see key_engine.format_keys
+    """
+
+    def __init__(self, column, template, sources, text_sources=('Age',)):
+        """
+        :param column: Output column
+        :param template: Template with one {} per source column
+        :param sources: Source columns
+        :param text_sources: Source columns the original parsers converted with astype(str), a missing value is
+            written 'nan' in the key instead of giving a missing key
+        """
+        self.column = column
+        self.template = template
+        self.sources = sources
+        self.text_columns = [position for position, source in enumerate(sources) if source in text_sources]
+
+    def apply(self, df):
+        df[self.column] = format_keys(self.template, *[df[source] for source in self.sources],
+                                      text_columns=self.text_columns)
+
+
+def _match(df, where):
+    """
+    Boolean mask of the rows whose columns hold one of the given values
+    :param where: {column: list of values}
+    """
+
+    mask = np.ones(len(df), dtype=bool)
+    for column, values in where.items():
+        mask &= df[column].isin(values).to_numpy()
+    return mask
+
+
+class CopyRows():
+    """
+    Derived rows: copies of the matching rows with some columns set, appended to the table
+    """
+
+    def __init__(self, where, values):
+        """
+        :param where: {column: list of values} the copied rows match
+        :param values: {column: value} set on the copies
+        """
+        self.where = where
+        self.values = values
+
+    def apply(self, df):
+        copies = df[_match(df, self.where)].copy()
+        for column, value in self.values.items():
+            copies[column] = value
+        return pd.concat([df, copies], sort=False, ignore_index=True)
+
+
+class DropRows():
+    """
+    Rows removed from the table, the other rows keep their labels
+    """
+
+    def __init__(self, where, below=None):
+        """
+        :param where: {column: list of values} the dropped rows match
+        :param below: {column: bound} the dropped rows are also below of
+        """
+        self.where = where
+        self.below = below or {}
+
+    def apply(self, df):
+        mask = _match(df, self.where)
+        for column, bound in self.below.items():
+            mask &= (df[column] < bound).to_numpy()
+        return df[~mask]
+
+
+class SetColumn():
+    """
+    Column set to a constant, on all rows or on the matching rows
+    """
+
+    def __init__(self, column, value, where=None, products=None):
+        """
+        :param column: Column, created if missing
+        :param value: Value
+        :param where: {column: list of values} of the rows set, None for all rows
+        :param products: Products the column is set for, None for all products
+        """
+        self.column = column
+        self.value = value
+        self.where = where
+        self.products = products
+
+    def apply(self, df, product_name):
+        if self.products is not None and product_name not in self.products:
+            return
+        if self.where is None:
+            df[self.column] = self.value
+        else:
+            df.loc[_match(df, self.where), self.column] = self.value
+
+
+class TableFilter():
+    """
+    Rows and columns requested from the tables: products, genders, risk classes, bands, dividend types and a range of
+    duration columns
+
+    The filter is pushed down to the sheet names: workbooks of other products are skipped before they are opened and
+    sheets whose tags are not requested are never decoded. Rows are then filtered on the tags taken from the headers
+    and on the derived rows, so a filtered table holds exactly the matching rows of the full table. Dimensions a
+    table does not have and rows without a value for a dimension ('') are not filtered. Sheets that derived rows are
+    copied from are kept, e.g. PUA sheets for ALIR PUA rates.
+
+    The duration range is pushed down to the sheet reader: the rate columns of the Dur. columns outside of the range
+    are not read. Tables without duration columns are not projected.
+    """
+
+    # Columns of each dimension in the tables of the parsers
+    DIMENSIONS = {
+        'genders': ['Gender'],
+        'classes': ['Class', 'Underwriting Class', 'Smk Stat'],
+        'bands': ['Band'],
+        'dividend_types': ['Base/PUA/RPU'],
+    }
+
+    def __init__(self, products=None, genders=None, classes=None, bands=None, dividend_types=None, durations=None):
+        """
+        :param products: Products (L10, L15, ...), None for all
+        :param genders: Genders (M, F, U), None for all
+        :param classes: Risk classes (UPNT, NT, T, ...), None for all
+        :param bands: Bands (B1 to B5), None for all
+        :param dividend_types: Dividend types (Base, PUA, ALIR PUA, RPU, LISR, ALIR), None for all
+        :param durations: (first, last) durations of the Dur. columns kept, both included, None for an open bound,
+                          None for all durations
+        """
+        self.products = products
+        self.genders = genders
+        self.classes = classes
+        self.bands = bands
+        self.dividend_types = dividend_types
+        self.durations = tuple(durations) if durations is not None else None
+
+    def __bool__(self):
+        return any(values is not None for values in self.to_dict().values())
+
+    def to_dict(self):
+        """
+        :return: {dimension: list of values or None}, the JSON form of the filter
+        """
+        return {'products': self.products, 'genders': self.genders, 'classes': self.classes, 'bands': self.bands,
+                'dividend_types': self.dividend_types,
+                'durations': list(self.durations) if self.durations is not None else None}
+
+    def keep_product(self, product_name):
+        """
+        :return: True if the workbooks of the product are requested
+        """
+        return self.products is None or product_name in self.products
+
+    def keep_column(self, name):
+        """
+        :param name: Output column name
+        :return: False for the duration columns outside of the duration range
+        """
+
+        if self.durations is None or not name.startswith(DURATION_PREFIX):
+            return True
+        duration = int(name[len(DURATION_PREFIX):])
+        first, last = self.durations
+        return (first is None or duration >= first) and (last is None or duration <= last)
+
+    def get_columns(self):
+        """
+        :return: {column: set of requested values} of the filtered dimensions
+        """
+
+        columns = {}
+        for dimension, names in self.DIMENSIONS.items():
+            values = getattr(self, dimension)
+            if values is not None:
+                for name in names:
+                    columns[name] = set(values)
+        return columns
+
+    def get_sources(self, derive):
+        """
+        Requested values extended with the values derived rows are copied from
+        :param derive: List of CopyRows and DropRows of the table
+        :return: {column: set of values, None when any value can be a source}
+        """
+
+        columns = self.get_columns()
+        for column, values in columns.items():
+            changed = True
+            while changed and values is not None:
+                changed = False
+                for step in derive:
+                    if not isinstance(step, CopyRows) or step.values.get(column) not in values:
+                        continue
+                    if column not in step.where:
+                        # Copies of any row can get a requested value
+                        values = None
+                        break
+                    if not values.issuperset(step.where[column]):
+                        values |= set(step.where[column])
+                        changed = True
+            columns[column] = values
+        return {column: values for column, values in columns.items() if values is not None}
+
+    def filter_tags(self, tags, columns):
+        """
+        Narrow the tags of a sheet to the requested values
+        :param tags: {column: value} of a sheet, tuple values replicate the rows of the sheet
+        :param columns: {column: set of values}
+        :return: Narrowed tags, None if no row of the sheet is requested
+        """
+
+        for column, values in columns.items():
+            value = tags.get(column)
+            if value is None or value == '':
+                continue
+            if isinstance(value, tuple):
+                value = tuple(v for v in value if v == '' or v in values)
+                if not value:
+                    return None
+                tags = dict(tags, **{column: value})
+            elif value not in values:
+                return None
+        return tags
+
+    def filter_rows(self, df, columns):
+        """
+        Rows of a table holding requested values, rows keep their labels
+        :param df: Data frame
+        :param columns: {column: set of values}
+        :return: Data frame
+        """
+
+        mask = np.ones(len(df), dtype=bool)
+        for column, values in columns.items():
+            if column in df.columns:
+                mask &= df[column].isin(list(values) + ['']).to_numpy()
+        return df if mask.all() else df[mask]
+
+
+@contextmanager
+def process_pool(max_workers):
+    """
+    Process pool that stops at the first error, e.g. MemoryBudgetError of a worker: the tasks not started yet are
+    cancelled and the error is raised without waiting for the tasks still running
+    :param max_workers: Number of worker processes
+    :return: Context manager of a ProcessPoolExecutor
+    """
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+class Section():
+    """
+    Sheets of a workbook sharing a layout: which sheets, where their header is, the tags taken from their names, how
+    they are reshaped and the keys built on their rows
+    """
+
+    def __init__(self, prefix=None, contains=None, first_row=None, tags=None, melt=None, keys=None):
+        """
+        :param prefix: Prefix of the sheet names, None for any
+        :param contains: Texts one of which the sheet names contain, None for any
+        :param first_row: Row of the header, None for the first row of the parser
+        :param tags: {column: value or Lookup or Token} of the columns taken from the sheet name
+        :param melt: Melt of the sheets, None to keep their columns
+        :param keys: List of Key of the section rows
+        """
+        self.prefix = prefix
+        self.contains = contains
+        self.first_row = first_row
+        self.tags = tags or {}
+        self.melt = melt
+        self.keys = keys or []
+
+    def match(self, sheet):
+        """
+        :return: True if the sheet belongs to the section
+        """
+
+        if self.prefix is not None and sheet[:len(self.prefix)] != self.prefix:
+            return False
+        return self.contains is None or any(text in sheet for text in self.contains)
+
+    def get_tags(self, sheet, product_name):
+        """
+        Tags of a sheet, from its name only
+        :return: {column: value}, tuple values replicate the rows of the sheet
+        """
+
+        info = sheet.split(' ')
+        return {column: tag(sheet, info, product_name) if callable(tag) else tag for column, tag in self.tags.items()}
+
+    def read(self, xl, sheet, first_row, usecols=None):
+        """
+        Read and reshape a sheet
+        :param xl: Excel file object
+        :param sheet: Sheet name
+        :param first_row: Row of the header of the parser
+        :param usecols: Names of the columns read, None for all columns
+        :return: Data frame, or {column: array} of a melted sheet
+        """
+
+        with span('read_sheet', sheet=sheet):
+            df = xl.parse(sheet_name=sheet, skiprows=(self.first_row or first_row) - 1, usecols=usecols,
+                          encoding='utf8')
+        if self.melt is None:
+            return df
+        with span('melt', sheet=sheet):
+            return self.melt.apply(df)
+
+    def read_sheets(self, input_file, cache, first_row, sheets, usecols=None):
+        """
+        Read and reshape a list of sheets, runs in a worker process with its own Excel file object
+        :return: List of data in the order of sheets
+        """
+
+        frames = []
+        with StreamingExcelFile(input_file, cache=cache) as xl:
+            for sheet in sheets:
+                frames.append(self.read(xl, sheet, first_row, usecols))
+                # The frames of the chunk are held until it is done
+                check_budget('read_sheets')
+        return frames
+
+    def build(self, plan, frames, product_name, table_filter=None, columns=None):
+        """
+        Assemble the sheets of the section
+        :param plan: List of (sheet, tags)
+        :param frames: Data of the sheets, in the order of plan
+        :param product_name: Product name
+        :param table_filter: TableFilter of the rows, None for all rows
+        :param columns: {column: set of values} kept by table_filter
+        :return: Data frame
+        """
+
+        with span('build_table'):
+            builder = RateTableBuilder()
+            for (_, tags), data in zip(plan, frames):
+                replicated = [column for column, value in tags.items() if isinstance(value, tuple)]
+                if not replicated:
+                    builder.append(data, tags)
+                    continue
+                # One copy of the rows per value of the replicated tag
+                column = replicated[0]
+                for value in tags[column]:
+                    builder.append(data, dict(tags, **{column: value}))
+            output = builder.build()
+        if table_filter:
+            # Rows of the tags taken from the headers
+            output = table_filter.filter_rows(output, columns)
+        output['Product'] = product_name
+        with span('keys'):
+            for key in self.keys:
+                key.apply(output)
+        return output
+
+
+class TableSpec():
+    """
+    Declarative description of an output table
+
+    A table is made of one or several sections of sheets. Each section is read sheet by sheet, tagged with the
+    information of the sheet names, reshaped and assembled once, then the table gets its derived rows, keys and
+    constant columns and its columns are selected in order and renamed. Sheet names are classified before any cell
+    is read, so a sheet name that does not parse fails before the workbook is decoded.
+    """
+
+    def __init__(self, sections, columns, names, product_columns=None, derive=None, keys=None, constants=None,
+                 reset_index=True):
+        """
+        :param sections: List of Section
+        :param columns: Columns of the output in order, column names are compared as strings
+        :param names: Output column names, one per column
+        :param product_columns: {product: columns} of the products with other columns
+        :param derive: List of CopyRows and DropRows applied in order
+        :param keys: List of Key built after the derived rows
+        :param constants: List of SetColumn applied in order
+        :param reset_index: Give the output a fresh RangeIndex, otherwise rows keep their labels after DropRows
+        """
+        self.sections = sections
+        self.columns = columns
+        self.names = names
+        self.product_columns = product_columns or {}
+        self.derive = derive or []
+        self.keys = keys or []
+        self.constants = constants or []
+        self.reset_index = reset_index
+
+    def plan(self, sheet_names, product_name, table_filter=None):
+        """
+        Sheets of each section with their tags
+        :param sheet_names: Sheet names of the workbook
+        :param product_name: Product name
+        :param table_filter: TableFilter, sheets without requested rows are left out
+        :return: List of (section, [(sheet, tags)]) in the order of sections
+        """
+
+        plans = [(section, [(sheet, section.get_tags(sheet, product_name)) for sheet in sheet_names
+                            if section.match(sheet)]) for section in self.sections]
+        if not table_filter:
+            return plans
+        columns = table_filter.get_sources(self.derive)
+        plans = [(section, [(sheet, table_filter.filter_tags(tags, columns)) for sheet, tags in plan])
+                 for section, plan in plans]
+        return [(section, [(sheet, tags) for sheet, tags in plan if tags is not None]) for section, plan in plans]
+
+    def project(self, product_name, table_filter=None):
+        """
+        Output columns of a product within the duration range of a filter, and the sheet columns they are built from
+        :param product_name: Product name
+        :param table_filter: TableFilter, None for all columns
+        :return: (columns, names, names of the sheet columns read or None for all columns)
+        """
+
+        columns = self.product_columns.get(product_name, self.columns)
+        if table_filter is None or all(table_filter.keep_column(name) for name in self.names):
+            return columns, self.names, None
+
+        kept = [(column, name) for column, name in zip(columns, self.names) if table_filter.keep_column(name)]
+        # Besides the output columns, the sheets keep the columns the keys, derived rows and constants are built from
+        usecols = [column for column, _ in kept]
+        for key in self.keys + [key for section in self.sections for key in section.keys]:
+            usecols += key.sources
+        for step in self.derive + self.constants:
+            usecols += list(step.where or {}) + list(getattr(step, 'below', {}))
+        return [column for column, _ in kept], [name for _, name in kept], list(dict.fromkeys(usecols))
+
+    def parse(self, xl, product_name, first_row, sheet_jobs=1, table_filter=None):
+        """
+        Parse a workbook into the output table
+        :param xl: Excel file object
+        :param product_name: Product name
+        :param first_row: Row of the header of the sheets
+        :param sheet_jobs: Number of worker processes used to read the sheets of a section, 1 to read them here
+        :param table_filter: TableFilter of the rows and duration columns, None for the whole table
+        :return: Data frame
+        """
+
+        sources = table_filter.get_sources(self.derive) if table_filter else None
+        columns, names, usecols = self.project(product_name, table_filter)
+        outputs = []
+        for section, plan in self.plan(xl.sheet_names, product_name, table_filter):
+            if not plan:
+                continue
+            sheets = [sheet for sheet, _ in plan]
+            # Melted sheets are read whole, their columns are not durations
+            section_usecols = usecols if section.melt is None else None
+            if sheet_jobs > 1 and len(sheets) > 1:
+                # Split sheets into contiguous chunks, one per worker, so every worker opens the workbook once
+                size = -(-len(sheets) // sheet_jobs)
+                chunks = [sheets[i:i + size] for i in range(0, len(sheets), size)]
+                worker = partial(section.read_sheets, xl.input_file, xl.cache, first_row, usecols=section_usecols)
+                recorder = get_recorder()
+                if recorder is not None:
+                    # Workers send their timing spans back with the frames
+                    worker = partial(run_recorded, recorder.options, worker)
+                with process_pool(len(chunks)) as executor:
+                    results = list(executor.map(worker, chunks))
+                if recorder is not None:
+                    for _, spans in results:
+                        recorder.merge(spans)
+                    results = [chunk_frames for chunk_frames, _ in results]
+                frames = [data for chunk_frames in results for data in chunk_frames]
+            else:
+                frames = [section.read(xl, sheet, first_row, section_usecols) for sheet in sheets]
+            outputs.append(section.build(plan, frames, product_name, table_filter, sources))
+        if not outputs:
+            # No sheet of the workbook is requested
+            return pd.DataFrame(columns=names)
+
+        output = outputs[0] if len(outputs) == 1 else pd.concat(outputs, sort=False)
+        if self.derive:
+            with span('derive_rows'):
+                for step in self.derive:
+                    output = step.apply(output)
+            if table_filter:
+                output = table_filter.filter_rows(output, table_filter.get_columns())
+        with span('keys'):
+            for key in self.keys:
+                key.apply(output)
+        for constant in self.constants:
+            constant.apply(output, product_name)
+
+        output.columns = output.columns.astype(str)
+        output = output[columns]
+        output.columns = names
+        if self.reset_index:
+            output = output.reset_index(drop=True)
+        return output
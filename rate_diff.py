@@ -0,0 +1,338 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from rate_store import HEADER_FILE, RateStore
+
+# Key columns of the output tables, rows are aligned on the ones present on both sides
+KEY_COLUMNS = ['PA_Key', 'PA_KEY', 'Code', 'CODE']
+# Name of the occurrence number of a key, which tells apart rows with the same key
+OCCURRENCE_COLUMN = 'Occurrence'
+# Rows read at once from each side
+CHUNK_ROWS_DEFAULT = 100000
+# Source bytes per partition, sides larger than this are spilled to partition files and diffed partition by partition
+PARTITION_BYTES = 64 << 20
+
+
+class DiffReport():
+    """
+    Differences between two rate tables
+
+    Rows are identified by their key columns and the occurrence number of the key, 0 for the first row with a key, so
+    tables with repeated keys are aligned row by row in file order. Added rows are only on the right side, removed rows
+    only on the left side, changed cells are cells of aligned rows whose values differ beyond the tolerance.
+    """
+
+    def __init__(self, key_columns, atol, rtol):
+        self.key_columns = list(key_columns)
+        self.atol = atol
+        self.rtol = rtol
+        self.rows_left = 0
+        self.rows_right = 0
+        self.columns_added = []
+        self.columns_removed = []
+        self.added = []
+        self.removed = []
+        self.changes = []
+        self.changed_cells = {}
+        self.max_abs_diff = {}
+
+    def is_equal(self):
+        """
+        :return: True when both tables have the same columns, rows and values within the tolerance
+        """
+        return not (self.columns_added or self.columns_removed or self.n_added or self.n_removed or self.n_changed)
+
+    @property
+    def n_added(self):
+        return sum(len(df) for df in self.added)
+
+    @property
+    def n_removed(self):
+        return sum(len(df) for df in self.removed)
+
+    @property
+    def n_changed(self):
+        return sum(self.changed_cells.values())
+
+    def summary(self):
+        """
+        Summary of the differences
+        :return: Dictionary
+        """
+
+        return {
+            'equal': self.is_equal(),
+            'key_columns': self.key_columns,
+            'atol': self.atol,
+            'rtol': self.rtol,
+            'rows_left': self.rows_left,
+            'rows_right': self.rows_right,
+            'columns_added': self.columns_added,
+            'columns_removed': self.columns_removed,
+            'rows_added': self.n_added,
+            'rows_removed': self.n_removed,
+            'cells_changed': self.n_changed,
+            'changed_cells_by_column': {name: count for name, count in self.changed_cells.items() if count},
+            'max_abs_diff_by_column': {name: value for name, value in self.max_abs_diff.items() if value},
+        }
+
+    def to_frame(self):
+        """
+        Differences in long format, one row per added or removed row and per changed cell
+        :return: Data frame with the change type, the key columns, the occurrence, the column and both values
+        """
+
+        columns = ['Change'] + self.key_columns + [OCCURRENCE_COLUMN, 'Column', 'Left', 'Right']
+        frames = [df.assign(Change='added') for df in self.added] + \
+                 [df.assign(Change='removed') for df in self.removed] + \
+                 [df.assign(Change='changed') for df in self.changes]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True).reindex(columns=columns)
+
+    def write(self, path):
+        """
+        Write the differences as csv and the summary as json next to it
+        :param path: Report csv file path
+        """
+
+        self.to_frame().to_csv(path, index=False)
+        with open(path + '.json', 'w', encoding='utf8') as f:
+            json.dump(self.summary(), f, indent=2, default=float)
+
+
+def iter_chunks(source, chunk_rows=CHUNK_ROWS_DEFAULT):
+    """
+    Read a table in chunks of rows
+    :param source: Data frame, csv file path or rate store directory
+    :param chunk_rows: Rows per chunk
+    :return: Iterator of data frames
+    """
+
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, max(len(source), 1), chunk_rows):
+            yield source.iloc[start:start + chunk_rows]
+    elif os.path.isdir(source) and os.path.exists(os.path.join(source, HEADER_FILE)):
+        store = RateStore.open(source)
+        for start in range(0, max(len(store), 1), chunk_rows):
+            yield store.to_frame(slice(start, start + chunk_rows))
+    else:
+        yield from pd.read_csv(source, chunksize=chunk_rows, low_memory=False)
+
+
+def get_columns(source):
+    """
+    Column names of a table without reading its rows
+    """
+
+    if isinstance(source, pd.DataFrame):
+        return [str(name) for name in source.columns]
+    if os.path.isdir(source):
+        return RateStore.open(source).columns
+    return list(pd.read_csv(source, nrows=0).columns)
+
+
+def get_size(source):
+    """
+    Approximate size of a table in bytes
+    """
+
+    if isinstance(source, pd.DataFrame):
+        return 0
+    if os.path.isdir(source):
+        return sum(os.path.getsize(os.path.join(source, name)) for name in os.listdir(source))
+    return os.path.getsize(source)
+
+
+def diff_tables(left, right, key_columns=None, atol=0.0, rtol=0.0, chunk_rows=CHUNK_ROWS_DEFAULT, partitions=None):
+    """
+    Compare two rate tables
+
+    Both sides are read in chunks and their rows are distributed by a hash of the key into partitions, spilled to
+    temporary files when the sides are larger than PARTITION_BYTES. Each partition holds every row of its keys on both
+    sides, so partitions are aligned and compared one at a time and memory is bounded by the partition size. Numeric
+    columns are equal when |left - right| <= atol + rtol * |right| or both are missing, the other columns when their
+    values are equal or both missing.
+    :param left: Reference table: data frame, csv file path or rate store directory
+    :param right: Compared table: data frame, csv file path or rate store directory
+    :param key_columns: Columns identifying rows, the key columns present on both sides if None
+    :param atol: Absolute tolerance of numeric columns
+    :param rtol: Relative tolerance of numeric columns
+    :param chunk_rows: Rows read at once from each side
+    :param partitions: Number of key partitions, from the size of the sides if None
+    :return: DiffReport
+    """
+
+    columns_left = get_columns(left)
+    columns_right = get_columns(right)
+    if key_columns is None:
+        key_columns = [name for name in KEY_COLUMNS if name in columns_left and name in columns_right]
+        if not key_columns:
+            raise ValueError(f'diff_tables: No key column of {KEY_COLUMNS} on both sides, set key_columns')
+    report = DiffReport(key_columns, atol, rtol)
+    report.columns_added = [name for name in columns_right if name not in columns_left]
+    report.columns_removed = [name for name in columns_left if name not in columns_right]
+    columns = [name for name in columns_left if name in columns_right and name not in key_columns]
+
+    if partitions is None:
+        partitions = max(1, math.ceil((get_size(left) + get_size(right)) / PARTITION_BYTES))
+
+    if partitions == 1:
+        df_left, df_right = [pd.concat(list(iter_chunks(source, chunk_rows)), ignore_index=True)
+                             for source in (left, right)]
+        df_left.columns, df_right.columns = columns_left, columns_right
+        report.rows_left, report.rows_right = len(df_left), len(df_right)
+        _diff_partition(report, df_left, df_right, columns)
+        return report
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pieces = {}
+        for side, source in [('left', left), ('right', right)]:
+            for n, chunk in enumerate(iter_chunks(source, chunk_rows)):
+                chunk.columns = [str(name) for name in chunk.columns]
+                if side == 'left':
+                    report.rows_left += len(chunk)
+                else:
+                    report.rows_right += len(chunk)
+                partition = pd.util.hash_pandas_object(chunk[key_columns].astype(str), index=False).to_numpy() \
+                    % partitions
+                for p in np.unique(partition):
+                    path = os.path.join(tmp_dir, f'{side}-{p}-{n}.pkl')
+                    chunk[partition == p].to_pickle(path)
+                    pieces.setdefault((side, p), []).append(path)
+
+        for p in range(partitions):
+            frames = {side: pd.concat([pd.read_pickle(path) for path in pieces.get((side, p), [])] or
+                                      [pd.DataFrame(columns=columns_left if side == 'left' else columns_right)],
+                                      ignore_index=True)
+                      for side in ['left', 'right']}
+            _diff_partition(report, frames['left'], frames['right'], columns)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return report
+
+
+def _diff_partition(report, df_left, df_right, columns):
+    """
+    Compare the rows of one key partition and add the differences to the report
+    """
+
+    key_columns = report.key_columns
+    keys_left = _get_row_keys(df_left, key_columns)
+    keys_right = _get_row_keys(df_right, key_columns)
+    rows_right = keys_right.get_indexer(keys_left)
+    rows_left = keys_left.get_indexer(keys_right)
+
+    def key_frame(keys, rows):
+        return keys[rows].to_frame(index=False, name=key_columns + [OCCURRENCE_COLUMN])
+
+    removed = np.flatnonzero(rows_right < 0)
+    added = np.flatnonzero(rows_left < 0)
+    if len(removed):
+        report.removed.append(key_frame(keys_left, removed))
+    if len(added):
+        report.added.append(key_frame(keys_right, added))
+
+    common_left = np.flatnonzero(rows_right >= 0)
+    if not len(common_left):
+        return
+    common_right = rows_right[common_left]
+    common_keys = key_frame(keys_left, common_left)
+    for name in columns:
+        values_left = df_left[name].to_numpy()[common_left]
+        values_right = df_right[name].to_numpy()[common_right]
+        changed, abs_diff = _compare(values_left, values_right, report.atol, report.rtol)
+        report.changed_cells[name] = report.changed_cells.get(name, 0) + len(changed)
+        if abs_diff is not None and len(changed):
+            report.max_abs_diff[name] = max(report.max_abs_diff.get(name, 0.0), float(np.nanmax(abs_diff)))
+        if len(changed):
+            changes = common_keys.iloc[changed].reset_index(drop=True)
+            changes['Column'] = name
+            changes['Left'] = values_left[changed]
+            changes['Right'] = values_right[changed]
+            report.changes.append(changes)
+
+
+def _get_row_keys(df, key_columns):
+    """
+    Row identifiers: key columns and occurrence number of the key
+    :return: MultiIndex
+    """
+
+    keys = df[key_columns].astype(str)
+    occurrence = keys.groupby(key_columns, sort=False).cumcount().to_numpy()
+    return pd.MultiIndex.from_arrays([keys[name].to_numpy() for name in key_columns] + [occurrence])
+
+
+def _compare(values_left, values_right, atol, rtol):
+    """
+    Compare aligned values
+    :return: (positions of the values that differ, absolute differences of those values or None if not numeric)
+    """
+
+    if pd.api.types.is_numeric_dtype(values_left.dtype) and pd.api.types.is_numeric_dtype(values_right.dtype) and \
+            values_left.dtype != bool and values_right.dtype != bool:
+        values_left = values_left.astype(np.float64)
+        values_right = values_right.astype(np.float64)
+        with np.errstate(invalid='ignore'):
+            abs_diff = np.abs(values_left - values_right)
+            equal = (abs_diff <= atol + rtol * np.abs(values_right)) | (values_left == values_right)
+        equal |= np.isnan(values_left) & np.isnan(values_right)
+        changed = np.flatnonzero(~equal)
+        return changed, abs_diff[changed]
+
+    missing_left = pd.isna(values_left)
+    missing_right = pd.isna(values_right)
+    equal = (missing_left & missing_right) | (values_left.astype(object) == values_right.astype(object))
+    return np.flatnonzero(~equal), None
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+    :param argv: Argument list, sys.argv[1:] if None
+    :return: Parsed arguments
+    """
+
+    arg_parser = argparse.ArgumentParser(description='Compare two rate tables (csv files or rate store directories) '
+                                                     'aligned on their key columns')
+    arg_parser.add_argument('left', help='Reference table')
+    arg_parser.add_argument('right', help='Compared table')
+    arg_parser.add_argument('--key', action='append',
+                            help='Key column, can be repeated (default: the columns of ' + ', '.join(KEY_COLUMNS) +
+                                 ' present on both sides)')
+    arg_parser.add_argument('--atol', type=float, default=0.0,
+                            help='Absolute tolerance of numeric columns (default: %(default)s)')
+    arg_parser.add_argument('--rtol', type=float, default=0.0,
+                            help='Relative tolerance of numeric columns (default: %(default)s)')
+    arg_parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS_DEFAULT,
+                            help='Rows read at once from each side (default: %(default)s)')
+    arg_parser.add_argument('--partitions', type=int,
+                            help='Number of key partitions diffed one at a time (default: from the size of the tables)')
+    arg_parser.add_argument('--report', help='Write the differences to this csv file and the summary next to it')
+    return arg_parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Compare two tables, print the summary and exit with 1 when they differ
+    :param argv: Argument list, sys.argv[1:] if None
+    """
+
+    args = parse_args(argv)
+    report = diff_tables(args.left, args.right, args.key, args.atol, args.rtol, args.chunk_rows, args.partitions)
+    if args.report:
+        report.write(args.report)
+    print(json.dumps(report.summary(), indent=2, default=float))
+    sys.exit(0 if report.is_equal() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,54 @@
 import pandas as pd
 import sys
 import numpy as np
+import os
 from os import listdir
+import argparse
 import configparser
+import json
+import re
+from collections import deque
+from functools import partial
+from output_sinks import ExcelSink, StreamingExcelWriter, get_metadata, sink_factory
+from rate_diff import diff_tables
+from rate_fingerprint import ContentFingerprint, fingerprint_table
+from parser_engine import CopyRows, DropRows, HeaderPart, Key, Lookup, Melt, Section, SetColumn, TableFilter, \
+    TableSpec, Token, process_pool
+from rate_matrix import RateMatrix
+from rate_table import FLOAT32_RTOL_DEFAULT, compact_frame
+from run_report import MemoryBudgetError, RunRecorder, get_recorder, profile, run_recorded, set_recorder, span
+from sheet_cache import SheetCache, file_hash
+from sheet_reader import StreamingExcelFile
+
+
+# Gender of the sheet names, Qual is the qualified market of the dividend sheets
+GENDER_DICT = {'Male': 'M', 'Female': 'F', 'Unisex': 'U', 'Qual': 'U'}
+# Risk class of the sheet names
+RISK_CLASS_NAME_DICT = {'UPNT': 'UPNT', 'SPNT': 'SPNT', 'NT': 'NT', 'SPT': 'ST', 'TOB': 'T', 'T': 'T'}
+# Risk sub classes of the sheet names used for PA_Key
+RISK_SUBCLASS_1_DICT = {'SP': 'SP', 'UP': 'UP'}
+RISK_SUBCLASS_2_DICT = {'NT': 'NT', 'SPT': 'T', 'TOB': 'T', 'T': 'T'}
 
 
 class BaseParser():
     """
     Base parser class
+
+    Parsers describe their output table with a parser_engine.TableSpec: which sheets are read, the tags taken from
+    the sheet names, the reshape, the derived rows, the keys and the output columns. parse() runs the spec.
     """
 
+    # Cache of decoded worksheets, shared by all parsers unless set per instance
+    sheet_cache = None
+    # Opened input workbook shared with other parsers, None to open the input file on parse
+    workbook = None
+    # Declarative spec of the output table
+    SPEC = None
+    # Number of worker processes used to decode the sheets of a workbook
+    sheet_jobs = 1
+    # TableFilter of the requested rows, None for all rows
+    table_filter = None
+
     def __init__(self, input_file, product_name, first_row):
         """
         :param input_file: Source file directory
@@ -20,91 +59,49 @@ class BaseParser():
         self.first_row = first_row
         self.product_name = product_name
 
-    def _get_gender(self, string):
+    def set_input_file(self, input_file):
         """
-        Utility method to get gender based on input string
+        Setter method for input_file
         """
+        self.input_file = input_file
 
-        gender_list = {
-            'Male': 'M',
-            'Female': 'F',
-            'Unisex': 'U',
-            # For dividends Market Type 'Qualified'
-            'Qual': 'U'
-        }
-
-        for gender in gender_list:
-            if gender in string:
-                return gender_list[gender]
-
-        raise ValueError(
-            "get_gender: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def _get_risk_class(self, string):
+    def set_product_name(self, product_name):
         """
-        Utility method to get risk class based on input string
+        Setter method for product_name
         """
+        self.product_name = product_name
 
-        class_list = {
-            'UPNT': 'UPNT',
-            'SPNT': 'SPNT',
-            'NT': 'NT',
-            'SPT': 'ST',
-            'TOB': 'T',
-            'T': 'T'
-        }
-
-        string = string.upper()
-
-        for type in class_list:
-            if type in string:
-                return class_list[type]
-
-        raise ValueError(
-            "get_risk_class: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def _get_risk_subclass_1(self, string):
+    def set_first_row(self, first_row):
         """
-        Utility class to get risk subclass used for PA_Key
+        Setter method for first_row
         """
+        self.first_row = first_row
 
-        if 'SP' in string:
-            return 'SP'
-        elif 'UP' in string:
-            return 'UP'
-        else:
-            return ''
-
-    def _get_risk_subclass_2(self, string):
+    def set_sheet_cache(self, sheet_cache):
         """
-        Utility class to get risk subclass used for PA_Key
+        Setter method for sheet_cache
         """
+        self.sheet_cache = sheet_cache
 
-        if 'NT' in string:
-            return 'NT'
-        elif 'SPT' in string or 'TOB' in string or 'T' in string:
-            return 'T'
-        else:
-            raise ValueError(
-                "get_risk_subclass_2 : Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def set_input_file(self, input_file):
+    def set_workbook(self, workbook):
         """
-        Setter method for input_file
+        Setter method for workbook
         """
-        self.input_file = input_file
+        self.workbook = workbook
 
-    def set_product_name(self, product_name):
+    def set_table_filter(self, table_filter):
         """
-        Setter method for product_name
+        Setter method for table_filter
         """
-        self.product_name = product_name
+        self.table_filter = table_filter
 
-    def set_first_row(self, first_row):
+    def _open_workbook(self):
         """
-        Setter method for first_row
+        Open the input file with the streaming reader, or return the shared workbook if set
         """
-        self.first_row = first_row
+        if self.workbook is not None:
+            return self.workbook
+        return StreamingExcelFile(self.input_file, cache=self.sheet_cache)
 
     def set_output_column_names(self, output_column_names):
         """
@@ -112,145 +109,90 @@ class BaseParser():
         """
         self.output_column_names = output_column_names
 
+    def parse(self):
+        """
+        Parse method
+        :return: Data frame
+        """
+
+        if self.SPEC is None:
+            raise NotImplementedError(f'{type(self).__name__} has no table spec')
+        return self.SPEC.parse(self._open_workbook(), self.product_name, self.first_row, self.sheet_jobs,
+                               self.table_filter)
+
+    def parse_matrix(self):
+        """
+        Parse into a RateMatrix, for the parser types producing duration tables
+        :return: RateMatrix
+        """
+        return RateMatrix.from_frame(self.parse())
+
 
 class DividendParser(BaseParser):
     """
     Dividend parser class
     """
+
+    # Input file worksheet names: <type> <gender or market> <risk class> [band]
+    # e.g. DIV Male NT B2, PUA Qual SPNT, ALIR Unisex TOB
+
     # Default value for row number of worksheet data including headers
     FIRST_ROW_DEFAULT = 6
     # Default value for output column names
     COLUMN_NAMES_DEFAULT = ['Product', 'Base/PUA/RPU', 'Gender', 'Market', 'Underwriting Class', 'Band', 'Iss. Age',
                             'PA_KEY', 'CODE'] + ['Dur.' + str(i) for i in range(0, 122)]
-
-    def __init__(self, input_file, product_name, first_row=FIRST_ROW_DEFAULT):
+    DIVIDEND_TYPE_DICT = {'DIV': 'Base', 'PUA': 'PUA', 'RPU': 'RPU', 'LISR': 'LISR', 'ALIR': 'ALIR'}
+    # SPT and TOB are different from the other parsers
+    RISK_CLASS_NAME_DICT = {'UPNT': 'UPNT', 'SPNT': 'SPNT', 'NT': 'NT', 'SPT': 'ST', 'TOB': 'T'}
+
+    SPEC = TableSpec(
+        sections=[Section(tags={
+            'Base/PUA/RPU': Lookup(DIVIDEND_TYPE_DICT, token=0, upper=True, name='get_dividend_type'),
+            'Gender': Lookup(GENDER_DICT, token=1, name='get_gender'),
+            'Market': Lookup({'Qual': 'Q'}, token=1, default='NQ'),
+            # The market is only in the key of unisex rates
+            'Market_in_key': Lookup({'Male': '', 'Female': '', 'Qual': 'Q'}, token=1, default='NQ'),
+            'Underwriting Class': Lookup(RISK_CLASS_NAME_DICT, token=2, upper=True, name='get_risk_class'),
+            'risk_class_in_key_1': Lookup(RISK_SUBCLASS_1_DICT, token=2, default=''),
+            'risk_class_in_key_2': Lookup(RISK_SUBCLASS_2_DICT, token=2, name='get_risk_subclass_2'),
+            'Band': Token(3, n_tokens=4),
+        })],
+        derive=[
+            # Add rate for ALIR PUA and set the value equal to PUA
+            CopyRows({'Base/PUA/RPU': ['PUA']}, {'Base/PUA/RPU': 'ALIR PUA'}),
+            # Add rate for Qualified and set the value equal to None Qualified for ALIR, ALIR PUA, PUA, and LISR
+            CopyRows({'Base/PUA/RPU': ['ALIR', 'ALIR PUA', 'PUA', 'LISR'], 'Gender': ['U']}, {'Market': 'Q'}),
+            # Drop Qualified and Age < 17
+            DropRows({'Market': ['Q']}, below={'Age': 17}),
+            # Drop risk class (T, ST) and Age < 15
+            DropRows({'Underwriting Class': ['T', 'ST']}, below={'Age': 15}),
+        ],
+        keys=[
+            Key('PA_KEY', 'CP{}A,{},{},{},{},{},{},{}', ['Product', 'Base/PUA/RPU', 'Gender', 'Market_in_key',
+                                                          'risk_class_in_key_1', 'risk_class_in_key_2', 'Band', 'Age']),
+            Key('CODE', '{},{},{},{},{},{},{}', ['Product', 'Base/PUA/RPU', 'Gender', 'Market', 'Underwriting Class',
+                                                 'Band', 'Age']),
+        ],
+        constants=[SetColumn('Dur.0', 0)],
+        columns=['Product', 'Base/PUA/RPU', 'Gender', 'Market', 'Underwriting Class', 'Band', 'Age', 'PA_KEY', 'CODE',
+                 'Dur.0'] + [str(i) for i in range(1, 122)],
+        names=COLUMN_NAMES_DEFAULT,
+        # Rows keep their labels after the dropped ages
+        reset_index=False,
+    )
+
+    def __init__(self, input_file, product_name, first_row=FIRST_ROW_DEFAULT, sheet_jobs=1):
+        """
+        :param input_file: Source file directory
+        :param product_name: Product name (L10, L15, L20, L65, L85, L100)
+        :param first_row: First row with data including headers
+        :param sheet_jobs: Number of worker processes used to decode sheets, 1 to decode in the current process
+        """
 
         self.input_file = input_file
         self.first_row = first_row
         self.product_name = product_name
-
-    def _get_dividend_market(self, string):
-        """
-        Utility method to get dividend market
-        """
-
-        if 'Qual' in string:
-            return 'Q'
-        else:
-            return 'NQ'
-
-    def _get_dividend_type(self, string):
-        """
-        Utility method to get dividend type
-        """
-
-        type_list = {
-            'DIV': 'Base',
-            'PUA': 'PUA',
-            'RPU': 'RPU',
-            'LISR': 'LISR',
-            'ALIR': 'ALIR'
-        }
-
-        string = string.upper()
-
-        for type in type_list:
-            if type in string:
-                return type_list[type]
-
-        raise ValueError(
-            "get_dividend_type: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def _get_risk_class(self, string):
-        """
-        Utility method to get risk class
-        SPT and TOB are different from base parser
-        """
-
-        class_list = {
-            'UPNT': 'UPNT',
-            'SPNT': 'SPNT',
-            'NT': 'NT',
-            'SPT': 'ST',
-            'TOB': 'T'
-        }
-
-        string = string.upper()
-
-        for type in class_list:
-            if type in string:
-                return class_list[type]
-
-        raise ValueError(
-            "get_risk_class: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-
-    def parse(self):
-        """
-        Parse method
-        :return: Data frame
-        """
-
-        # Output data frame
-        output = pd.DataFrame([])
-        xl = pd.ExcelFile(self.input_file)
-        for sheet in xl.sheet_names:
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Parse info based on sheet name
-            info = sheet.split(' ')
-
-            # Set Base/PUA/RPU
-            df['Base/PUA/RPU'] = self._get_dividend_type(info[0])
-            df['Gender'] = self._get_gender(info[1])
-            df['Market'] = self._get_dividend_market(info[1])
-            df['Market_in_key'] = self._get_dividend_market(info[1]) if self._get_gender(info[1]) == 'U' else ''
-            df['Underwriting Class'] = self._get_risk_class(info[2])
-            df['risk_class_in_key_1'] = self._get_risk_subclass_1(info[2])
-            df['risk_class_in_key_2'] = self._get_risk_subclass_2(info[2])
-            df['Band'] = info[3] if len(info) == 4 else ''
-            output = pd.concat([output, df], sort=False)
-
-        output['Product'] = self.product_name
-
-        # Add rate for ALIR PUA and set the value equal to PUA
-        df_alirpua = output[output['Base/PUA/RPU'] == 'PUA'].copy()
-        df_alirpua['Base/PUA/RPU'] = 'ALIR PUA'
-        output = pd.concat([output, df_alirpua], sort=False)
-
-        # Add rate for Qualified and set the value equal to None Qualified for ALIR, ALIR PUA, PUA, and LISR
-        df_qualified = output[
-            output['Base/PUA/RPU'].isin(['ALIR', 'ALIR PUA', 'PUA', 'LISR']) & (output['Gender'] == 'U')].copy()
-        df_qualified['Market'] = 'Q'
-        output = pd.concat([output, df_qualified], sort=False)
-
-        # Reset index before dropping
-        output = output.reset_index(drop=True)
-
-        # Drop Qualified and Age < 17
-        output.drop(output[(output['Market'] == 'Q') & (output['Age'] < 17)].index, inplace=True)
-
-        # Drop risk class (T, ST) and Age < 15
-        output.drop(output[output['Underwriting Class'].isin(['T', 'ST']) & (output['Age'] < 15)].index, inplace=True)
-
-        # Build PA_KEY
-        output['PA_KEY'] = 'CP' + output['Product'] + 'A,' + output['Base/PUA/RPU'] + ',' + output['Gender'] + ',' + \
-                           output['Market_in_key'] + ',' + \
-                           output['risk_class_in_key_1'] + ',' + output['risk_class_in_key_2'] + ',' + output[
-                               'Band'] + ',' + output['Age'].astype(str)
-        # Build CODE
-        output['CODE'] = output['Product'] + ',' + output['Base/PUA/RPU'] + ',' + output['Gender'] + ',' + output[
-            'Market'] + ',' + \
-                         output['Underwriting Class'] + ',' + output['Band'] + ',' + output['Age'].astype(str)
-        output['Dur.0'] = 0
-        output.columns = output.columns.astype(str)
-        # Rearrange the column
-        output = output[
-            ['Product', 'Base/PUA/RPU', 'Gender', 'Market', 'Underwriting Class', 'Band', 'Age', 'PA_KEY', 'CODE',
-             'Dur.0'] + [str(i) for i in range(1, 122)]]
-        # Rename the column
-        output.columns = self.COLUMN_NAMES_DEFAULT
-
-        return output
+        self.sheet_jobs = sheet_jobs
 
 
 class CurrPremPerkParser(BaseParser):
@@ -275,118 +217,51 @@ class CurrPremPerkParser(BaseParser):
     RISK_CLASS_2_DICT = {'1': 'NT', '2': 'NT', '3': 'NT', '4': 'T', '5': 'T'}
     TABLE_RATINGS = ['A', 'B', 'C', 'D', 'E', 'F', 'H', 'J', 'L', 'P']
 
+    SPEC = TableSpec(
+        sections=[
+            # 1. General risk classes, worksheet name starting with Prem
+            Section(
+                prefix='Prem',
+                tags={
+                    'Gender': Lookup(GENDER_DICT, token=1, name='get_gender'),
+                    'Table Rating': '-',
+                    # LP10 and HECV have no band, their rates are replicated for bands 2, 3, 4 and 5
+                    'Band': Token(-1, contains='Band', prefix='B', default=('B2', 'B3', 'B4', 'B5')),
+                },
+                # Header <Age M1 M2 M3 M4 M5 M0>, the digit is the risk class
+                melt=Melt(slice(1, 6), header_tags={'Class': HeaderPart(RISK_CLASS_DICT),
+                                                    'risk_class_in_key_1': HeaderPart(RISK_CLASS_1_DICT),
+                                                    'risk_class_in_key_2': HeaderPart(RISK_CLASS_2_DICT)}),
+                keys=[
+                    Key('PA_Key', 'CP{}A,{},{},{},{},{}', ['Product', 'Gender', 'Band', 'risk_class_in_key_1',
+                                                           'risk_class_in_key_2', 'Age']),
+                    Key('Code', '{},{},{},{},{},{}', ['Product', 'Gender', 'Band', 'Class', 'Table Rating', 'Age']),
+                ]),
+            # 2. Sub risk classes, worksheet name starting with Sub_Classified
+            Section(
+                prefix='Sub',
+                first_row=FIRST_ROW_SUB_DEFAULT,
+                tags={
+                    'Gender': Lookup(GENDER_DICT, name='get_gender'),
+                    'Class': Lookup(RISK_CLASS_NAME_DICT, upper=True, name='get_risk_class'),
+                    'Band': '',
+                },
+                melt=Melt(TABLE_RATINGS, variable='Table Rating'),
+                keys=[
+                    Key('PA_Key', 'CP{}A,{},{},{},{}', ['Product', 'Gender', 'Class', 'Table Rating', 'Age']),
+                    Key('Code', '{},{},{},{},{},{}', ['Product', 'Gender', 'Band', 'Class', 'Table Rating', 'Age']),
+                ]),
+        ],
+        columns=['Product', 'Gender', 'Band', 'Class', 'Table Rating', 'Age', 'PA_Key', 'Code', 'value'],
+        names=COLUMN_NAMES_DEFAULT,
+    )
+
     def __init__(self, input_file, product_name, first_row):
 
         self.input_file = input_file
         self.product_name = product_name
         self.first_row = first_row
 
-    def parse(self):
-        """
-        Parse method
-        :return: Data frame
-        """
-
-        # Output data frame
-        output = pd.DataFrame([])
-        # Read excel file into pandas data object
-        xl = pd.ExcelFile(self.input_file)
-        # Find general risk classes sheets
-        prem_sheet_list = [s for s in xl.sheet_names if 'Prem' == s[:4]]
-        # Find sub risk classes sheets
-        prem_sub_classified_sheet_list = [s for s in xl.sheet_names if 'Sub' == s[:3]]
-
-        # 1. General risk classes, worksheet name starting with Prem #
-        for sheet in prem_sheet_list:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Get gender and risk class information from the header <Age M1	M2	M3	M4	M5	M0>
-            gender_and_risk_class = df.columns[1:6].tolist()
-            # Restructure and make <M1 M2 M3 M4 M5> as dataframe value
-            df = pd.melt(df, id_vars=['Age'], value_vars=gender_and_risk_class)
-            # Split M1 into gender and risk class
-            risk_class_info = df['variable'].str.split(pat=r'([A-Za-z]+)', expand=True).iloc[:, 1:3]
-            # Split worksheet name
-            info = sheet.split(' ')
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(info[1])
-            # Get band from worksheet name if Band exists
-            if 'Band' in sheet:
-                df['Band'] = 'B' + info[-1]
-            # For LP10 and HECV
-            else:
-                # replicate 4 times with band 2,3,4,5
-                df_1 = pd.DataFrame([])
-                for b in range(2, 6):
-                    df['Band'] = 'B' + str(b)
-                    df_1 = pd.concat([df_1,df.copy()])
-                df = df_1
-
-            df['Class'] = risk_class_info[2]
-            # UP or SP
-            df['risk_class_in_key_1'] = risk_class_info[2]
-            # NT or T
-            df['risk_class_in_key_2'] = risk_class_info[2]
-            # Default table rating as -
-            df['Table Rating'] = "-"
-            # Concatenate to the output data frame
-            output = pd.concat([output, df], sort=False)
-        # Set product name
-        output['Product'] = self.product_name
-        # Map risk class to UP/SP, NT/T
-        output = output.replace({'Class': self.RISK_CLASS_DICT, 'risk_class_in_key_1': self.RISK_CLASS_1_DICT,
-                                 'risk_class_in_key_2': self.RISK_CLASS_2_DICT})
-        # Generate PA_Key
-        output['PA_Key'] = 'CP' + output['Product'] + 'A,' + output['Gender'] + "," + output['Band'] + "," + output[
-            'risk_class_in_key_1'] + ',' + output['risk_class_in_key_2'] + ',' + output['Age'].astype(str)
-        # Generate Code
-        output['Code'] = output['Product'] + ',' + output['Gender'] + ',' + output['Band'] + ',' + output[
-            'Class'] + ',' + output['Table Rating'] + ',' + output['Age'].astype(str)
-        # Rename columns
-        output = output.rename(columns={'value': 'Premium_Rate', 'Age': 'Issue Age'})
-        # Drop extra columns
-        output = output.drop(columns=['risk_class_in_key_1', 'risk_class_in_key_2', 'variable'])
-        # Reset index
-        output = output.reset_index(drop=True)
-
-        # 2. Sub risk classes, worksheet name starting with Sub_Classified
-        output_sub = pd.DataFrame([])
-        for sheet in prem_sub_classified_sheet_list:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.FIRST_ROW_SUB_DEFAULT - 1, encoding='utf8')
-            # Restructure and make ['A', 'B', 'C', 'D', 'E', 'F', 'H', 'J', 'L', 'P'] as dataframe value
-            df = pd.melt(df, id_vars=['Age'], value_vars=self.TABLE_RATINGS)
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(sheet)
-            # Get risk class from worksheet name
-            df['Class'] = self._get_risk_class(sheet)
-            # Set default empty band
-            df['Band'] = ''
-            # Concatenate to the output data frame
-            output_sub = pd.concat([output_sub, df])
-        # Set product name
-        output_sub['Product'] = self.product_name
-        # Rename columns
-        output_sub = output_sub.rename(
-            columns={'variable': 'Table Rating', 'value': 'Premium_Rate', 'Age': 'Issue Age'})
-        # Generate PA_Key
-        output_sub['PA_Key'] = 'CP' + output_sub['Product'] + 'A,' + output_sub['Gender'] + ',' + output_sub[
-            'Class'] + ',' + output_sub['Table Rating'] + ',' + output_sub['Issue Age'].astype(str)
-        # Generate Code
-        output_sub['Code'] = output_sub['Product'] + ',' + output_sub['Gender'] + ',' + output_sub['Band'] + "," + \
-                             output_sub[
-                                 'Class'] + ',' + output_sub['Table Rating'] + ',' + output_sub['Issue Age'].astype(str)
-        # Reset index
-        output_sub = output_sub.reset_index(drop=True)
-
-        # Concatenate to output
-        output = pd.concat([output, output_sub], sort=False)
-        # Rearrange columns
-        output = output[self.COLUMN_NAMES_DEFAULT]
-        # Reset index
-        output = output.reset_index(drop=True)
-        return output
-
 
 class WaiverPerKParser(BaseParser):
     """
@@ -406,6 +281,28 @@ class WaiverPerKParser(BaseParser):
     RISK_CLASS_1_DICT = {'1': 'UP', '2': 'SP', '3': '', '4': 'SP', '5': ''}
     RISK_CLASS_2_DICT = {'1': 'NT', '2': 'NT', '3': 'NT', '4': 'T', '5': 'T'}
 
+    SPEC = TableSpec(
+        sections=[Section(
+            # Waiver worksheets, 'WP' as prefix of worksheet name
+            prefix='WP',
+            tags={
+                'Gender': Lookup(GENDER_DICT, token=1, name='get_gender'),
+                # LP10 and HECV have no band, their rates are replicated for bands 2, 3, 4 and 5
+                'Band': Token(-1, contains='Band', prefix='B', default=('B2', 'B3', 'B4', 'B5')),
+            },
+            # Header <Age M1 M2 M3 M4 M5 M0>, the digit is the risk class
+            melt=Melt(slice(1, 6), header_tags={'Class': HeaderPart(RISK_CLASS_DICT),
+                                                'risk_class_in_key_1': HeaderPart(RISK_CLASS_1_DICT),
+                                                'risk_class_in_key_2': HeaderPart(RISK_CLASS_2_DICT)}),
+            keys=[
+                Key('PA_Key', 'CP{}A,{},{},{},{},{}', ['Product', 'Gender', 'Band', 'risk_class_in_key_1',
+                                                       'risk_class_in_key_2', 'Age']),
+                Key('Code', '{},{},{},{},{}', ['Product', 'Gender', 'Band', 'Class', 'Age']),
+            ])],
+        columns=['Product', 'Gender', 'Band', 'Class', 'Age', 'PA_Key', 'Code', 'value'],
+        names=COLUMN_NAMES_DEFAULT,
+    )
+
     def __init__(self, input_file, product_name, first_row):
 
         self.input_file = input_file
@@ -413,71 +310,6 @@ class WaiverPerKParser(BaseParser):
         self.first_row = first_row
 
 
-    def parse(self):
-
-        # Output data frame
-        output = pd.DataFrame([])
-        # Read excel file into pandas data object
-        xl = pd.ExcelFile(self.input_file)
-        # Find waiver worksheets, 'WP' as prefix of worksheet name
-        waiver_sheet_list = [s for s in xl.sheet_names if 'WP' == s[:2]]
-        # Loop each waiver worksheet
-        for sheet in waiver_sheet_list:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Get gender and risk class information from the header <Age M1	M2	M3	M4	M5	M0>
-            gender_and_risk_class = df.columns[1:6].tolist()
-            # Restructure and make <M1 M2 M3 M4 M5> as dataframe value
-            df = pd.melt(df, id_vars=['Age'], value_vars=gender_and_risk_class)
-            # Split M1 into gender and risk class
-            risk_class_info = df['variable'].str.split(pat=r'([A-Za-z]+)', expand=True).iloc[:, 1:3]
-            # Split worksheet name
-            info = sheet.split(' ')
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(info[1])
-            # Get band from worksheet name if Band exists
-            if 'Band' in sheet:
-                df['Band'] = 'B' + info[-1]
-            # For LP10 and HECV
-            else:
-                # replicate 4 times with band 2,3,4,5
-                df_1 = pd.DataFrame([])
-                for b in range(2, 6):
-                    df['Band'] = 'B' + str(b)
-                    df_1 = pd.concat([df_1,df.copy()])
-                df = df_1
-
-            df['Class'] = risk_class_info[2]
-            # UP or SP
-            df['risk_class_in_key_1'] = risk_class_info[2]
-            # NT or T
-            df['risk_class_in_key_2'] = risk_class_info[2]
-            # Concatenate to the output data frame
-            output = pd.concat([output, df], sort=False)
-        # Set product name
-        output['Product'] = self.product_name
-        # Map risk class to UP/SP, NT/T
-        output = output.replace({'Class': self.RISK_CLASS_DICT, 'risk_class_in_key_1': self.RISK_CLASS_1_DICT,
-                                 'risk_class_in_key_2': self.RISK_CLASS_2_DICT})
-        # Generate PA_Key
-        output['PA_Key'] = 'CP' + output['Product'] + 'A,' + output['Gender'] + "," + output['Band'] + "," + output[
-            'risk_class_in_key_1'] + ',' + output['risk_class_in_key_2'] + ',' + output['Age'].astype(str)
-
-        # Generate Code
-        output['Code'] = output['Product'] + ',' + output['Gender'] + ',' + output['Band'] + ',' + output[
-            'Class'] + ',' + output['Age'].astype(str)
-        # Rename columns
-        output = output.rename(columns={'value': 'Premium_Rate', 'Age': 'Issue Age'})
-        # Drop extra columns
-        output = output.drop(columns=['risk_class_in_key_1', 'risk_class_in_key_2', 'variable'])
-        # Rearrange columns
-        output = output[self.COLUMN_NAMES_DEFAULT]
-        # Reset index
-        output = output.reset_index(drop=True)
-
-        return output
-
-
 class NSPParser(BaseParser):
     """
     NSP parser class
@@ -512,6 +344,20 @@ class BOYStateReserveParser(BaseParser):
     COLUMN_NAMES_DEFAULT = ['Product', 'Gender',  'Iss. Age', 'PA_Key', 'Code'] + [
                             'Dur.' + str(i) for i in range(-1, 122)]
 
+    SPEC = TableSpec(
+        # Every worksheet is a reserve worksheet
+        sections=[Section(
+            tags={'Gender': Lookup(GENDER_DICT, name='get_gender')},
+            keys=[
+                Key('PA_Key', 'CP{}A,{},{}', ['Product', 'Gender', 'Age']),
+                Key('Code', '{},{},{}', ['Product', 'Gender', 'Age']),
+            ])],
+        # Add two place holder columns
+        constants=[SetColumn('-1', 0), SetColumn('0', 0)],
+        columns=['Product', 'Gender', 'Age', 'PA_Key', 'Code'] + [str(i) for i in range(-1, 122)],
+        names=COLUMN_NAMES_DEFAULT,
+    )
+
     def __init__(self, input_file, product_name, first_row):
 
         self.input_file = input_file
@@ -519,43 +365,6 @@ class BOYStateReserveParser(BaseParser):
         self.first_row = first_row
 
 
-    def parse(self):
-
-        # Output data frame
-        output = pd.DataFrame([])
-        # Read excel file into pandas data object
-        xl = pd.ExcelFile(self.input_file)
-        # Loop each reserve worksheet
-        for sheet in xl.sheet_names:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(sheet)
-
-            # Concatenate to the output data frame
-            output = pd.concat([output, df], sort=False)
-        # Set product name
-        output['Product'] = self.product_name
-        # Add two place holder columns
-        output['-1'] = 0
-        output['0'] = 0
-        # Generate PA_Key
-        output['PA_Key'] = 'CP' + output['Product'] + 'A,' + output['Gender'] +  ',' + output['Age'].astype(str)
-
-        # Generate Code
-        output['Code'] = output['Product'] + ',' + output['Gender'] + ',' + output['Age'].astype(str)
-        # Convert column names into string for the further selection
-        output.columns = output.columns.astype(str)
-        # Rearrange columns
-        output = output[['Product', 'Gender', 'Age', 'PA_Key', 'Code'] + [str(i) for i in range(-1, 122)]]
-        # Rename column name
-        output.columns = self.COLUMN_NAMES_DEFAULT
-        # Reset index
-        output = output.reset_index(drop=True)
-
-        return output
-
-
 class CashValuePerKParser(BaseParser):
     """
     CashValuePerK parser class
@@ -571,6 +380,31 @@ class CashValuePerKParser(BaseParser):
 
     COLUMN_NAMES_DEFAULT = ['Product', 'Gender', 'Class', 'Iss. Age', 'PA_Key', 'Code'] + [
                             'Dur.' + str(i) for i in range(0, 122)]
+    # SPT and TOB are different from base parser
+    RISK_CLASS_NAME_DICT = {'UPNT': 'UPNT', 'SPNT': 'SPNT', 'NT': 'NT', 'SPT': 'SPT', 'TOB': 'TOB'}
+
+    SPEC = TableSpec(
+        sections=[Section(
+            # Cash value worksheets, worksheet name contains CV (BOY) or CV(BOY)
+            contains=['CV (BOY)', 'CV(BOY)'],
+            # Risk class for L85 only
+            tags={'Gender': Lookup(GENDER_DICT, name='get_gender'),
+                  'Class': Lookup(RISK_CLASS_NAME_DICT, upper=True, name='get_risk_class', products=['L85'])},
+            keys=[
+                Key('PA_Key', 'CP{}A,{},{},{}', ['Product', 'Gender', 'Class', 'Age']),
+                Key('Code', '{},{},{},{}', ['Product', 'Gender', 'Class', 'Age']),
+            ])],
+        # Add column 122 for L10 only, set 1000 for Age 0 duration 122
+        constants=[SetColumn('122', 0, products=['L10']), SetColumn('122', 1000.00, where={'Age': [0]},
+                                                                     products=['L10'])],
+        # Rest of product's header for rates are from 0 to 121
+        columns=['Product', 'Gender', 'Class', 'Age', 'PA_Key', 'Code'] + [str(i) for i in range(0, 122)],
+        # L10 has different header for rates from 1 to 122
+        product_columns={product: ['Product', 'Gender', 'Class', 'Age', 'PA_Key', 'Code'] +
+                         [str(i) for i in range(1, 123)] for product in ['L10', 'L12']},
+        names=COLUMN_NAMES_DEFAULT,
+    )
+
     def __init__(self, input_file, product_name, first_row):
 
         self.input_file = input_file
@@ -578,89 +412,32 @@ class CashValuePerKParser(BaseParser):
         self.first_row = first_row
 
 
-    def _get_risk_class(self, string):
-        """
-        Utility method to get risk class
-        SPT and TOB are different from base parser
-        """
-
-        class_list = {
-            'UPNT': 'UPNT',
-            'SPNT': 'SPNT',
-            'NT': 'NT',
-            'SPT': 'SPT',
-            'TOB': 'TOB'
-        }
-
-        string = string.upper()
-
-        for type in class_list:
-            if type in string:
-                return class_list[type]
-
-        raise ValueError(
-            "get_risk_class: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def parse(self):
-
-        # Output data frame
-        output = pd.DataFrame([])
-        # Read excel file into pandas data object
-        xl = pd.ExcelFile(self.input_file)
-        # Find cash value worksheets, worksheet name contains CV (BOY) or CV(BOY)
-        cash_value_sheet_list = [s for s in xl.sheet_names if 'CV (BOY)' in s or 'CV(BOY)' in s]
-        # Loop each cash value worksheet
-        for sheet in cash_value_sheet_list:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(sheet)
-            # Get risk class for L85 only
-            if self.product_name == 'L85':
-                df['Class'] = self._get_risk_class(sheet)
-            else:
-                df['Class'] = ''
-            # Concatenate to the output data frame
-            output = pd.concat([output, df], sort=False)
-        # Set product name
-        output['Product'] = self.product_name
-        # Add column 122 for L10 only
-        if self.product_name == 'L10':
-            output['122'] = 0
-            # Set 1000 for Age 0 duration 122
-            output.loc[(output.Age == 0), '122'] = 1000.00
-
-        # Generate PA_Key
-        output['PA_Key'] = 'CP' + output['Product'] + 'A,' + output['Gender'] + ',' + output['Class'] + ',' + output[
-            'Age'].astype(str)
-        # Generate Code
-        output['Code'] = output['Product'] + ',' + output['Gender'] + ',' + output[
-            'Class'] + ',' + output['Age'].astype(str)
-
-        # Convert column names into string for the further selection
-        output.columns = output.columns.astype(str)
-        # Rearrange columns
-        # L10 has different header for rates from 1 to 122
-        if self.product_name in ['L10', 'L12']:
-            output = output[['Product', 'Gender', 'Class', 'Age', 'PA_Key', 'Code'] + [str(i) for i in range(1, 123)]]
-        # Rest of product's header for rates are from 0 to 121
-        else:
-            output = output[['Product', 'Gender', 'Class', 'Age', 'PA_Key', 'Code'] + [str(i) for i in range(0, 122)]]
-        # Rename column name
-        output.columns = self.COLUMN_NAMES_DEFAULT
-        # Reset index
-        output = output.reset_index(drop=True)
-
-        return output
-
 class TAI_TRParser(BaseParser):
     """
-    CashValuePerK parser class
+    TAI_TR parser class
     """
 
     COLUMN_NAMES_DEFAULT = ['PA_Key', 'Product', 'Gender', 'Smk Stat', 'Age', 'Code'] + [
                             'Dur.' + str(i) for i in range(1, 122)]
-
+    RISK_CLASS_NAME_DICT = {'UPNT': 'UPNT', 'SPNT': 'SPNT', 'NT': 'NT', 'NS': 'NT', 'SPT': 'SPT', 'TOB': 'T', 'SM': 'T'}
+    # Risk class used for Code
+    CODE_CLASS_DICT = {'UPNT': 'N', 'SPNT': 'N', 'NT': 'N', 'NS': 'N', 'SPT': 'S', 'TOB': 'S', 'SM': 'S'}
+
+    SPEC = TableSpec(
+        # Every worksheet is a TAI_TR worksheet
+        sections=[Section(
+            tags={
+                'Gender': Lookup(GENDER_DICT, name='get_gender'),
+                'Smk Stat': Lookup(RISK_CLASS_NAME_DICT, upper=True, name='get_risk_class'),
+                'Code_Class': Lookup(CODE_CLASS_DICT, upper=True, name='get_risk_class'),
+            },
+            keys=[
+                Key('PA_Key', 'CP{}A,{},{},{}', ['Product', 'Gender', 'Smk Stat', 'Age']),
+                Key('Code', '{},{},{},{}', ['Product', 'Gender', 'Code_Class', 'Age']),
+            ])],
+        columns=['PA_Key', 'Product', 'Gender', 'Smk Stat', 'Age', 'Code'] + [str(i) for i in range(1, 122)],
+        names=COLUMN_NAMES_DEFAULT,
+    )
 
     def __init__(self, input_file, product_name, first_row):
 
@@ -668,85 +445,6 @@ class TAI_TRParser(BaseParser):
         self.product_name = product_name
         self.first_row = first_row
 
-    def _get_risk_class(self, string):
-        class_list = {
-            'UPNT': 'UPNT',
-            'SPNT': 'SPNT',
-            'NT': 'NT',
-            'NS': 'NT',
-            'SPT': 'SPT',
-            'TOB': 'T',
-            'SM': 'T'
-        }
-
-        string = string.upper()
-
-        for type in class_list:
-            if type in string:
-                return class_list[type]
-
-        raise ValueError(
-            "get_risk_class: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def _get_risk_class_1(self, string):
-        class_list = {
-            'UPNT': 'N',
-            'SPNT': 'N',
-            'NT': 'N',
-            'NS': 'N',
-            'SPT': 'S',
-            'TOB': 'S',
-            'SM': 'S'
-        }
-
-        string = string.upper()
-
-        for type in class_list:
-            if type in string:
-                return class_list[type]
-
-        raise ValueError(
-            "get_risk_class: Please check the sheet name of input file. Program Terminated with value: " + string)
-
-    def parse(self):
-
-        # Output data frame
-        output = pd.DataFrame([])
-        # Read excel file into pandas data object
-        xl = pd.ExcelFile(self.input_file)
-        # Loop each TAI_TR worksheet
-        for sheet in xl.sheet_names:
-            # Convert each worksheet into dataframe
-            df = xl.parse(sheet_name=sheet, skiprows=self.first_row - 1, encoding='utf8')
-            # Get gender from worksheet name
-            df['Gender'] = self._get_gender(sheet)
-            # Get risk class from worksheet name
-            df['Smk Stat'] = self._get_risk_class(sheet)
-            # Get risk class used for Code
-            df['Code_Class'] = self._get_risk_class_1(sheet)
-            # Concatenate to the output data frame
-            output = pd.concat([output, df], sort=False)
-        # Set product name
-        output['Product'] = self.product_name
-        # Generate PA_Key
-        output['PA_Key'] = 'CP' + output['Product'] + 'A,' + output['Gender'] + ',' + output['Smk Stat'] + ','+ output[
-            'Age'].astype(str)
-        # Generate Code
-        output["Code"] = output["Product"] + "," + output["Gender"] + "," + output["Code_Class"] + "," + output[
-        "Age"].astype(str)
-        output.columns = output.columns.astype(str)
-
-        # Convert column names into string for the further selection
-        output.columns = output.columns.astype(str)
-        # Rearrange columns
-        output = output[['PA_Key', 'Product', 'Gender', 'Smk Stat', 'Age', 'Code'] + [str(i) for i in range(1, 122)]]
-        # Rename column name
-        output.columns = self.COLUMN_NAMES_DEFAULT
-        # Reset index
-        output = output.reset_index(drop=True)
-
-        return output
-
 
 def parser_factory(parserType):
     """
@@ -768,18 +466,17 @@ def parser_factory(parserType):
     return parsers[parserType]
 
 
-def validation(srcFile, destnFile):
+def validation(srcFile, destnFile, atol=0.0, rtol=0.0):
     """
-    Compare two csv files
+    Compare two csv files, rows are aligned on their key columns, see rate_diff.diff_tables
     :param srcFile: source csv file path
     :param destnFile: destination csv file path
-    :return: Ture if all matches, False otherwise
+    :param atol: Absolute tolerance of numeric columns
+    :param rtol: Relative tolerance of numeric columns
+    :return: True if all matches, False otherwise
     """
 
-    df_src = pd.read_csv(srcFile).fillna(0)
-    df_destn = pd.read_csv(destnFile).fillna(0)
-    df_diff = df_src - df_destn
-    return (df_diff == 0).any().any()
+    return diff_tables(srcFile, destnFile, atol=atol, rtol=rtol).is_equal()
 
 
 def get_product(string):
@@ -806,65 +503,650 @@ def get_product(string):
     raise ValueError("get_product : Please check the name of input file. Program Terminated with value: " + string)
 
 
-def main():
-    """
-    Main application function
-    :return:
-    """
+# Parser types that can be run from the command line
+PARSER_TYPES = ['Dividend', 'CurrPremPerK', 'WaiverPerK', 'CashValuePerK', 'BOYStateReserve', 'TAI_TR']
 
-    # Load configuration file
-    config = configparser.ConfigParser()
-    config.read('config.txt')
-    # Get parser type through command line
-    if len(sys.argv) >= 2:
-        parser_type = sys.argv[1]
+# Fixed product order used to merge per-workbook results, independent of directory listing order
+PRODUCT_ORDER = ['L10', 'L12', 'L15', 'L20', 'L65', 'L85', 'L100']
 
-    # parser_type = 'Dividend'
-    # parser_type = 'CurrPremPerK'
-    # parser_type = 'WaiverPerK'
-    # parser_type = 'CashValuePerK'
-    # parser_type = 'BOYStateReserve'
-    parser_type = 'TAI_TR'
+# Fixed category sets of the dimension columns in compact mode, shared by all products and parser types
+DIMENSION_CATEGORIES = {
+    'Product': PRODUCT_ORDER,
+    'Gender': ['M', 'F', 'U'],
+    'Band': ['', 'B1', 'B2', 'B3', 'B4', 'B5'],
+    'Class': ['', 'UPNT', 'SPNT', 'NT', 'ST', 'SPT', 'T', 'TOB'],
+    'Underwriting Class': ['UPNT', 'SPNT', 'NT', 'ST', 'T'],
+    'Market': ['NQ', 'Q'],
+    'Base/PUA/RPU': ['Base', 'PUA', 'ALIR PUA', 'RPU', 'LISR', 'ALIR'],
+    'Smk Stat': ['UPNT', 'SPNT', 'NT', 'SPT', 'T'],
+    'Table Rating': ['-'] + CurrPremPerkParser.TABLE_RATINGS
+}
 
 
-    # Load input and output config
-    io_dic = config['IO']
+def get_input_dir(io_dic, parser_type):
+    """
+    Get input directory of a parser type from the IO configuration
+    :param io_dic: IO section of the configuration file
+    :param parser_type: Parser type string
+    :return: Input directory
+    """
+
     if parser_type == 'Dividend':
-        input_dir = io_dic['Dividend.input_dir']
+        return io_dic['Dividend.input_dir']
     elif parser_type == 'BOYStateReserve':
-        input_dir = io_dic['Reserve.input_dir']
+        return io_dic['Reserve.input_dir']
     elif parser_type == 'TAI_TR':
-        input_dir = io_dic['TAI_TR.input_dir']
+        return io_dic['TAI_TR.input_dir']
     else:
-        input_dir = io_dic['Rate.input_dir']
+        return io_dic['Rate.input_dir']
 
-    output_file = io_dic['Output_file']
-
-    parser_config = config[parser_type]
 
-    df_output = pd.DataFrame([])
-    input_file_list = listdir(input_dir)
+def get_workbook_tasks(parser_type, input_dir, parser_config, table_filter=None):
+    """
+    List the workbooks of an input directory in a fixed product order
+    :param parser_type: Parser type string
+    :param input_dir: Input directory
+    :param parser_config: Parser section of the configuration file
+    :param table_filter: TableFilter, workbooks of the products it leaves out are not listed
+    :return: List of (parser_type, input_file, product_name, first_row) tuples
+    """
 
-    for eachFile in input_file_list:
-        input_file = input_dir + '\\' + eachFile
+    tasks = []
+    for eachFile in listdir(input_dir):
+        input_file = os.path.join(input_dir, eachFile)
         product_name = get_product(eachFile)
+        if table_filter is not None and not table_filter.keep_product(product_name):
+            # Skipped on the file name, the workbook is never opened
+            continue
         first_row = parser_config[f"{product_name}.data_first_row"]
-        # Initialize a parser
-        parser = parser_factory(parser_type)(input_file, product_name, int(first_row))
-        df_output = pd.concat([df_output, parser.parse()], sort=False)
+        tasks.append((parser_type, input_file, product_name, int(first_row)))
+
+    # Sort by product order then file name so serial and parallel runs merge identically
+    tasks.sort(key=lambda task: (PRODUCT_ORDER.index(task[2]), os.path.basename(task[1])))
+    return tasks
+
+
+def parse_workbook(input_file, product_name, parsers, sheet_cache=None, parser_options=None, compact=None,
+                   table_filter=None):
+    """
+    Parse one workbook with one or several parser types, module level so that it can be sent to a worker process
+    :param input_file: Source file directory
+    :param product_name: Product name
+    :param parsers: List of (parser_type, first_row) tuples
+    :param sheet_cache: SheetCache of decoded worksheets, None to always decode
+    :param parser_options: {parser_type: extra keyword arguments of the parser class}
+    :param compact: Keyword arguments of compact_frame, None to keep the dtypes of the parsers
+    :param table_filter: TableFilter of the rows, None for all rows
+    :return: List of data frames in the order of parsers
+    """
+
+    parser_options = parser_options or {}
+    frames = []
+    # Open the workbook once and share it between the parsers
+    with span('workbook', file=os.path.basename(input_file)), StreamingExcelFile(input_file, cache=sheet_cache) as xl:
+        for parser_type, first_row in parsers:
+            # Initialize a parser
+            parser = parser_factory(parser_type)(input_file, product_name, first_row,
+                                                 **parser_options.get(parser_type, {}))
+            parser.set_workbook(xl)
+            parser.set_table_filter(table_filter)
+            with span('parse', parser=parser_type):
+                df = parser.parse()
+            if compact is not None:
+                # Compact in the worker, so smaller frames are sent back
+                with span('compact', parser=parser_type):
+                    df = compact_frame(df, DIMENSION_CATEGORIES, **compact)
+            frames.append(df)
+    return frames
+
+
+def parse_workbook_recorded(input_file, product_name, parsers, recorder_options=None, **kwargs):
+    """
+    parse_workbook in a worker process, recording its timing spans
+    :param recorder_options: Keyword arguments of the RunRecorder of the worker
+    :return: (list of data frames in the order of parsers, list of span records)
+    """
+
+    return run_recorded(recorder_options, parse_workbook, input_file, product_name, parsers, **kwargs)
+
+
+def iter_parse_workbooks(tasks, jobs=1, sheet_cache=None, parser_options=None, compact=None, table_filter=None):
+    """
+    Parse workbooks serially or over a process pool, tasks on the same workbook are parsed together
+    :param tasks: List of (parser_type, input_file, product_name, first_row) tuples
+    :param jobs: Number of worker processes, 1 to parse in the current process
+    :param sheet_cache: SheetCache of decoded worksheets, None to always decode
+    :param parser_options: {parser_type: extra keyword arguments of the parser class}
+    :param compact: Keyword arguments of compact_frame, None to keep the dtypes of the parsers
+    :param table_filter: TableFilter of the rows, None for all rows
+    :return: Generator of (task, data frame), grouped by workbook in the order workbooks first appear in tasks
+    """
+
+    # Group tasks by workbook
+    groups = {}
+    for task in tasks:
+        groups.setdefault((task[1], task[2]), []).append(task)
+
+    worker = partial(parse_workbook, sheet_cache=sheet_cache, parser_options=parser_options, compact=compact,
+                     table_filter=table_filter)
+    if jobs <= 1 or len(groups) <= 1:
+        for (input_file, product_name), group in groups.items():
+            yield from zip(group, worker(input_file, product_name, [(task[0], task[3]) for task in group]))
+        return
+
+    recorder = get_recorder()
+    if recorder is not None:
+        # Workers send their timing spans back with the frames
+        worker = partial(parse_workbook_recorded, recorder_options=recorder.options, sheet_cache=sheet_cache,
+                         parser_options=parser_options, compact=compact, table_filter=table_filter)
+
+    def get_frames(future):
+        if recorder is None:
+            return future.result()
+        frames, spans = future.result()
+        recorder.merge(spans)
+        return frames
+
+    # The first error, e.g. MemoryBudgetError of a worker, cancels the workbooks not started yet
+    with process_pool(min(jobs, len(groups))) as executor:
+        # Keep at most one pending workbook per worker, so parsed frames do not pile up ahead of the consumer
+        pending = deque()
+        for (input_file, product_name), group in groups.items():
+            pending.append((group, executor.submit(worker, input_file, product_name,
+                                                   [(task[0], task[3]) for task in group])))
+            if len(pending) >= jobs:
+                group, future = pending.popleft()
+                yield from zip(group, get_frames(future))
+        while pending:
+            group, future = pending.popleft()
+            yield from zip(group, get_frames(future))
+
+
+def parse_workbooks(tasks, jobs=1, sheet_cache=None, parser_options=None, compact=None, table_filter=None):
+    """
+    Parse workbooks serially or over a process pool, tasks on the same workbook are parsed together
+    :param tasks: List of (parser_type, input_file, product_name, first_row) tuples
+    :param jobs: Number of worker processes, 1 to parse in the current process
+    :param sheet_cache: SheetCache of decoded worksheets, None to always decode
+    :param parser_options: {parser_type: extra keyword arguments of the parser class}
+    :param compact: Keyword arguments of compact_frame, None to keep the dtypes of the parsers
+    :param table_filter: TableFilter of the rows, None for all rows
+    :return: Data frames in the order of tasks
+    """
+
+    frames = dict(iter_parse_workbooks(tasks, jobs, sheet_cache, parser_options, compact, table_filter))
+    return [frames[task] for task in tasks]
+
+
+def get_product_fingerprints(tasks):
+    """
+    Fingerprint the workbooks of each product, a product is reparsed when its fingerprint changes
+    :param tasks: List of (parser_type, input_file, product_name, first_row) tuples
+    :return: {product_name: {'first_row': first_row, 'files': {file_name: content_hash}}}
+    """
+
+    fingerprints = {}
+    for _, input_file, product_name, first_row in tasks:
+        fingerprint = fingerprints.setdefault(product_name, {'first_row': first_row, 'files': {}})
+        fingerprint['files'][os.path.basename(input_file)] = file_hash(input_file)
+    return fingerprints
+
+
+def load_run_state(state_file):
+    """
+    Load the product fingerprints recorded by previous runs
+    :param state_file: State file path
+    :return: {output_sheet_name: {'parser_type': parser_type, 'fingerprints': {...}}}
+    """
+
+    try:
+        with open(state_file, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_run_state(state_file, state):
+    """
+    Save the product fingerprints of a run
+    :param state_file: State file path
+    :param state: State dictionary
+    """
+
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def save_content_fingerprints(content_file, content, rows=False):
+    """
+    Record the content fingerprints of the output sheets of a run, fingerprints of the other sheets are kept
+    :param content_file: Content fingerprint file path
+    :param content: {sheet_name: ContentFingerprint}
+    :param rows: Record the hash of every row besides the table and block digests
+    """
+
+    fingerprints = load_run_state(content_file)
+    fingerprints.update({sheet_name: fingerprint.to_dict(rows=rows) for sheet_name, fingerprint in content.items()})
+    save_run_state(content_file, fingerprints)
+
+
+def has_output_sheet(output_file, sheet_name):
+    """
+    Check whether an output sheet exists
+    :param output_file: Output file path
+    :param sheet_name: Output sheet name
+    :return: True if the sheet exists, False otherwise
+    """
+
+    if not os.path.exists(output_file):
+        return False
+    with StreamingExcelFile(output_file) as xl:
+        return sheet_name in xl.sheet_names
+
+
+def read_output_sheet(output_file, sheet_name):
+    """
+    Read back an output sheet written by main
+    :param output_file: Output file path
+    :param sheet_name: Output sheet name
+    :return: Data frame, None if the file or the sheet does not exist
+    """
+
+    return read_output_sheets(output_file, [sheet_name]).get(sheet_name)
+
+
+def read_output_sheets(output_file, sheet_names):
+    """
+    Read back several output sheets written by main, opening the file once
+    :param output_file: Output file path
+    :param sheet_names: Output sheet names
+    :return: {sheet name: data frame} of the sheets that exist
+    """
+
+    if not os.path.exists(output_file):
+        return {}
+    frames = {}
+    with StreamingExcelFile(output_file) as xl:
+        for sheet_name in sheet_names:
+            if sheet_name not in xl.sheet_names:
+                continue
+            df = xl.parse(sheet_name=sheet_name)
+            # Column A is left empty by startcol=1
+            df = df.iloc[:, 1:]
+            # NaN values were filled with 0 before writing, so empty cells can only be empty strings
+            frames[sheet_name] = df.fillna('')
+    return frames
+
+
+def splice_products(df_existing, product_frames):
+    """
+    Replace product blocks of an existing output, keeping the fixed product order
+    :param df_existing: Existing output data frame
+    :param product_frames: {product_name: new data frame, None to remove the product}
+    :return: Data frame, None if the new data frames do not have the layout of the existing output
+    """
+
+    if any(list(df.columns) != list(df_existing.columns) for df in product_frames.values() if df is not None):
+        return None
+
+    products = set(df_existing['Product']) | set(product_frames)
+    frames = []
+    for product in sorted(products, key=PRODUCT_ORDER.index):
+        if product not in product_frames:
+            frames.append(df_existing[df_existing['Product'] == product])
+        elif product_frames[product] is not None:
+            frames.append(product_frames[product])
+    return pd.concat(frames, sort=False).reset_index(drop=True)
+
+
+def plan_incremental(run_state, parser_type, tasks, fingerprints, output_file, sheet_name, table_filter=None):
+    """
+    Find the workbooks an incremental run has to parse
+    :param run_state: State recorded by the previous run for the output sheet
+    :param parser_type: Parser type string
+    :param tasks: List of (parser_type, input_file, product_name, first_row) tuples
+    :param fingerprints: Current product fingerprints
+    :param output_file: Output file path
+    :param sheet_name: Output sheet name
+    :param table_filter: TableFilter of the run, the output is rebuilt when it differs from the previous run
+    :return: (tasks to parse, existing output or None for a full rebuild, removed products),
+             None if the output sheet is up to date
+    """
+
+    if run_state.get('parser_type') != parser_type or run_state.get('filter') != get_filter_state(table_filter):
+        return tasks, None, []
+
+    previous_fingerprints = run_state['fingerprints']
+    changed_tasks = [task for task in tasks if previous_fingerprints.get(task[2]) != fingerprints[task[2]]]
+    removed = [product for product in previous_fingerprints if product not in fingerprints]
+    if not changed_tasks and not removed and has_output_sheet(output_file, sheet_name):
+        return None
+
+    df_existing = read_output_sheet(output_file, sheet_name)
+    if df_existing is None:
+        return tasks, None, []
+    return changed_tasks, df_existing, removed
+
+
+def get_filter_state(table_filter):
+    """
+    Filter recorded in the run state, a sheet written with other rows is rebuilt by incremental runs
+    :param table_filter: TableFilter, None for all rows
+    :return: {dimension: values}, None for all rows
+    """
+    return table_filter.to_dict() if table_filter else None
+
+
+def prepare_output(df_output):
+    """
+    Final clean up of the output data frame
+    :param df_output: Data frame
+    :return: Data frame
+    """
 
     # Fill NaN value with 0
     df_output = df_output.fillna(0)
     # Reset Index
     df_output = df_output.reset_index(drop=True)
+    return df_output
+
+
+def write_streaming(plans, output_file, jobs=1, sheet_cache=None, parser_options=None, compact=None,
+                    table_filter=None):
+    """
+    Parse and write output sheets product by product, no output sheet is held in memory
+    :param plans: List of (parser_type, sheet_name, tasks, fingerprints, parse_tasks, ...) tuples
+    :param output_file: Output file path
+    :param jobs: Number of worker processes, 1 to parse in the current process
+    :param sheet_cache: SheetCache of decoded worksheets, None to always decode
+    :param parser_options: {parser_type: extra keyword arguments of the parser class}
+    :param compact: Keyword arguments of compact_frame, None to keep the dtypes of the parsers
+    :param table_filter: TableFilter of the rows, None for all rows
+    :return: {sheet_name: ContentFingerprint} of the written sheets
+    """
 
-    # Write data frame into excel file with proper sheet name
-    with pd.ExcelWriter(output_file, mode='a', engine='openpyxl') as writer:
-        df_output.to_excel(writer, sheet_name=parser_config['Output_sheet_name'], index=False, startcol=1)
+    writer = StreamingExcelWriter(output_file)
+    sheet_names = {}
+    content = {}
+    for parser_type, sheet_name, *_ in plans:
+        writer.add_sheet(sheet_name)
+        sheet_names[parser_type] = sheet_name
+        content[sheet_name] = ContentFingerprint()
+
+    # Workbooks are parsed in product order, so each sheet receives its products in order
+    parse_tasks = [task for plan in plans for task in plan[4]]
+    for task, df in iter_parse_workbooks(parse_tasks, jobs, sheet_cache, parser_options, compact, table_filter):
+        context = {'file': os.path.basename(task[1]), 'parser': task[0]}
+        with span('prepare', **context):
+            df_output = prepare_output(df)
+        with span('write_xlsx', **context):
+            writer.append(sheet_names[task[0]], df_output)
+        with span('fingerprint', **context):
+            content[sheet_names[task[0]]].update(df_output)
+    with span('write_xlsx'):
+        writer.close()
+    return content
+
+
+def parse_duration_range(text):
+    """
+    Parse a FIRST:LAST duration range of the command line, either bound can be left out
+    :param text: Range text, e.g. 1:50 or :30
+    :return: (first, last), None for an open bound
+    """
 
-    # writer = pd.ExcelWriter(output_file, mode='a', engine='openpyxl')
-    # df_output.to_excel(writer, sheet_name=parser_config['Output_sheet_name'], index=False, startcol=1)
-    # writer.save()
+    first, sep, last = text.partition(':')
+    try:
+        if not sep:
+            raise ValueError(text)
+        durations = (int(first) if first else None, int(last) if last else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration range: '{text}' (expected FIRST:LAST, e.g. 1:50)")
+    if None not in durations and durations[0] > durations[1]:
+        raise argparse.ArgumentTypeError(f"invalid duration range: '{text}' (FIRST is after LAST)")
+    return durations
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+    :param argv: Argument list, sys.argv[1:] if None
+    :return: Parsed arguments
+    """
+
+    arg_parser = argparse.ArgumentParser(description='Convert rate files into the output workbook')
+    arg_parser.add_argument('parser_type', nargs='*',
+                            help='Parser types, also the section names in config.txt (default: TAI_TR). Several '
+                                 'parser types are run in one pass, sharing each opened workbook: '
+                                 + ', '.join(PARSER_TYPES))
+    arg_parser.add_argument('--jobs', type=int, default=1,
+                            help='Number of worker processes used to parse workbooks (default: 1)')
+    arg_parser.add_argument('--sheet-jobs', type=int, default=1,
+                            help='Number of worker processes used to decode the sheets of one Dividend workbook '
+                                 '(default: 1)')
+    arg_parser.add_argument('--cache-dir',
+                            help='Directory of the decoded sheet cache, sheets of unchanged workbooks are not decoded '
+                                 'again')
+    arg_parser.add_argument('--cache-max-mb', type=int, default=SheetCache.MAX_BYTES_DEFAULT >> 20,
+                            help='Size limit of the decoded sheet cache in MB (default: %(default)s)')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='Only reparse products whose workbooks changed since the last run and replace their '
+                                 'rows in the existing output sheet')
+    arg_parser.add_argument('--sink', action='append', choices=['xlsx', 'parquet', 'arrow', 'csv', 'store'],
+                            help='Output sink, can be repeated (default: xlsx). xlsx appends sheets to Output_file, '
+                                 'the other sinks write one file per output sheet into --sink-dir, store writes a '
+                                 'memory mapped rate store directory')
+    arg_parser.add_argument('--stream-xlsx', action='store_true',
+                            help='Write the xlsx output in constant memory, each product is written as soon as it is '
+                                 'parsed. Output_file is created if missing, otherwise the sheets are appended to it')
+    arg_parser.add_argument('--sink-dir',
+                            help='Output directory of the parquet, arrow, csv and store sinks (default: directory of '
+                                 'Output_file)')
+    arg_parser.add_argument('--compact', action='store_true',
+                            help='Keep parsed tables in compact dtypes: dimension columns as categoricals with a fixed '
+                                 'category set, integer columns downcast')
+    arg_parser.add_argument('--float32', action='store_true',
+                            help='Store rate columns as float32, implies --compact. Fails when a rate cannot be stored '
+                                 'within --float32-rtol')
+    arg_parser.add_argument('--float32-rtol', type=float, default=FLOAT32_RTOL_DEFAULT,
+                            help='Largest relative error allowed for rates stored as float32 (default: %(default)s)')
+    arg_parser.add_argument('--product', action='append', choices=PRODUCT_ORDER,
+                            help='Only parse the workbooks of this product, can be repeated (default: all). Other '
+                                 'workbooks are never opened')
+    arg_parser.add_argument('--gender', action='append', choices=DIMENSION_CATEGORIES['Gender'],
+                            help='Only keep the rows of this gender, can be repeated (default: all). Sheets of other '
+                                 'genders are never decoded, the same for --class, --band and --dividend-type')
+    arg_parser.add_argument('--class', action='append', dest='risk_class',
+                            choices=DIMENSION_CATEGORIES['Class'][1:],
+                            help='Only keep the rows of this risk class (Class, Underwriting Class or Smk Stat), can '
+                                 'be repeated (default: all)')
+    arg_parser.add_argument('--band', action='append', choices=DIMENSION_CATEGORIES['Band'][1:],
+                            help='Only keep the rows of this band, can be repeated (default: all)')
+    arg_parser.add_argument('--dividend-type', action='append', choices=DIMENSION_CATEGORIES['Base/PUA/RPU'],
+                            help='Only keep the Dividend rows of this type, can be repeated (default: all)')
+    arg_parser.add_argument('--durations', type=parse_duration_range, metavar='FIRST:LAST',
+                            help='Only keep the duration columns Dur.FIRST to Dur.LAST of the Dividend, '
+                                 'CashValuePerK, BOYStateReserve and TAI_TR tables, either bound can be left out, '
+                                 'e.g. 1:50, :30 or -1:30 for the Dur.-1 column of BOYStateReserve (also accepted '
+                                 'as --durations=-1:30). Rates of the other durations are not read')
+    arg_parser.add_argument('--fingerprint', action='store_true',
+                            help='Record the hash of every output row in the content fingerprints next to Output_file '
+                                 '(.content.json), so a comparison of two runs points at the changed rows and not '
+                                 'only at the changed blocks')
+    arg_parser.add_argument('--timing', action='store_true',
+                            help='Time each stage of the run and write a JSON report per file and per sheet next to '
+                                 'Output_file (.timing.json)')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='Run under cProfile and write the statistics next to Output_file (.prof), worker '
+                                 'processes are not profiled')
+    arg_parser.add_argument('--memory', action='store_true',
+                            help='Record the RSS and the allocation high-water mark of each stage, workbook and sheet '
+                                 'in the timing report, implies --timing. Tracing allocations slows the run down')
+    arg_parser.add_argument('--memory-budget-mb', type=int,
+                            help='Stop the run with an error as soon as a process uses more memory than this, checked '
+                                 'at every stage and while sheets are decoded, implies --timing. Each --jobs and '
+                                 '--sheet-jobs worker has its own budget, the first worker over it stops the run')
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # argparse takes a range starting with a negative duration, e.g. -1:30, for an option, pass it as --durations=-1:30
+    for i in range(len(argv) - 1, 0, -1):
+        if argv[i - 1] == '--durations' and re.match(r'-\d', argv[i]):
+            argv[i - 1:i + 1] = ['--durations=' + argv[i]]
+    args = arg_parser.parse_args(argv)
+    args.parser_type = args.parser_type or ['TAI_TR']
+    args.sink = args.sink or ['xlsx']
+    if args.incremental and 'xlsx' not in args.sink:
+        arg_parser.error('--incremental updates the existing xlsx output and needs the xlsx sink')
+    if args.stream_xlsx and (args.sink != ['xlsx'] or args.incremental):
+        arg_parser.error('--stream-xlsx only writes the xlsx output, it cannot be combined with other sinks or '
+                         '--incremental')
+    for parser_type in args.parser_type:
+        if parser_type not in PARSER_TYPES:
+            arg_parser.error(f"invalid parser type: {parser_type} (choose from {', '.join(PARSER_TYPES)})")
+    return args
+
+
+def main(argv=None):
+    """
+    Main application function
+    :param argv: Argument list, sys.argv[1:] if None
+    :return:
+    """
+
+    args = parse_args(argv)
+
+    # Load configuration file
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+    output_file = config['IO']['Output_file']
+
+    recorder = None
+    if args.timing or args.memory or args.memory_budget_mb is not None:
+        memory_budget = args.memory_budget_mb << 20 if args.memory_budget_mb is not None else None
+        recorder = RunRecorder(memory=args.memory, memory_budget=memory_budget)
+    set_recorder(recorder)
+    error = None
+    try:
+        with profile(output_file + '.prof' if args.profile else None):
+            run(args, config)
+    except MemoryBudgetError as e:
+        error = str(e)
+    finally:
+        set_recorder(None)
+        if recorder is not None:
+            recorder.write(output_file + '.timing.json', argv=sys.argv[1:] if argv is None else list(argv),
+                           parser_types=args.parser_type, error=error)
+    if error is not None:
+        sys.exit(error)
+
+
+def run(args, config):
+    """
+    Parse the workbooks and write the output sheets
+    :param args: Parsed arguments
+    :param config: Configuration file
+    """
+
+    # Load input and output config
+    io_dic = config['IO']
+    output_file = io_dic['Output_file']
+    # Product fingerprints of previous runs are kept next to the output file
+    state_file = output_file + '.state.json'
+    state = load_run_state(state_file)
+    # Content fingerprints of the output sheets are kept next to the output file too
+    content_file = output_file + '.content.json'
+
+    # Sheet level parallelism is only available for dividend workbooks
+    parser_options = {'Dividend': {'sheet_jobs': args.sheet_jobs}}
+    sheet_cache = SheetCache(args.cache_dir, args.cache_max_mb << 20) if args.cache_dir else None
+    compact = {'float32': args.float32, 'rtol': args.float32_rtol} if args.compact or args.float32 else None
+    table_filter = TableFilter(products=args.product, genders=args.gender, classes=args.risk_class, bands=args.band,
+                               dividend_types=args.dividend_type, durations=args.durations) or None
+
+    # 1. Plan the workbooks to parse for each parser type
+    plans = []
+    for parser_type in args.parser_type:
+        with span('plan', parser=parser_type):
+            parser_config = config[parser_type]
+            sheet_name = parser_config['Output_sheet_name']
+            tasks = get_workbook_tasks(parser_type, get_input_dir(io_dic, parser_type), parser_config, table_filter)
+            fingerprints = get_product_fingerprints(tasks)
+
+            plan = (tasks, None, [])
+            if args.incremental:
+                plan = plan_incremental(state.get(sheet_name, {}), parser_type, tasks, fingerprints, output_file,
+                                        sheet_name, table_filter)
+        if plan is None:
+            # Nothing to do, the output sheet is up to date
+            continue
+        plans.append((parser_type, sheet_name, tasks, fingerprints) + plan)
+
+    if args.stream_xlsx:
+        content = write_streaming(plans, output_file, args.jobs, sheet_cache, parser_options, compact, table_filter)
+        for parser_type, sheet_name, _, fingerprints, *_ in plans:
+            state[sheet_name] = {'parser_type': parser_type, 'fingerprints': fingerprints,
+                                 'filter': get_filter_state(table_filter)}
+        save_run_state(state_file, state)
+        save_content_fingerprints(content_file, content, rows=args.fingerprint)
+        return
+
+    # 2. Parse the workbooks of all parser types, each workbook is opened once
+    parse_tasks = [task for plan in plans for task in plan[4]]
+    frames = dict(zip(parse_tasks, parse_workbooks(parse_tasks, args.jobs, sheet_cache, parser_options, compact,
+                                                   table_filter)))
+
+    # 3. Build the output sheets
+    outputs = {}
+    metadata = {}
+    content = {}
+    for parser_type, sheet_name, tasks, fingerprints, _, df_existing, removed in plans:
+        df_output = None
+        if df_existing is not None:
+            product_frames = {product: None for product in removed}
+            for product in PRODUCT_ORDER:
+                product_tasks = [task for task in tasks if task[2] == product and task in frames]
+                if product_tasks:
+                    product_frames[product] = prepare_output(
+                        pd.concat([frames[task] for task in product_tasks], sort=False))
+            with span('splice', parser=parser_type):
+                df_output = splice_products(df_existing, product_frames)
+
+        if df_output is None:
+            # Full rebuild, also when the parser no longer produces the layout of the existing sheet
+            missing = [task for task in tasks if task not in frames]
+            frames.update(zip(missing, parse_workbooks(missing, args.jobs, sheet_cache, parser_options, compact,
+                                                       table_filter)))
+            with span('prepare', parser=parser_type):
+                df_output = prepare_output(pd.concat([frames[task] for task in tasks], sort=False))
+        outputs[sheet_name] = df_output
+        metadata[sheet_name] = get_metadata(parser_type, sheet_name, df_output)
+        with span('fingerprint', parser=parser_type):
+            content[sheet_name] = fingerprint_table(df_output)
+        # Sinks record the table and product digests, the row hashes are only kept in the content file
+        metadata[sheet_name]['content'] = content[sheet_name].to_dict(rows=False)
+
+    if not outputs:
+        return
+
+    # 4. Write all output sheets in one pass per sink
+    sink_dir = args.sink_dir or os.path.dirname(os.path.abspath(output_file))
+    for sink_type in args.sink:
+        if sink_type == 'xlsx':
+            sink = ExcelSink(output_file, replace=args.incremental)
+        else:
+            sink = sink_factory(sink_type)(sink_dir)
+        with span('write_' + sink_type):
+            sink.write(outputs, metadata)
+
+    # The recorded state describes the xlsx output, which incremental runs update
+    if 'xlsx' in args.sink:
+        for parser_type, sheet_name, _, fingerprints, *_ in plans:
+            state[sheet_name] = {'parser_type': parser_type, 'fingerprints': fingerprints,
+                                 'filter': get_filter_state(table_filter)}
+        save_run_state(state_file, state)
+    save_content_fingerprints(content_file, content, rows=args.fingerprint)
 
 
 if __name__ == '__main__':
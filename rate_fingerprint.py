@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import sys
+import numpy as np
+import pandas as pd
+
+# Version of the canonical form and of the hash functions, fingerprints of different versions are never compared
+FINGERPRINT_VERSION = 1
+# Column holding the block of a row
+BLOCK_COLUMN = 'Product'
+
+
+class ContentFingerprint():
+    """
+    Content hashes of an output table
+
+    Every row gets a 64 bit hash of its canonical values, labels and rates of the duration curve, computed column wise
+    with pd.util.hash_array. The rows of each product block are then hashed in order into a block digest and all rows
+    into the table digest, together with the column names. Two runs holding the same table have the same digests
+    whatever the dtypes the values were held in: numbers are hashed as float64 without sign of zero, float32 rates as
+    their shortest decimal form, categoricals as their values.
+
+    Frames can be added with update() as they are produced, so a table written product by product gets the same
+    fingerprint as the whole table.
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.n_rows = 0
+        self.rows = []
+        self.blocks = {}
+        self.block_rows = {}
+        self.block_starts = {}
+        self._table = hashlib.blake2b(digest_size=16)
+        self._blocks = {}
+
+    def update(self, df, block_column=BLOCK_COLUMN):
+        """
+        Add the next rows of the table
+        :param df: Data frame with the columns of the previous frames
+        :param block_column: Column holding the block of the rows, no blocks if None or missing
+        :return: The fingerprint
+        """
+
+        columns = [str(name) for name in df.columns]
+        if self.columns is None:
+            self.columns = columns
+            self._table.update(json.dumps(columns).encode('utf8'))
+        elif columns != self.columns:
+            raise ValueError('ContentFingerprint: Data frame columns do not match the previous frames')
+
+        row_hashes = hash_rows(df)
+        self.rows.append(row_hashes)
+        self.n_rows += len(row_hashes)
+        self._table.update(row_hashes.tobytes())
+
+        if block_column is not None and block_column in df.columns:
+            blocks = df[block_column].astype(str).to_numpy()
+            # Blocks are contiguous runs of rows, hash each run in one call
+            starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]]) if len(blocks) else np.zeros(0, dtype=int)
+            for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(blocks)]):
+                block = blocks[start]
+                self.block_starts.setdefault(block, self.n_rows - len(row_hashes) + start)
+                self._blocks.setdefault(block, hashlib.blake2b(digest_size=16)).update(row_hashes[start:end].tobytes())
+                self.block_rows[block] = self.block_rows.get(block, 0) + end - start
+        self.blocks = {block: digest.hexdigest() for block, digest in self._blocks.items()}
+        return self
+
+    @property
+    def table(self):
+        """
+        Digest of the table
+        """
+        return self._table.hexdigest()
+
+    def get_row_hashes(self):
+        """
+        :return: uint64 array of the row hashes in table order
+        """
+        return np.concatenate(self.rows) if self.rows else np.zeros(0, dtype=np.uint64)
+
+    def to_dict(self, rows=True):
+        """
+        JSON form of the fingerprint
+        :param rows: Include the row hashes, as 16 digit hexadecimal strings
+        :return: Dictionary
+        """
+
+        fingerprint = {
+            'version': FINGERPRINT_VERSION,
+            'table': self.table,
+            'rows': self.n_rows,
+            'columns': self.columns,
+            'blocks': {block: {'hash': digest, 'rows': self.block_rows[block], 'start': self.block_starts[block]}
+                       for block, digest in self.blocks.items()},
+        }
+        if rows:
+            fingerprint['row_hashes'] = [f'{value:016x}' for value in self.get_row_hashes().tolist()]
+        return fingerprint
+
+
+def canonical_frame(df):
+    """
+    Canonical form of a table used for hashing
+    :param df: Data frame
+    :return: Data frame of float64 and object columns
+    """
+
+    columns = {}
+    for name in df.columns:
+        values = df[name]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        if values.dtype == np.float32:
+            # Shortest decimal form, like the xlsx writers
+            values = values.to_numpy().astype(str).astype(np.float64)
+        elif pd.api.types.is_numeric_dtype(values.dtype) and values.dtype != bool:
+            values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = values.to_numpy(dtype=object)
+        if values.dtype == np.float64:
+            # Adding 0.0 turns -0.0 into 0.0, every NaN is the same NaN
+            values = np.where(np.isnan(values), np.nan, values + 0.0)
+        columns[str(name)] = values
+    return pd.DataFrame(columns)
+
+
+def hash_rows(df):
+    """
+    64 bit hash of every row of a table, from its canonical values
+    :param df: Data frame
+    :return: uint64 array
+    """
+
+    return pd.util.hash_pandas_object(canonical_frame(df), index=False).to_numpy()
+
+
+def fingerprint_table(df, block_column=BLOCK_COLUMN):
+    """
+    Content fingerprint of a whole table
+    :param df: Data frame
+    :param block_column: Column holding the block of the rows
+    :return: ContentFingerprint
+    """
+    return ContentFingerprint().update(df, block_column)
+
+
+def compare_fingerprints(left, right):
+    """
+    Compare the fingerprints of two runs
+    :param left: {table name: fingerprint dictionary} of the reference run
+    :param right: {table name: fingerprint dictionary} of the compared run
+    :return: {table name: {'equal': bool, 'blocks': [mismatching blocks], 'rows': {block: [row positions]}}} of the
+             tables of either run, row positions within the block are only given when the block is one run of rows
+             with the same number of rows on both sides and the row hashes were recorded
+    """
+
+    result = {}
+    for name in list(left) + [name for name in right if name not in left]:
+        fp_left, fp_right = left.get(name), right.get(name)
+        if fp_left is None or fp_right is None:
+            result[name] = {'equal': False, 'missing': 'left' if fp_left is None else 'right'}
+            continue
+        if fp_left.get('version') != fp_right.get('version'):
+            raise ValueError(f'compare_fingerprints: Table {name} fingerprints have different versions')
+        if fp_left['table'] == fp_right['table']:
+            result[name] = {'equal': True}
+            continue
+
+        blocks_left, blocks_right = fp_left['blocks'], fp_right['blocks']
+        blocks = [block for block in list(blocks_left) + [b for b in blocks_right if b not in blocks_left]
+                  if blocks_left.get(block, {}).get('hash') != blocks_right.get(block, {}).get('hash')]
+        rows = {}
+        if 'row_hashes' in fp_left and 'row_hashes' in fp_right:
+            for block in blocks:
+                if block not in blocks_left or block not in blocks_right or \
+                        blocks_left[block]['rows'] != blocks_right[block]['rows']:
+                    continue
+                start_left, start_right = blocks_left[block]['start'], blocks_right[block]['start']
+                n_rows = blocks_left[block]['rows']
+                hashes_left = np.array(fp_left['row_hashes'][start_left:start_left + n_rows])
+                hashes_right = np.array(fp_right['row_hashes'][start_right:start_right + n_rows])
+                rows[block] = np.flatnonzero(hashes_left != hashes_right).tolist()
+        result[name] = {'equal': False, 'columns_equal': fp_left['columns'] == fp_right['columns'],
+                        'blocks': blocks, 'rows': rows}
+    return result
+
+
+def load_fingerprints(path):
+    """
+    Load the content fingerprints written by a run
+    :param path: Fingerprint file path
+    :return: {table name: fingerprint dictionary}
+    """
+
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    """
+    Compare the content fingerprint files of two runs, exit with 1 when they differ
+    :param argv: Argument list, sys.argv[1:] if None
+    """
+
+    arg_parser = argparse.ArgumentParser(description='Compare the content fingerprints of two runs')
+    arg_parser.add_argument('left', help='Fingerprint file of the reference run')
+    arg_parser.add_argument('right', help='Fingerprint file of the compared run')
+    args = arg_parser.parse_args(argv)
+
+    result = compare_fingerprints(load_fingerprints(args.left), load_fingerprints(args.right))
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if all(table['equal'] for table in result.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
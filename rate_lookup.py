@@ -0,0 +1,280 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+from rate_matrix import AGE_COLUMNS, DURATION_PREFIX, RateMatrix
+from rate_store import RateStore
+
+# Key string columns of the output tables, they are not dimensions
+KEY_COLUMNS = ['PA_Key', 'PA_KEY', 'Code', 'CODE']
+# Row position of keys matching several rows
+_AMBIGUOUS = -1
+# Largest key space indexed by a dense array in batch lookups, larger ones are searched in sorted codes
+DENSE_INDEX_MAX = 1 << 22
+
+
+class RateLookup():
+    """
+    In-memory rate lookup over a parsed table
+
+    Dimension tuples, e.g. ('L15', 'M', 'B3', 'SPNT', '-', 45) for CurrPremPerK, and Code strings are indexed to row
+    positions in hash tables, so a lookup costs one dictionary access and one array access whatever the size of the
+    table. Duration tables are held as a RateMatrix and get_curve() returns a view of a row of its block. Tables with a
+    single rate column, like CurrPremPerK and WaiverPerK, hold that column as an array.
+
+    The dimensions are the label columns of the table other than the keys, in table order, with the issue age last.
+    """
+
+    def __init__(self, table, dims=None, rate_column=None, keep=None):
+        """
+        :param table: Output data frame of a parser, RateMatrix or RateStore
+        :param dims: Dimension column names in key order, the label columns other than the keys if None
+        :param rate_column: Rate column of a table without duration columns, the only numeric column other than the
+                            issue age if None
+        :param keep: Row kept when several rows have the same key: 'first', 'last', or None to raise KeyError when such
+                     a key is looked up
+        """
+
+        if isinstance(table, RateStore):
+            table = table.to_table()
+        if isinstance(table, pd.DataFrame) and any(str(name).startswith(DURATION_PREFIX) for name in table.columns):
+            table = RateMatrix.from_frame(table)
+
+        if isinstance(table, RateMatrix):
+            self.matrix = table
+            labels = table.index
+            self.values = table.values
+            self.durations = {int(duration): j for j, duration in enumerate(table.durations)}
+            # Column position by duration offset from the first duration, -1 for gaps
+            self.first_duration = min(self.durations)
+            self.duration_columns = np.full(max(self.durations) - self.first_duration + 1, -1, dtype=np.int64)
+            self.duration_columns[np.array(list(self.durations)) - self.first_duration] = list(self.durations.values())
+        else:
+            self.matrix = None
+            labels = table
+            self.durations = None
+
+        if dims is None:
+            dims = [name for name in labels.columns if name not in KEY_COLUMNS and name != rate_column]
+            if self.matrix is None and rate_column is None:
+                numeric = [name for name in dims
+                           if pd.api.types.is_numeric_dtype(labels[name].dtype) and name not in AGE_COLUMNS]
+                if len(numeric) != 1:
+                    raise ValueError(f'RateLookup: Cannot tell the rate column among {numeric}, set rate_column')
+                rate_column = numeric[0]
+                dims.remove(rate_column)
+        self.dims = list(dims)
+
+        if self.matrix is None:
+            self.values = labels[rate_column].to_numpy()
+        self.rate_column = rate_column
+
+        # Python values, so that keys built by callers from str and int hash the same
+        keys = list(zip(*[labels[name].tolist() for name in self.dims]))
+        self.index = _build_index(keys, keep)
+        code_column = next((name for name in ['Code', 'CODE'] if name in labels.columns), None)
+        self.code_index = _build_index(labels[code_column].tolist(), keep) if code_column else {}
+        self.labels = labels
+        self.keep = keep
+        self._batch_index = None
+
+    @classmethod
+    def open(cls, path, dims=None, keep=None):
+        """
+        Build a lookup over a memory mapped rate store, the rates are read from the mapped file when looked up
+        :param path: Store directory written by rate_store.write_store
+        :param dims: Dimension column names in key order, see __init__
+        :param keep: Row kept when several rows have the same key, see __init__
+        :return: RateLookup
+        """
+        return cls(RateStore.open(path), dims, keep=keep)
+
+    def __len__(self):
+        return len(self.values)
+
+    def row(self, key):
+        """
+        Row position of a key
+        :param key: Dimension tuple or Code string
+        :return: Row position
+        """
+
+        index = self.code_index if isinstance(key, str) else self.index
+        row = index[key if isinstance(key, str) else tuple(key)]
+        if row == _AMBIGUOUS:
+            raise KeyError(f'RateLookup: Key {key!r} matches several rows')
+        return row
+
+    def get(self, key, duration=None, default=KeyError):
+        """
+        Look up a single rate
+        :param key: Dimension tuple or Code string
+        :param duration: Duration of a duration table, None for a table with a single rate column
+        :param default: Value returned for a missing key or duration, raise KeyError if not set
+        :return: Rate
+        """
+
+        if (duration is None) != (self.durations is None):
+            raise ValueError('RateLookup: A duration is required for duration tables and not allowed for the others')
+        try:
+            row = self.row(key)
+            if duration is None:
+                return self.values[row].item()
+            return self.values[row, self.durations[duration]].item()
+        except KeyError:
+            if default is KeyError:
+                raise
+            return default
+
+    def get_curve(self, key):
+        """
+        Look up the rates of all durations of a row
+        :param key: Dimension tuple or Code string
+        :return: 1D view of the rate block, in the order of the duration columns
+        """
+
+        if self.matrix is None:
+            raise ValueError('RateLookup: get_curve needs a table with duration columns')
+        return self.matrix.curve(self.row(key))
+
+    def get_batch(self, keys, durations=None):
+        """
+        Look up the rates of many keys at once
+
+        Key columns are mapped to integer codes and combined into one code per key, rows are found by indexing a code
+        table and the rates are gathered with one fancy indexing of the rate block, with no Python loop over the keys.
+        Categorical key columns, e.g. an in-force file loaded with compact dtypes, skip hashing the values of every row.
+        :param keys: {dimension: array}, data frame with the dimension columns, or list of arrays in the order of dims
+        :param durations: Array of durations of a duration table, None for a table with a single rate column
+        :return: (rate array, missing mask), rates of missing keys, durations and ambiguous keys are NaN
+        """
+
+        if (durations is None) != (self.durations is None):
+            raise ValueError('RateLookup: Durations are required for duration tables and not allowed for the others')
+        if not isinstance(keys, (dict, pd.DataFrame)):
+            keys = dict(zip(self.dims, keys))
+        rows = self._get_batch_index().get_rows([keys[name] for name in self.dims])
+        missing = rows < 0
+
+        if durations is None:
+            columns = None
+        else:
+            durations = np.asarray(durations, dtype=np.float64)
+            with np.errstate(invalid='ignore'):
+                position = durations - self.first_duration
+                valid = (position >= 0) & (position < len(self.duration_columns)) & (position == np.floor(position))
+            position = np.where(valid, position, 0).astype(np.int64)
+            columns = np.where(valid, self.duration_columns[position], -1)
+            missing |= columns < 0
+
+        rows = np.where(missing, 0, rows)
+        if columns is None:
+            rates = self.values[rows]
+        else:
+            rates = self.values[rows, np.where(missing, 0, columns)]
+        rates = rates.astype(np.result_type(rates.dtype, np.float32))
+        rates[missing] = np.nan
+        return rates, missing
+
+    def _get_batch_index(self):
+        """
+        Code tables of batch lookups, built on first use
+        """
+
+        if self._batch_index is None:
+            self._batch_index = _BatchIndex([self.labels[name] for name in self.dims], self.keep)
+        return self._batch_index
+
+
+def _build_index(keys, keep):
+    """
+    Hash index of keys to row positions
+    :param keys: List of hashable keys, one per row
+    :param keep: 'first', 'last' or None to mark keys of several rows as ambiguous
+    :return: {key: row position}
+    """
+
+    index = dict(zip(keys, range(len(keys))))
+    if len(index) == len(keys) or keep == 'last':
+        return index
+    if keep == 'first':
+        return dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+    for key, count in Counter(keys).items():
+        if count > 1:
+            index[key] = _AMBIGUOUS
+    return index
+
+
+class _BatchIndex():
+    """
+    Integer code index of the dimension tuples of a table
+
+    Each dimension value is coded by its position in the distinct values of the column and the codes are combined in
+    mixed radix into one integer per tuple. Small key spaces are indexed by a dense array of row positions, larger ones
+    by the sorted tuple codes.
+    """
+
+    def __init__(self, columns, keep):
+        """
+        :param columns: Dimension columns of the table
+        :param keep: 'first', 'last' or None to mark tuples of several rows as ambiguous
+        """
+
+        self.uniques = []
+        codes = np.zeros(len(columns[0]) if columns else 0, dtype=np.int64)
+        self.size = 1
+        for column in columns:
+            # Missing values are a value of their own, like the blank band of bandless products read back from Excel
+            column_codes, uniques = pd.factorize(column, use_na_sentinel=False)
+            self.uniques.append(pd.Index(uniques))
+            codes = codes * len(uniques) + column_codes
+            self.size *= max(len(uniques), 1)
+            if self.size >= 1 << 62:
+                raise ValueError('RateLookup: Key space too large for batch lookups')
+
+        # Row kept for each tuple code
+        order = np.argsort(codes[::-1] if keep == 'last' else codes, kind='stable')
+        if keep == 'last':
+            order = len(codes) - 1 - order
+        sorted_codes = codes[order]
+        first = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]] if len(codes) else np.zeros(0, dtype=bool)
+        self.codes = sorted_codes[first]
+        self.rows = order[first]
+        if keep is None:
+            counts = np.diff(np.r_[np.flatnonzero(first), len(codes)])
+            self.rows = np.where(counts > 1, _AMBIGUOUS, self.rows)
+
+        self.dense = None
+        if self.size <= DENSE_INDEX_MAX:
+            self.dense = np.full(self.size, -1, dtype=np.int64)
+            self.dense[self.codes] = self.rows
+
+    def get_rows(self, columns):
+        """
+        Row positions of key tuples
+        :param columns: Key columns in the order of the dimensions
+        :return: Array of row positions, negative for missing and ambiguous tuples
+        """
+
+        n_keys = len(columns[0]) if columns else 0
+        codes = np.zeros(n_keys, dtype=np.int64)
+        missing = np.zeros(n_keys, dtype=bool)
+        for column, uniques in zip(columns, self.uniques):
+            if isinstance(getattr(column, 'dtype', None), pd.CategoricalDtype):
+                # Categorical columns only map their categories, rows keep their category codes
+                column = pd.Categorical(column)
+                column_codes = np.r_[uniques.get_indexer(column.categories), uniques.get_indexer([np.nan])]
+                column_codes = column_codes[column.codes]
+            else:
+                column_codes = uniques.get_indexer(pd.Index(column))
+            missing |= column_codes < 0
+            codes = codes * len(uniques) + column_codes
+
+        codes = np.where(missing, 0, codes)
+        if self.dense is not None:
+            rows = self.dense[codes]
+        else:
+            positions = np.clip(np.searchsorted(self.codes, codes), 0, max(len(self.codes) - 1, 0))
+            rows = np.where(self.codes[positions] == codes, self.rows[positions], -1) if len(self.codes) else \
+                np.full(n_keys, -1, dtype=np.int64)
+        rows[missing] = -1
+        return rows
@@ -0,0 +1,165 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Output column name prefix of the duration columns
+DURATION_PREFIX = 'Dur.'
+# Names of the issue age column in the output tables
+AGE_COLUMNS = ['Iss. Age', 'Issue Age', 'Age']
+
+
+class RateMatrix():
+    """
+    Duration rate table stored as one contiguous 2D block
+
+    The rates of the BOYStateReserve, CashValuePerK, TAI_TR and Dividend tables are kept in a (rows, durations) NumPy
+    block and the rows are described by a compact index, a data frame of the label columns (dimensions, age and keys).
+    Each dimension combination of a parsed table is a contiguous run of rows in ascending age order, so selecting a
+    combination, an age range within it or a duration range is a basic slice of the block and returns a view. The
+    data frame with one column per duration is only built by to_frame() for export.
+    """
+
+    def __init__(self, values, index, columns, dtypes=None, age_column=None):
+        """
+        :param values: 2D block of rates, one row per index row and one column per duration
+        :param index: Data frame of the label columns, its index is the index of the exported data frame
+        :param columns: Duration column names, e.g. Dur.0 ... Dur.121
+        :param dtypes: Dtypes of the duration columns restored by to_frame, the block dtype if None
+        :param age_column: Name of the issue age column of the index, looked up in AGE_COLUMNS if None
+        """
+        if values.ndim != 2 or values.shape != (len(index), len(columns)):
+            raise ValueError(f'RateMatrix: Block of shape {values.shape} does not match {len(index)} index rows and '
+                             f'{len(columns)} duration columns')
+        self.values = values
+        self.index = index
+        self.columns = list(columns)
+        self.durations = np.array([_get_duration(name) for name in self.columns], dtype=np.int64)
+        self.dtypes = list(dtypes) if dtypes is not None else [values.dtype] * len(self.columns)
+        if age_column is None:
+            age_column = next((name for name in AGE_COLUMNS if name in index.columns), None)
+        self.age_column = age_column
+
+    @classmethod
+    def from_frame(cls, df, duration_prefix=DURATION_PREFIX):
+        """
+        Build a rate matrix from an output data frame
+        :param df: Data frame with label columns followed by duration columns
+        :param duration_prefix: Name prefix of the duration columns
+        :return: RateMatrix
+        """
+
+        columns = [name for name in df.columns if str(name).startswith(duration_prefix)]
+        if not columns:
+            raise ValueError(f"RateMatrix: No duration column starting with '{duration_prefix}'")
+        dtypes = df[columns].dtypes.tolist()
+        # One copy of the duration columns into a C ordered block, so every row is a contiguous curve
+        values = np.ascontiguousarray(df[columns].to_numpy(dtype=np.result_type(*dtypes)))
+        index = df[[name for name in df.columns if name not in set(columns)]]
+        return cls(values, index, columns, dtypes)
+
+    @classmethod
+    def concat(cls, matrices):
+        """
+        Stack rate matrices with the same duration columns
+        :param matrices: List of RateMatrix
+        :return: RateMatrix
+        """
+
+        columns = matrices[0].columns
+        for matrix in matrices[1:]:
+            if matrix.columns != columns:
+                raise ValueError('RateMatrix.concat: Matrices have different duration columns')
+        dtypes = [np.result_type(*dtypes) for dtypes in zip(*(matrix.dtypes for matrix in matrices))]
+        return cls(np.concatenate([matrix.values for matrix in matrices]),
+                   pd.concat([matrix.index for matrix in matrices], ignore_index=True), columns, dtypes,
+                   matrices[0].age_column)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def to_frame(self):
+        """
+        Build the output data frame, label columns followed by one column per duration
+        :return: Data frame
+        """
+
+        columns = {name: self.index[name] for name in self.index.columns}
+        for j, name in enumerate(self.columns):
+            columns[name] = self.values[:, j].astype(self.dtypes[j], copy=False)
+        return pd.DataFrame(columns, index=self.index.index)
+
+    def curve(self, row):
+        """
+        Rates of one row over all durations
+        :param row: Row position
+        :return: 1D view of the block
+        """
+        return self.values[row]
+
+    def select(self, dims=None, ages=None, durations=None):
+        """
+        Select rows by dimension values and age range, and columns by duration range
+
+        The result is a view of the block when the selected rows are contiguous, which is the case for a full dimension
+        combination, an age range within it, or any selection of the leading dimensions of a sorted matrix. Other
+        selections copy the selected rows.
+        :param dims: {column: value or list of values} of index columns
+        :param ages: (first age, last age) inclusive range of issue ages
+        :param durations: (first duration, last duration) inclusive range of durations
+        :return: RateMatrix
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in (dims or {}).items():
+            column = self.index[name]
+            if isinstance(value, (list, tuple, set)):
+                mask &= column.isin(value).to_numpy()
+            else:
+                mask &= (column == value).to_numpy()
+        if ages is not None:
+            age = self.index[self.age_column].to_numpy()
+            mask &= (age >= ages[0]) & (age <= ages[1])
+
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0 or rows[-1] - rows[0] + 1 == len(rows):
+            rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+            index = self.index.iloc[rows].reset_index(drop=True)
+        else:
+            index = self.index.take(rows).reset_index(drop=True)
+
+        columns = slice(None)
+        if durations is not None:
+            # Durations are in ascending order, so a range of durations is a range of columns
+            positions = np.flatnonzero((self.durations >= durations[0]) & (self.durations <= durations[1]))
+            columns = slice(positions[0], positions[-1] + 1) if len(positions) else slice(0, 0)
+
+        # Basic slicing on both axes keeps a view, row positions take a copy
+        values = self.values[rows, columns] if isinstance(rows, slice) else self.values[rows][:, columns]
+        return RateMatrix(values, index, self.columns[columns], self.dtypes[columns], self.age_column)
+
+    def sort(self, dims):
+        """
+        Sort rows by dimension columns and issue age, so that any selection of the leading dimensions is contiguous
+        :param dims: Index column names in sort order
+        :return: RateMatrix
+        """
+
+        order = self.index.reset_index(drop=True).sort_values(list(dims) + [self.age_column],
+                                                              kind='stable').index.to_numpy()
+        return RateMatrix(self.values[order], self.index.take(order).reset_index(drop=True), self.columns, self.dtypes,
+                          self.age_column)
+
+
+def _get_duration(name):
+    """
+    Duration number of a duration column name, e.g. -1 for Dur.-1
+    """
+
+    match = re.search(r'(-?\d+)$', str(name))
+    if match is None:
+        raise ValueError(f'RateMatrix: Cannot read the duration of column {name}')
+    return int(match.group(1))
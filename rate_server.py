@@ -0,0 +1,460 @@
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from output_sinks import RateStoreSink
+from rate_file_converter import PARSER_TYPES, read_output_sheets
+from rate_lookup import RateLookup
+from rate_store import HEADER_FILE
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+                500: 'Internal Server Error'}
+# Largest request body accepted, a batch of about a million keys
+MAX_BODY_BYTES = 256 << 20
+# Most keys answered by one batch request
+MAX_BATCH_KEYS = 1 << 20
+# Routes whose work grows with the request size, run in the thread pool so the event loop keeps serving
+EXECUTOR_ROUTES = {('POST', '/batch')}
+
+
+class RateSnapshot():
+    """
+    Immutable set of rate lookups loaded from one version of the output file
+
+    The server holds the current snapshot in a single attribute and each request reads that attribute once, so a reload
+    swaps all the tables at once by replacing the reference and requests in flight keep the snapshot they started with.
+    """
+
+    def __init__(self, lookups, sheets, version, signature):
+        """
+        :param lookups: {table name: RateLookup}
+        :param sheets: {table name: output sheet name}
+        :param version: Snapshot number, incremented on each reload
+        :param signature: Change signature of the files the tables were read from, see get_signature
+        """
+        self.lookups = lookups
+        self.sheets = sheets
+        self.version = version
+        self.signature = signature
+        self.loaded_at = time.time()
+
+    def get_lookup(self, table):
+        """
+        Lookup of a table
+        :param table: Table name, the parser type, e.g. Dividend
+        :return: RateLookup
+        """
+
+        if table not in self.lookups:
+            raise KeyError(f'Unknown table {table!r}, loaded tables: {sorted(self.lookups)}')
+        return self.lookups[table]
+
+
+def get_store_paths(store_dir, sheets):
+    """
+    Store directories of the output sheets, as written by the store sink
+    :param store_dir: Output directory of the store sink
+    :param sheets: {table name: output sheet name}
+    :return: {table name: store directory}
+    """
+
+    sink = RateStoreSink(store_dir)
+    return {table: sink.get_path(sheet_name) for table, sheet_name in sheets.items()}
+
+
+def get_signature(paths):
+    """
+    Change signature of files
+    :param paths: File paths
+    :return: Tuple of (mtime in ns, size) per file, None for a missing file, None if no file exists
+    """
+
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature) if any(signature) else None
+
+
+def get_source_files(output_file, sheets, store_dir=None):
+    """
+    Files whose change triggers a reload: the output workbook, or the header of each store, which is written last
+    """
+
+    if store_dir is None:
+        return [output_file]
+    return [os.path.join(path, HEADER_FILE) for path in get_store_paths(store_dir, sheets).values()]
+
+
+def load_snapshot(output_file, sheets, version, keep=None, store_dir=None):
+    """
+    Read the output sheets and index them
+    :param output_file: Output file path
+    :param sheets: {table name: output sheet name}
+    :param version: Version number of the snapshot
+    :param keep: Row kept for keys of several rows, see RateLookup
+    :param store_dir: Output directory of the store sink, the tables are mapped from the stores instead of read from
+                      the output file
+    :return: RateSnapshot
+    """
+
+    signature = get_signature(get_source_files(output_file, sheets, store_dir))
+    if store_dir is None:
+        frames = read_output_sheets(output_file, sheets.values())
+        lookups = {table: RateLookup(frames[sheet_name], keep=keep) for table, sheet_name in sheets.items()
+                   if sheet_name in frames}
+    else:
+        lookups = {table: RateLookup.open(path, keep=keep) for table, path in get_store_paths(store_dir, sheets).items()
+                   if os.path.exists(os.path.join(path, HEADER_FILE))}
+    if not lookups:
+        raise ValueError(f'No output sheet of {sorted(sheets)} in {store_dir or output_file}')
+    return RateSnapshot(lookups, {table: sheets[table] for table in lookups}, version, signature)
+
+
+def to_json_value(value):
+    """
+    JSON value of a rate, null for NaN
+    """
+
+    value = value.item() if isinstance(value, np.generic) else value
+    return None if isinstance(value, float) and value != value else value
+
+
+class RateServer():
+    """
+    Local HTTP server of rate lookups
+
+    Tables are read once from the output file, or mapped from the rate stores of the store sink, and answered from
+    memory. The source files are polled and a change rebuilds the tables in a worker thread while requests are served
+    from the current snapshot, then the new snapshot is swapped in. A reload is only started once the files are
+    unchanged for a full poll interval, so a file still being written is not read, and a failed reload keeps the
+    current snapshot.
+
+    Endpoints, JSON bodies and responses:
+        GET /health
+        GET /tables
+        GET /keys?table=Dividend&limit=100       key tuples of the first rows of a table
+        POST /lookup {"table": "CashValuePerK", "key": ["L15", "M", "NT", 45] or "<Code>", "duration": 10}
+        POST /batch {"table": "CashValuePerK", "keys": {"Product": [...], ...} or [[...], ...], "durations": [...]}
+        POST /reload
+    """
+
+    def __init__(self, output_file, sheets, host='127.0.0.1', port=8765, poll_interval=2.0, keep=None,
+                 store_dir=None):
+        """
+        :param output_file: Output file path
+        :param sheets: {table name: output sheet name}
+        :param host: Listening address, localhost by default
+        :param port: Listening port, 0 to pick a free port
+        :param poll_interval: Seconds between checks of the output file, 0 to disable polling
+        :param keep: Row kept for keys of several rows, see RateLookup
+        :param store_dir: Output directory of the store sink to serve instead of the output file
+        """
+
+        self.output_file = output_file
+        self.sheets = sheets
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.keep = keep
+        self.store_dir = store_dir
+        self.snapshot = None
+        self.server = None
+        self._reload_task = None
+        self._watch_task = None
+        self._failed_signature = None
+
+    async def start(self):
+        """
+        Load the tables and start listening
+        """
+
+        loop = asyncio.get_running_loop()
+        self.snapshot = await loop.run_in_executor(None, load_snapshot, self.output_file, self.sheets, 1, self.keep,
+                                                   self.store_dir)
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.poll_interval:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def serve_forever(self):
+        await self.start()
+        log(f'Serving {sorted(self.snapshot.lookups)} from {self.store_dir or self.output_file} on '
+            f'http://{self.host}:{self.port}')
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        tasks = [task for task in (self._watch_task, self._reload_task) if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        # A cancelled reload leaves its thread to finish, the snapshot it loads is dropped
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def reload(self):
+        """
+        Start a background reload, or join the one in progress
+        :return: Task resolving to the new snapshot
+        """
+
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload())
+        return self._reload_task
+
+    async def _reload(self):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        snapshot = await loop.run_in_executor(None, load_snapshot, self.output_file, self.sheets,
+                                              self.snapshot.version + 1, self.keep, self.store_dir)
+        # Single reference assignment on the event loop thread, the swap is atomic for every request
+        self.snapshot = snapshot
+        log(f'Reloaded snapshot {snapshot.version} in {time.perf_counter() - start:.1f}s')
+        return snapshot
+
+    async def _watch(self):
+        """
+        Poll the source files and reload once a change has settled
+        """
+
+        paths = get_source_files(self.output_file, self.sheets, self.store_dir)
+        pending = None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            signature = get_signature(paths)
+            if signature is None or signature in (self.snapshot.signature, self._failed_signature):
+                pending = None
+                continue
+            if signature != pending:
+                # Changed since the last poll, wait for the writer to finish
+                pending = signature
+                continue
+            pending = None
+            try:
+                await self.reload()
+            except Exception as error:
+                log(f'Reload failed, keeping snapshot {self.snapshot.version}: {error!r}')
+                # Do not retry until the file changes again
+                self._failed_signature = signature
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload = await self.dispatch(method, target, body)
+                data = json.dumps(payload).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HttpError as error:
+            data = json.dumps({'error': str(error)}).encode()
+            writer.write(f'HTTP/1.1 {error.status} {HTTP_REASONS[error.status]}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode() + data)
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """
+        Answer a request
+        :param method: HTTP method
+        :param target: Request target, path and query
+        :param body: Request body
+        :return: (HTTP status, JSON payload)
+        """
+
+        url = urlsplit(target)
+        routes = {('GET', '/health'): self._health, ('GET', '/tables'): self._tables, ('GET', '/keys'): self._keys,
+                  ('POST', '/lookup'): self._lookup, ('POST', '/batch'): self._batch}
+        try:
+            if (method, url.path) == ('POST', '/reload'):
+                snapshot = await self.reload()
+                return 200, {'version': snapshot.version}
+            if (method, url.path) not in routes:
+                if url.path in {path for _, path in routes} | {'/reload'}:
+                    return 405, {'error': f'{method} not allowed on {url.path}'}
+                return 404, {'error': f'Unknown path {url.path}'}
+            # The snapshot is read once, a reload during the request does not change the tables it uses
+            snapshot = self.snapshot
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            if (method, url.path) in EXECUTOR_ROUTES:
+                loop = asyncio.get_running_loop()
+                return 200, await loop.run_in_executor(None, call_route, routes[method, url.path], snapshot, body,
+                                                       query)
+            return 200, call_route(routes[method, url.path], snapshot, body, query)
+        except KeyError as error:
+            return 404, {'error': str(error.args[0]) if error.args else repr(error)}
+        except (ValueError, TypeError) as error:
+            return 400, {'error': str(error)}
+        except Exception as error:
+            return 500, {'error': repr(error)}
+
+    def _health(self, snapshot, request, query):
+        return {'status': 'ok', 'version': snapshot.version, 'loaded_at': snapshot.loaded_at}
+
+    def _tables(self, snapshot, request, query):
+        tables = {}
+        for table, lookup in snapshot.lookups.items():
+            durations = sorted(lookup.durations) if lookup.durations is not None else None
+            tables[table] = {'sheet': snapshot.sheets[table], 'dims': lookup.dims, 'rows': len(lookup),
+                             'durations': [durations[0], durations[-1]] if durations else None}
+        return {'version': snapshot.version, 'tables': tables}
+
+    def _keys(self, snapshot, request, query):
+        lookup = snapshot.get_lookup(query.get('table'))
+        limit = int(query.get('limit', 100))
+        return {'dims': lookup.dims, 'keys': [list(key) for key, _ in zip(lookup.index, range(limit))]}
+
+    def _lookup(self, snapshot, request, query):
+        lookup = snapshot.get_lookup(request.get('table'))
+        key = request.get('key')
+        if not isinstance(key, str):
+            key = tuple(key)
+        rate = lookup.get(key, request.get('duration'), default=None)
+        if rate is None:
+            raise KeyError(f"No rate for key {request.get('key')!r} of {lookup.dims} at duration "
+                           f"{request.get('duration')!r}")
+        return {'version': snapshot.version, 'rate': to_json_value(rate)}
+
+    def _batch(self, snapshot, request, query):
+        lookup = snapshot.get_lookup(request.get('table'))
+        keys = request.get('keys')
+        n_keys = max((len(column) for column in (keys.values() if isinstance(keys, dict) else keys)), default=0)
+        if n_keys > MAX_BATCH_KEYS:
+            raise ValueError(f'Batch of {n_keys} keys is larger than {MAX_BATCH_KEYS}, split it into smaller requests')
+        if isinstance(keys, dict):
+            keys = {name: np.asarray(keys[name]) for name in lookup.dims}
+        else:
+            keys = [np.asarray(column) for column in keys]
+        durations = request.get('durations')
+        rates, missing = lookup.get_batch(keys, None if durations is None else np.asarray(durations, dtype=float))
+        return {'version': snapshot.version, 'rates': np.where(missing, None, rates.astype(object)).tolist(),
+                'missing': missing.tolist()}
+
+
+def call_route(route, snapshot, body, query):
+    """
+    Decode a request body and answer it with a route
+    :return: JSON payload
+    """
+
+    return route(snapshot, json.loads(body) if body else {}, query)
+
+
+class HttpError(Exception):
+    """
+    Malformed request, answered with the status and the connection closed
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    """
+    Read one HTTP/1.1 request
+    :param reader: asyncio.StreamReader of the connection
+    :return: (method, target, {lower case header: value}, body bytes), None when the client closed the connection
+    """
+
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HttpError(400, f'Malformed request line {line!r}')
+    method, target, _ = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f'Request body of {length} bytes is larger than {MAX_BODY_BYTES}')
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+
+def log(message):
+    print(time.strftime('%Y-%m-%d %H:%M:%S'), message, file=sys.stderr, flush=True)
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+    :param argv: Argument list, sys.argv[1:] if None
+    :return: Parsed arguments
+    """
+
+    arg_parser = argparse.ArgumentParser(description='Serve rate lookups of the output workbook on localhost')
+    arg_parser.add_argument('parser_type', nargs='*',
+                            help='Tables to serve, the parser types of the output sheets (default: all the output '
+                                 'sheets of config.txt found in Output_file): ' + ', '.join(PARSER_TYPES))
+    arg_parser.add_argument('--config', default='config.txt', help='Configuration file (default: %(default)s)')
+    arg_parser.add_argument('--output-file', help='Workbook to serve (default: Output_file of the configuration)')
+    arg_parser.add_argument('--store-dir',
+                            help='Serve the rate stores written by the store sink into this directory instead of the '
+                                 'workbook, tables are memory mapped and reload in milliseconds')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='Listening address (default: %(default)s)')
+    arg_parser.add_argument('--port', type=int, default=8765, help='Listening port (default: %(default)s)')
+    arg_parser.add_argument('--poll', type=float, default=2.0,
+                            help='Seconds between checks of the output file for a refresh, 0 to only reload on '
+                                 'POST /reload (default: %(default)s)')
+    arg_parser.add_argument('--keep', choices=['first', 'last'],
+                            help='Row answered for keys matching several rows (default: such keys are not found)')
+
+    args = arg_parser.parse_args(argv)
+    for parser_type in args.parser_type:
+        if parser_type not in PARSER_TYPES:
+            arg_parser.error(f"invalid parser type: {parser_type} (choose from {', '.join(PARSER_TYPES)})")
+    return args
+
+
+def main(argv=None):
+    """
+    Server entry point
+    :param argv: Argument list, sys.argv[1:] if None
+    :return:
+    """
+
+    args = parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    output_file = args.output_file or config['IO']['Output_file']
+    parser_types = args.parser_type or [name for name in PARSER_TYPES if name in config]
+    sheets = {name: config[name]['Output_sheet_name'] for name in parser_types if 'Output_sheet_name' in config[name]}
+
+    server = RateServer(output_file, sheets, args.host, args.port, args.poll, args.keep, args.store_dir)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import json
+import os
+import uuid
+import numpy as np
+import pandas as pd
+from rate_matrix import AGE_COLUMNS, DURATION_PREFIX, RateMatrix
+
+# Name of the JSON header file of a store directory
+HEADER_FILE = 'header.json'
+# Format name and version written in the header
+STORE_FORMAT = 'rate-store'
+STORE_VERSION = 1
+
+
+class RateStore():
+    """
+    Memory mapped binary rate table
+
+    A store is a directory holding a JSON header, the rate block as a raw C ordered array (rows, rate columns) and the
+    dimension index as a raw array of integer codes (label columns, rows), whose values are listed in the header.
+    Opening a store reads the header and maps both arrays with np.memmap, no rate is read until it is used, so a table
+    opens in milliseconds whatever its size and processes of the same host share its pages in the page cache.
+
+    The rate columns are the duration columns of duration tables, and the numeric columns other than the issue age for
+    the other tables, e.g. Premium_Rate of CurrPremPerK. Every other column is a label column.
+    """
+
+    def __init__(self, path, header, values, codes):
+        """
+        :param path: Store directory
+        :param header: Header dictionary
+        :param values: Rate block, (rows, rate columns)
+        :param codes: Label codes, (label columns, rows)
+        """
+        self.path = path
+        self.header = header
+        self.values = values
+        self.codes = codes
+        self._index = None
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open a store directory
+        :param path: Store directory
+        :return: RateStore
+        """
+
+        # A writer replaces the header last, retry if the files it names were replaced in between
+        for attempt in range(3):
+            with open(os.path.join(path, HEADER_FILE), encoding='utf8') as f:
+                header = json.load(f)
+            if header.get('format') != STORE_FORMAT or header.get('version') != STORE_VERSION:
+                raise ValueError(f"RateStore: {path} is not a {STORE_FORMAT} version {STORE_VERSION} directory")
+            try:
+                values = _map_array(path, header['rates'])
+                codes = _map_array(path, header['index'])
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                continue
+            return cls(path, header, values, codes)
+
+    def __len__(self):
+        return self.header['rows']
+
+    @property
+    def columns(self):
+        """
+        Column names of the stored data frame, in order
+        """
+        return self.header['columns']
+
+    @property
+    def metadata(self):
+        return self.header.get('metadata', {})
+
+    @property
+    def index(self):
+        """
+        Data frame of the label columns: text columns as categoricals over the stored values, numeric columns decoded
+        """
+
+        if self._index is None:
+            self._index = pd.DataFrame({column['name']: _decode_column(self.codes[k], column, categorical=True)
+                                        for k, column in enumerate(self.header['index']['columns'])})
+        return self._index
+
+    def is_duration_table(self):
+        return any(str(name).startswith(DURATION_PREFIX) for name in self.header['rates']['columns'])
+
+    def to_matrix(self):
+        """
+        Rate matrix over the mapped rate block, selections of contiguous rows stay views of the mapped file
+        :return: RateMatrix
+        """
+
+        if not self.is_duration_table():
+            raise ValueError(f'RateStore: {self.path} is not a duration table')
+        rates = self.header['rates']
+        return RateMatrix(self.values, self.index, rates['columns'], [np.dtype(dtype) for dtype in rates['dtypes']])
+
+    def to_table(self):
+        """
+        Table for RateLookup: a RateMatrix for duration tables, the label columns and the rate column otherwise
+        """
+
+        if self.is_duration_table():
+            return self.to_matrix()
+        rates = self.header['rates']
+        columns = dict(self.index.items())
+        for j, name in enumerate(rates['columns']):
+            columns[name] = self.values[:, j].astype(rates['dtypes'][j], copy=False)
+        return pd.DataFrame(columns)
+
+    def to_frame(self, rows=slice(None)):
+        """
+        Rebuild the stored data frame with its column order and dtypes
+        :param rows: Slice of the rows to rebuild, all rows by default
+        :return: Data frame
+        """
+
+        columns = {}
+        for k, column in enumerate(self.header['index']['columns']):
+            columns[column['name']] = _decode_column(self.codes[k, rows], column)
+        rates = self.header['rates']
+        values = self.values[rows]
+        for j, name in enumerate(rates['columns']):
+            columns[name] = np.array(values[:, j], dtype=rates['dtypes'][j])
+        return pd.DataFrame(columns)[self.columns]
+
+
+def write_store(path, df, metadata=None):
+    """
+    Write a data frame as a store directory
+
+    The arrays are written under new file names and the header is replaced last, so readers either open the previous
+    version or the new one. Files of the previous versions are then removed. Readers keep the generation they mapped:
+    on POSIX the removed files stay readable until unmapped, on Windows a mapped file cannot be removed and is left in
+    place, every write retries the files of older generations.
+    :param path: Store directory, created if missing
+    :param df: Output data frame of a parser
+    :param metadata: Metadata dictionary kept in the header, see output_sinks.get_metadata
+    """
+
+    columns = [str(name) for name in df.columns]
+    df = df.set_axis(columns, axis=1)
+    rate_columns = get_rate_columns(df)
+    label_columns = [name for name in columns if name not in set(rate_columns)]
+
+    dtypes = [df[name].dtype for name in rate_columns]
+    block_dtype = np.result_type(*dtypes) if dtypes else np.float64
+    values = np.ascontiguousarray(df[rate_columns].to_numpy(dtype=block_dtype))
+
+    codes = np.empty((len(label_columns), len(df)), dtype=np.int32)
+    index_columns = []
+    for k, name in enumerate(label_columns):
+        column = df[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes[k] = column.cat.codes
+            categories = column.cat.categories
+        else:
+            codes[k], categories = pd.factorize(column)
+        index_columns.append({'name': name, 'dtype': str(column.dtype), 'categories': categories.tolist()})
+
+    os.makedirs(path, exist_ok=True)
+    token = uuid.uuid4().hex[:12]
+    header = {
+        'format': STORE_FORMAT,
+        'version': STORE_VERSION,
+        'rows': len(df),
+        'columns': columns,
+        'rates': {'file': f'rates-{token}.bin', 'dtype': values.dtype.str, 'shape': list(values.shape),
+                  'columns': rate_columns, 'dtypes': [str(dtype) for dtype in dtypes]},
+        'index': {'file': f'index-{token}.bin', 'dtype': codes.dtype.str, 'shape': list(codes.shape),
+                  'columns': index_columns},
+        'metadata': metadata or {},
+    }
+    values.tofile(os.path.join(path, header['rates']['file']))
+    codes.tofile(os.path.join(path, header['index']['file']))
+    tmp_header = os.path.join(path, HEADER_FILE + '.tmp')
+    with open(tmp_header, 'w', encoding='utf8') as f:
+        json.dump(header, f)
+    os.replace(tmp_header, os.path.join(path, HEADER_FILE))
+
+    for name in os.listdir(path):
+        if name.endswith('.bin') and name not in (header['rates']['file'], header['index']['file']):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                # Still mapped by a reader (PermissionError on Windows), removed by a later write
+                pass
+
+
+def get_rate_columns(df):
+    """
+    Rate columns of an output data frame: the duration columns, or the numeric columns other than the issue age
+    """
+
+    columns = [name for name in df.columns if str(name).startswith(DURATION_PREFIX)]
+    if columns:
+        return columns
+    return [name for name in df.columns
+            if pd.api.types.is_numeric_dtype(df[name].dtype) and name not in AGE_COLUMNS]
+
+
+def _map_array(path, spec):
+    """
+    Map an array file of a store read-only
+    """
+
+    shape = tuple(spec['shape'])
+    if 0 in shape:
+        # mmap cannot map an empty file
+        return np.empty(shape, dtype=spec['dtype'])
+    return np.memmap(os.path.join(path, spec['file']), dtype=spec['dtype'], mode='r', shape=shape)
+
+
+def _decode_column(codes, column, categorical=False):
+    """
+    Rebuild a label column from its codes
+    :param codes: Codes of the rows, -1 for missing values
+    :param column: Column description of the header
+    :param categorical: Return text columns as categoricals instead of their stored dtype
+    :return: Array like
+    """
+
+    categories = pd.Index(column['categories'])
+    if column['dtype'] == 'category' or (categorical and not pd.api.types.is_numeric_dtype(categories.dtype)):
+        return pd.Categorical.from_codes(codes, categories=categories)
+    if (codes < 0).any():
+        # Missing values become NaN, in an object or float array
+        return np.asarray(pd.Categorical.from_codes(codes, categories=categories))
+    return categories.take(codes).astype(column['dtype']).to_numpy()
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+
+class _Constant():
+    """
+    Column holding the same value on every row of a chunk, broadcast on build
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class RateTableBuilder():
+    """
+    Accumulator of rate table chunks
+
+    Parsers append the columns of each worksheet as arrays and the data frame is materialized once by build(), every
+    column is concatenated with a single copy. Growing the output with pd.concat inside the sheet loop copies the whole
+    table again for each sheet, which makes the cost quadratic in the number of sheets. Columns that are constant within
+    a sheet, like the gender or the band taken from the sheet name, are kept as scalars until build. Columns missing
+    from a chunk are filled with NaN and columns keep the order of first appearance, like pd.concat(sort=False).
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.names = {}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, data, constants=None):
+        """
+        Append a chunk of rows
+        :param data: Data frame, or {column: array} with arrays of the same length
+        :param constants: {column: value} of columns holding the same value on every row of the chunk
+        :return: The builder
+        """
+
+        if isinstance(data, pd.DataFrame):
+            n_rows = len(data)
+            # One block per dtype, taking the columns one by one as series costs more than the copy
+            chunk = {}
+            dtypes = data.dtypes.to_numpy()
+            for dtype in pd.unique(dtypes):
+                positions = np.flatnonzero(dtypes == dtype)
+                block = data.iloc[:, positions].to_numpy()
+                for k, position in enumerate(positions):
+                    chunk[data.columns[position]] = block[:, k]
+            chunk = {name: chunk[name] for name in data.columns}
+        else:
+            chunk = {name: np.asarray(values) for name, values in data.items()}
+            n_rows = len(next(iter(chunk.values()))) if chunk else 0
+        for name, value in (constants or {}).items():
+            chunk[name] = _Constant(value)
+
+        for name in chunk:
+            self.names.setdefault(name, None)
+        self.chunks.append((n_rows, chunk))
+        self.n_rows += n_rows
+        return self
+
+    def build(self):
+        """
+        Materialize the appended chunks
+        :return: Data frame with a fresh RangeIndex
+        """
+
+        columns = {}
+        for name in self.names:
+            parts = []
+            for n_rows, chunk in self.chunks:
+                values = chunk.get(name)
+                if values is None:
+                    parts.append(np.full(n_rows, np.nan))
+                elif isinstance(values, _Constant):
+                    parts.append(np.full(n_rows, values.value, dtype=object if isinstance(values.value, str) else None))
+                else:
+                    parts.append(values)
+            columns[name] = np.concatenate(parts)
+        return pd.DataFrame(columns, index=pd.RangeIndex(self.n_rows))
+
+
+# Default bound of the relative error of rates stored as float32
+FLOAT32_RTOL_DEFAULT = 1e-6
+
+
+def compact_frame(df, categories, float32=False, rtol=FLOAT32_RTOL_DEFAULT):
+    """
+    Convert an output data frame to compact dtypes
+
+    Dimension columns become categoricals over a fixed category set, so the frames of different products share their
+    categories and stay categorical when concatenated. Integer columns are downcast to the smallest integer type.
+    Float rate columns are stored as float32 on request, every value is checked against the relative error bound.
+    :param df: Data frame
+    :param categories: {column: list of categories} of the dimension columns
+    :param float32: Store float64 columns as float32
+    :param rtol: Largest relative error allowed for float32 values
+    :return: Data frame
+    """
+
+    columns = {}
+    for name in df.columns:
+        values = df[name]
+        if name in categories:
+            compact = pd.Categorical(values, categories=categories[name])
+            unknown = values.notna().to_numpy() & (compact.codes == -1)
+            if unknown.any():
+                raise ValueError(f"compact_frame: Column {name} has values outside of its category set: "
+                                 f"{sorted(set(values[unknown].astype(str)))}")
+            values = compact
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            values = pd.to_numeric(values, downcast='integer')
+        elif float32 and values.dtype == np.float64:
+            compact = values.to_numpy(np.float32)
+            with np.errstate(over='ignore', invalid='ignore'):
+                error = np.abs(compact.astype(np.float64) - values.to_numpy())
+                bad = ~(error <= rtol * np.abs(values.to_numpy())) & values.notna().to_numpy()
+            if bad.any():
+                raise ValueError(f"compact_frame: Column {name} cannot be stored as float32 within a relative error of "
+                                 f"{rtol}, e.g. value {float(values[bad].iloc[0])!r}")
+            values = compact
+        columns[name] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def widen_float32(df):
+    """
+    Convert float32 columns back to float64 for writers that format float64 values
+
+    Each value becomes the float64 closest to the shortest decimal representation of the float32 value, so 0.1 stored
+    as float32 is written as 0.1 and not as 0.10000000149011612.
+    :param df: Data frame
+    :return: Data frame, df itself when it has no float32 column
+    """
+
+    names = [name for name, dtype in df.dtypes.items() if dtype == np.float32]
+    if not names:
+        return df
+    df = df.copy(deep=False)
+    for name in names:
+        df[name] = df[name].to_numpy().astype(str).astype(np.float64)
+    return df
@@ -0,0 +1,320 @@
+import cProfile
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not recorded there
+    resource = None
+
+# Version of the run report layout
+REPORT_VERSION = 1
+# Memory fields of a span, in bytes, the report keeps their largest value per stage
+MEMORY_FIELDS = ['rss_delta', 'rss_peak_delta', 'alloc_delta', 'alloc_peak']
+
+# Recorder of the current process, None when instrumentation is off
+_recorder = None
+# Context manager returned by span() when instrumentation is off
+_NO_SPAN = nullcontext()
+
+
+class MemoryBudgetError(MemoryError):
+    """
+    Raised when the memory of the process goes over the memory budget of the run
+    """
+
+
+class RunRecorder():
+    """
+    Recorder of named timing spans
+
+    A span times one stage of a run, e.g. reading a sheet or building the keys of a table. Spans carry the workbook, the
+    parser type and the sheet they ran for, inherited from the enclosing spans, so the report can be broken down per
+    file and per sheet. Spans nest: the time of a span includes the time of the spans it encloses.
+
+    In memory mode, spans also record the change of the resident set size (rss_delta), how much the peak RSS of the
+    process grew (rss_peak_delta), the change of the memory allocated through Python and NumPy (alloc_delta) and its
+    high-water mark above the start of the span (alloc_peak). Allocations are traced with tracemalloc, which slows the
+    run down noticeably, so memory mode is opt-in.
+
+    With a memory budget, the RSS is checked at the start and at the end of every span, and by check_budget() within
+    long stages, and MemoryBudgetError is raised as soon as it is over the budget, naming the stage, workbook and sheet.
+
+    Code being timed does not hold a recorder, it calls the module level span(), which records into the recorder set
+    with set_recorder() and costs nothing when there is none.
+    """
+
+    def __init__(self, memory=False, memory_budget=None, context=None):
+        """
+        :param memory: Record the memory of every span
+        :param memory_budget: Memory budget of the process in bytes, None for no budget
+        :param context: Context of the spans, e.g. the file and parser of the span a worker process runs for
+        """
+        self.memory = memory
+        self.memory_budget = memory_budget
+        self.spans = []
+        self.started = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._context = dict(context or {})
+        # Allocation high-water marks of the open spans, innermost last
+        self._alloc_peaks = []
+        # The budget is checked on the traced allocations where the RSS cannot be read
+        self._trace = memory or (memory_budget is not None and get_rss() is None)
+        if self._trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def options(self):
+        """
+        Arguments to create a recorder with the same settings and the context of the open spans, e.g. in a worker
+        process
+        """
+        return {'memory': self.memory, 'memory_budget': self.memory_budget, 'context': dict(self._context)}
+
+    @contextmanager
+    def span(self, name, **context):
+        """
+        Time the enclosed block
+        :param name: Stage name
+        :param context: file, parser or sheet of the stage, added to the context of the enclosing spans
+        """
+
+        previous = self._context
+        self._context = dict(previous, **context)
+        record = dict(self._context, name=name)
+        try:
+            self.check_budget(name)
+            memory = self._start_memory() if self.memory else None
+            start = time.perf_counter()
+            try:
+                yield record
+            finally:
+                record['seconds'] = time.perf_counter() - start
+                if memory is not None:
+                    record.update(self._stop_memory(memory))
+                self.spans.append(record)
+            self.check_budget(name)
+        finally:
+            self._context = previous
+
+    def _start_memory(self):
+        """
+        Memory at the start of a span
+        """
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self._alloc_peaks:
+            # Keep the high-water mark of the enclosing span before resetting it for this span
+            self._alloc_peaks[-1] = max(self._alloc_peaks[-1], peak)
+        tracemalloc.reset_peak()
+        self._alloc_peaks.append(current)
+        return {'rss': get_rss(), 'rss_peak': get_peak_rss(), 'alloc': current}
+
+    def _stop_memory(self, memory):
+        """
+        Memory fields of a span
+        :param memory: Memory at the start of the span
+        :return: {field: bytes}
+        """
+
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(self._alloc_peaks.pop(), peak)
+        if self._alloc_peaks:
+            self._alloc_peaks[-1] = max(self._alloc_peaks[-1], peak)
+        fields = {'alloc_delta': current - memory['alloc'], 'alloc_peak': peak - memory['alloc']}
+        if memory['rss'] is not None:
+            fields['rss_delta'] = get_rss() - memory['rss']
+        if memory['rss_peak'] is not None:
+            fields['rss_peak_delta'] = get_peak_rss() - memory['rss_peak']
+        return fields
+
+    def check_budget(self, name=None):
+        """
+        Raise MemoryBudgetError if the process is over the memory budget
+        :param name: Stage being run, for the message
+        """
+
+        if self.memory_budget is None:
+            return
+        used = get_rss()
+        if used is None:
+            used = tracemalloc.get_traced_memory()[0]
+        if used > self.memory_budget:
+            where = ', '.join(f'{key} {self._context[key]}' for key in ('file', 'parser', 'sheet')
+                              if key in self._context)
+            raise MemoryBudgetError(f'Memory budget of {self.memory_budget >> 20} MB exceeded: {used >> 20} MB used '
+                                    f"at stage {name or '-'}" + (f' ({where})' if where else ''))
+
+    def merge(self, spans):
+        """
+        Add the spans recorded by another recorder, e.g. in a worker process
+        :param spans: List of span records
+        """
+        self.spans.extend(spans)
+
+    def to_dict(self, **run):
+        """
+        Build the run report
+        :param run: Extra top level entries, e.g. the command line arguments
+        :return: {'stages': {name: {'seconds', 'count'}}, 'files': {file: {'stages', 'sheets': {sheet: {'stages'}}}}}
+        """
+
+        report = {
+            'version': REPORT_VERSION,
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self._start, 6),
+        }
+        if self.memory or self.memory_budget is not None:
+            report['memory'] = {
+                'budget_mb': _to_mb(self.memory_budget),
+                'rss_peak_mb': _to_mb(get_peak_rss()),
+                'alloc_peak_mb': _to_mb(tracemalloc.get_traced_memory()[1]) if self._trace else None,
+            }
+        report.update(run)
+        report['stages'] = {}
+        report['files'] = {}
+        for span in self.spans:
+            _add_stage(report, span)
+            if 'file' not in span:
+                continue
+            file_report = report['files'].setdefault(span['file'], {'stages': {}, 'sheets': {}})
+            _add_stage(file_report, span)
+            if 'sheet' in span:
+                _add_stage(file_report['sheets'].setdefault(span['sheet'], {'stages': {}}), span)
+        return report
+
+    def write(self, path, **run):
+        """
+        Write the run report as JSON
+        :param path: Report file path
+        :param run: Extra top level entries
+        """
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.to_dict(**run), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def _add_stage(report, span):
+    """
+    Add the time and the count of a span to the stages of a report entry
+    """
+
+    stage = report['stages'].setdefault(span['name'], {'seconds': 0.0, 'count': 0})
+    stage['seconds'] = round(stage['seconds'] + span['seconds'], 6)
+    stage['count'] += 1
+    for field in MEMORY_FIELDS:
+        if field in span:
+            stage[field + '_mb'] = max(stage.get(field + '_mb', float('-inf')), _to_mb(span[field]))
+
+
+def _to_mb(n_bytes):
+    return None if n_bytes is None else round(n_bytes / (1 << 20), 3)
+
+
+def get_rss():
+    """
+    :return: Resident set size of the process in bytes, None where it cannot be read
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    # Without /proc, the peak RSS is the closest bound of the RSS
+    return get_peak_rss()
+
+
+def get_peak_rss():
+    """
+    :return: Peak resident set size of the process in bytes, None where it is not available
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak << 10
+
+
+def get_recorder():
+    """
+    :return: Recorder of the current process, None when instrumentation is off
+    """
+    return _recorder
+
+
+def set_recorder(recorder):
+    """
+    Set the recorder of the current process
+    :param recorder: RunRecorder, None to turn instrumentation off
+    """
+    global _recorder
+    _recorder = recorder
+
+
+def span(name, **context):
+    """
+    Time the enclosed block in the recorder of the current process, does nothing when instrumentation is off
+    :param name: Stage name
+    :param context: file, parser or sheet of the stage
+    :return: Context manager
+    """
+
+    if _recorder is None:
+        return _NO_SPAN
+    return _recorder.span(name, **context)
+
+
+def check_budget(name=None):
+    """
+    Check the memory budget in the recorder of the current process within a long stage, does nothing when
+    instrumentation is off
+    :param name: Stage being run, for the message
+    """
+
+    if _recorder is not None:
+        _recorder.check_budget(name)
+
+
+def run_recorded(recorder_options, function, *args, **kwargs):
+    """
+    Call a function in a worker process, recording its timing spans
+    :param recorder_options: Keyword arguments of the RunRecorder of the worker, see RunRecorder.options
+    :return: (result of the function, list of span records)
+    """
+
+    recorder = RunRecorder(**(recorder_options or {}))
+    set_recorder(recorder)
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        set_recorder(None)
+    return result, recorder.spans
+
+
+@contextmanager
+def profile(path):
+    """
+    Run the enclosed block under cProfile and dump the statistics, read them with pstats or snakeviz
+    :param path: Statistics file path, None to run without profiling
+    """
+
+    if path is None:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import zipfile
+import numpy as np
+
+
+def file_hash(path):
+    """
+    Content hash of a file
+    :param path: File path
+    :return: SHA-256 hex digest of the file bytes
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SheetCache():
+    """
+    On-disk cache of decoded worksheets
+
+    Entries are keyed by workbook content hash, sheet name, number of skipped rows and columns read, so a changed
+    workbook or a changed data_first_row never hits a stale entry. Each sheet is stored as an uncompressed .npz file
+    holding the value block in column-major order next to a small JSON part with the header and the non numeric
+    cells. When the cache grows above max_bytes the least recently used entries are evicted.
+
+    The size of the cache is kept as a running total updated by put and evict, the directory is only scanned when
+    the cache is opened and when the total goes over max_bytes. Entries written by other processes sharing the
+    directory are counted at the next scan.
+    """
+
+    # Bump when the stored layout changes so old entries are ignored
+    FORMAT_VERSION = 2
+    # Default size limit of the cache directory
+    MAX_BYTES_DEFAULT = 1 << 30
+    # Fraction of max_bytes an eviction brings the cache down to, so a full cache is not scanned on every put
+    EVICT_TO = 0.9
+
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES_DEFAULT):
+        """
+        :param cache_dir: Cache directory, created if missing
+        :param max_bytes: Size limit of the cache directory in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # Size of the entries in bytes, set by _evict
+        self.total_bytes = 0
+        # Apply the limit right away in case it was lowered since the last run
+        self._evict()
+
+    def make_key(self, content_hash, sheet_name, skiprows, usecols=None):
+        """
+        Build the key of a decoded worksheet
+        :param content_hash: Content hash of the workbook
+        :param sheet_name: Sheet name
+        :param skiprows: Number of rows above the header row
+        :param usecols: Names of the columns read, None for all columns
+        :return: Key string
+        """
+
+        parts = [self.FORMAT_VERSION, content_hash, sheet_name, skiprows]
+        if usecols is not None:
+            # Projected sheets are stored apart from the whole sheet
+            parts.append(sorted(str(name) for name in usecols))
+        key = json.dumps(parts)
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """
+        Load a decoded worksheet
+        :param key: Key from make_key
+        :return: (header values, float block, {(row, column): value}) or None when missing
+        """
+
+        path = self._path(key, '.npz')
+        try:
+            with np.load(path) as data:
+                block = np.ascontiguousarray(data['block'])
+                meta = json.loads(str(data['meta']))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        self._touch(path)
+        others = {(i, j): value for i, j, value in meta['others']}
+        return meta['header'], block, others
+
+    def put(self, key, header, block, others):
+        """
+        Store a decoded worksheet, sheets with values JSON cannot hold (e.g. dates) are not cached
+        :param key: Key from make_key
+        :param header: Header values
+        :param block: Float block
+        :param others: {(row, column): value} of non numeric cells
+        """
+
+        try:
+            meta = json.dumps({'header': header, 'others': [[i, j, value] for (i, j), value in others.items()]})
+        except (TypeError, ValueError):
+            return
+        path = self._path(key, '.npz')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, block=np.asfortranarray(block), meta=np.array(meta))
+        self._replace(tmp_path, path)
+
+    def get_sheet_names(self, content_hash):
+        """
+        Load the sheet names of a workbook
+        :param content_hash: Content hash of the workbook
+        :return: List of sheet names or None when missing
+        """
+
+        path = self._path(self.make_key(content_hash, None, None), '.json')
+        try:
+            with open(path, encoding='utf8') as f:
+                sheet_names = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._touch(path)
+        return sheet_names
+
+    def put_sheet_names(self, content_hash, sheet_names):
+        """
+        Store the sheet names of a workbook
+        :param content_hash: Content hash of the workbook
+        :param sheet_names: List of sheet names
+        """
+
+        path = self._path(self.make_key(content_hash, None, None), '.json')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(list(sheet_names), f)
+        self._replace(tmp_path, path)
+
+    def _replace(self, tmp_path, path):
+        """
+        Move a written entry into place and evict entries if the cache went over max_bytes
+        """
+
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self.total_bytes += size - replaced
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def _touch(self, path):
+        """
+        Mark an entry as recently used
+        """
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """
+        Remove least recently used entries until the cache fits in EVICT_TO of max_bytes
+        """
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            self.total_bytes = total
+            return
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            total -= size
+        self.total_bytes = total
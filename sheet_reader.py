@@ -0,0 +1,360 @@
+import numpy as np
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+from pandas.io.parsers import TextParser
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.utils.cell import get_column_letter
+from openpyxl.worksheet._reader import WorkSheetParser
+from run_report import check_budget
+from sheet_cache import file_hash
+
+# Cell values written straight into the block, a row of only these takes the fast path
+_NUMERIC_TYPES = {int, float, type(None)}
+# Texts read as empty cells: the default NA strings of pandas and the Excel error values, which pandas reads as NaN
+_NA_VALUES = frozenset(STR_NA_VALUES) | frozenset(ERROR_CODES)
+
+
+class StreamingExcelFile():
+    """
+    Streaming replacement of pd.ExcelFile
+
+    Worksheets are walked row by row in openpyxl read-only, values-only mode and the cell values are written straight
+    into a preallocated NumPy block, so no cell objects are built and the peak memory of a sheet stays close to the
+    size of its numbers. parse() returns the same data frame as pd.ExcelFile.parse. Every cell goes through one rule
+    whatever else its row holds: numbers go to the block, the default NA strings of pandas (n/a, NA...) and the Excel
+    error values (#N/A, #DIV/0!...) are empty cells and other values (text, booleans, dates) are kept aside. Columns of
+    numbers only are built from the block, integral ones as int64. Columns holding other values are converted by the
+    pandas text parser like read_excel does, so numeric text, booleans and NA strings come out as pandas gives them.
+
+    With a SheetCache, decoded sheets are looked up by workbook content hash first and the workbook itself is only
+    opened when a sheet is missing from the cache.
+
+    usecols projects a sheet on some of its columns, found by name in the header row: below the header, the cells of
+    the other columns are skipped before their value is converted and the block is only allocated for the projected
+    columns.
+    """
+
+    # Number of rows allocated when the sheet dimension is unknown
+    ROW_CAPACITY_DEFAULT = 1024
+
+    def __init__(self, input_file, cache=None):
+        """
+        :param input_file: Source file directory
+        :param cache: SheetCache of decoded sheets, None to always decode
+        """
+        self.input_file = input_file
+        self.cache = cache
+        self._book = None
+        self._content_hash = None
+        self._sheet_names = None
+
+    @property
+    def book(self):
+        """
+        openpyxl read-only workbook, loaded on first use
+        """
+        if self._book is None:
+            self._book = load_workbook(self.input_file, read_only=True, data_only=True, keep_links=False)
+        return self._book
+
+    @property
+    def content_hash(self):
+        """
+        Content hash of the workbook, computed on first use
+        """
+        if self._content_hash is None:
+            self._content_hash = file_hash(self.input_file)
+        return self._content_hash
+
+    @property
+    def sheet_names(self):
+        """
+        Worksheet names in workbook order, read once per workbook
+        """
+        if self._sheet_names is None:
+            if self.cache is None:
+                self._sheet_names = self.book.sheetnames
+            else:
+                self._sheet_names = self.cache.get_sheet_names(self.content_hash)
+                if self._sheet_names is None:
+                    self._sheet_names = self.book.sheetnames
+                    self.cache.put_sheet_names(self.content_hash, self._sheet_names)
+        return self._sheet_names
+
+    def close(self):
+        """
+        Release the underlying file handle
+        """
+        if self._book is not None:
+            self._book.close()
+            self._book = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_grid(self, sheet_name, skiprows=0, usecols=None):
+        """
+        Read the header and the data block of a worksheet, from the cache when possible
+        :param sheet_name: Sheet name
+        :param skiprows: Number of rows above the header row
+        :param usecols: Names of the columns to read, compared as strings, None for all columns
+        :return: (header values, float block, {(row, column): value} of non numeric cells)
+        """
+
+        if self.cache is None:
+            return self._decode_grid(sheet_name, skiprows, usecols)
+
+        key = self.cache.make_key(self.content_hash, sheet_name, skiprows, usecols)
+        grid = self.cache.get(key)
+        if grid is None:
+            grid = self._decode_grid(sheet_name, skiprows, usecols)
+            self.cache.put(key, *grid)
+        return grid
+
+    def _decode_grid(self, sheet_name, skiprows, usecols=None):
+        """
+        Decode the header and the data block of a worksheet
+        """
+
+        ws = self.book[sheet_name]
+        # The stored dimension is only used as a capacity hint, it is not reliable enough to bound the iteration
+        capacity_rows = ws.max_row - skiprows - 1 if ws.max_row else self.ROW_CAPACITY_DEFAULT
+        capacity_cols = ws.max_column or 1
+        if usecols is not None:
+            usecols = {str(name) for name in usecols}
+            capacity_cols = min(capacity_cols, max(len(usecols), 1))
+        ws.reset_dimensions()
+
+        block = np.full((max(capacity_rows, 1), capacity_cols), np.nan)
+        header = []
+        others = {}
+        rows = ws.iter_rows(values_only=True) if usecols is None else _ProjectedRows(ws)
+        # Number of data rows up to the last row holding a value, and width up to the last column holding a value
+        n_rows = 0
+        n_cols = 0
+        i = -1
+        for r, row in enumerate(rows):
+            width = _row_width(row)
+            if r < skiprows:
+                if usecols is None:
+                    n_cols = max(n_cols, width)
+                continue
+            if r == skiprows:
+                if usecols is None:
+                    header = list(row[:width])
+                    n_cols = max(n_cols, width)
+                else:
+                    # Columns are selected on the names parse() gives them, the header holds the names
+                    names = _column_names(row[:width])
+                    positions = [j for j, name in enumerate(names) if str(name) in usecols]
+                    rows.project(positions)
+                    header = [names[j] for j in positions]
+                    n_cols = len(header)
+                continue
+
+            n_cols = max(n_cols, width)
+            i = r - skiprows - 1
+            if width == 0:
+                continue
+            n_rows = i + 1
+            if i >= block.shape[0] or width > block.shape[1]:
+                block = _grow(block, max(i + 1, block.shape[0] * 2), max(width, block.shape[1]))
+                check_budget('decode_sheet')
+            if all(map(_NUMERIC_TYPES.__contains__, map(type, row[:width]))):
+                block[i, :width] = row[:width]
+                continue
+            # Text, booleans, dates or other non numeric cells, set cell by cell and keep the rest aside
+            for j in range(width):
+                value = row[j]
+                kind = type(value)
+                if value is None or (kind is str and value in _NA_VALUES):
+                    continue
+                if kind is int or kind is float:
+                    block[i, j] = value
+                else:
+                    others[(i, j)] = value
+
+        if n_cols > block.shape[1]:
+            block = _grow(block, block.shape[0], n_cols)
+        return header + [None] * (n_cols - len(header)), block[:n_rows, :n_cols], others
+
+    def parse(self, sheet_name, skiprows=0, usecols=None, **kwargs):
+        """
+        Read a worksheet into a data frame, the row above the data is used as header
+        :param sheet_name: Sheet name
+        :param skiprows: Number of rows above the header row
+        :param usecols: Names of the columns to read, compared as strings, None for all columns. Names missing from
+                        the header are ignored, rows are read up to the last one holding a value in these columns
+        :param kwargs: Accepted for compatibility with pd.ExcelFile.parse and ignored
+        :return: Data frame
+        """
+
+        header, block, others = self.read_grid(sheet_name, skiprows, usecols)
+
+        object_columns = _convert_objects(block, others)
+        columns = {}
+        for j, name in enumerate(_column_names(header)):
+            values = block[:, j]
+            if j in object_columns:
+                columns[name] = object_columns[j]
+            elif len(values) and np.isfinite(values).all() and (values == np.floor(values)).all():
+                # Integral values are read as integers, like pandas does
+                columns[name] = values.astype(np.int64)
+            else:
+                columns[name] = values
+
+        return pd.DataFrame(columns, index=pd.RangeIndex(block.shape[0]))
+
+
+def _row_width(row):
+    """
+    Number of cells of a row up to the last one holding a value
+    """
+
+    width = len(row)
+    while width and (row[width - 1] is None or row[width - 1] == ''):
+        width -= 1
+    return width
+
+
+class _ProjectedSheetParser(WorkSheetParser):
+    """
+    openpyxl worksheet parser skipping the cells of the columns that are not kept, before their value is converted
+    """
+
+    # Column letters of the kept columns, None to keep all columns
+    letters = None
+
+    def parse_row(self, row):
+        if self.letters is None:
+            return super().parse_row(row)
+        refs = [el.get('r') for el in row]
+        if None in refs:
+            # Cells without reference are placed by counting them, all of them are parsed
+            return super().parse_row(row)
+        r = row.get('r')
+        self.row_counter = int(r) if r is not None else self.row_counter + 1
+        self.col_counter = 0
+        return self.row_counter, [self.parse_cell(el) for el, ref in zip(row, refs)
+                                  if ref.rstrip('0123456789') in self.letters]
+
+
+class _ProjectedRows():
+    """
+    Values of the rows of a read-only worksheet like ws.iter_rows(values_only=True), rows read after project() only
+    hold the values of the projected columns
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.positions = None
+        # Projected position of each kept 1-based column number
+        self._index = None
+        self._parser = None
+
+    def project(self, positions):
+        """
+        Keep some columns in the next rows
+        :param positions: Ascending 0-based positions of the kept columns
+        """
+
+        self.positions = positions
+        self._index = {j + 1: k for k, j in enumerate(positions)}
+        if self._parser is not None:
+            self._parser.letters = {get_column_letter(j + 1) for j in positions}
+
+    def __iter__(self):
+        ws = self.ws
+        if not hasattr(ws, '_get_source'):
+            # Not a read-only worksheet, the cells are converted and the projection is applied on the values
+            for row in ws.iter_rows(values_only=True):
+                yield row if self.positions is None else tuple(row[j] if j < len(row) else None
+                                                               for j in self.positions)
+            return
+
+        with ws._get_source() as src:
+            self._parser = _ProjectedSheetParser(src, ws._shared_strings, data_only=ws.parent.data_only,
+                                                 epoch=ws.parent.epoch, date_formats=ws.parent._date_formats,
+                                                 timedelta_formats=ws.parent._timedelta_formats)
+            counter = 1
+            for idx, cells in self._parser.parse():
+                # Rows missing from the sheet are empty
+                for _ in range(counter, idx):
+                    yield ()
+                counter = idx + 1
+                if self.positions is None:
+                    row = [None] * (cells[-1]['column'] if cells else 0)
+                    for cell in cells:
+                        row[cell['column'] - 1] = cell['value']
+                else:
+                    row = [None] * len(self.positions)
+                    for cell in cells:
+                        k = self._index.get(cell['column'])
+                        if k is not None:
+                            row[k] = cell['value']
+                yield tuple(row)
+
+
+def _grow(block, n_rows, n_cols):
+    """
+    Copy a block into a larger NaN filled block
+    """
+
+    grown = np.full((n_rows, n_cols), np.nan)
+    grown[:block.shape[0], :block.shape[1]] = block
+    return grown
+
+
+def _convert_objects(block, others):
+    """
+    Convert the columns holding non numeric cells with the pandas text parser, as pd.ExcelFile.parse does
+    :param block: Float block of the sheet
+    :param others: {(row, column): value} of non numeric cells
+    :return: {column: series}
+    """
+
+    positions = sorted({j for (_, j) in others})
+    if not positions:
+        return {}
+    cells = {j: [_to_python(v) for v in block[:, j]] for j in positions}
+    for (i, j), value in others.items():
+        cells[j][i] = value
+    converted = TextParser([list(row) for row in zip(*cells.values())], header=None).read()
+    return {j: converted[k].rename(None) for k, j in enumerate(positions)}
+
+
+def _to_python(value):
+    """
+    Convert a block value into the cell value pandas would have read
+    """
+
+    if np.isnan(value):
+        return np.nan
+    if value == np.floor(value):
+        return int(value)
+    return float(value)
+
+
+def _column_names(header):
+    """
+    Build column names from header values, following pandas for empty and duplicated names
+    """
+
+    names = []
+    seen = {}
+    for j, value in enumerate(header):
+        if value is None or value == '':
+            value = f'Unnamed: {j}'
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        name = value
+        while name in seen:
+            seen[value] += 1
+            name = f'{value}.{seen[value]}'
+        seen[name] = 0
+        names.append(name)
+    return names
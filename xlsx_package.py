@@ -0,0 +1,591 @@
+import io
+import math
+import numbers
+import os
+import posixpath
+import re
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+# Relationship and content types of a worksheet part
+WORKSHEET_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+WORKSHEET_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+CALC_CHAIN_PART = 'xl/calcChain.xml'
+# Limits of Excel on sheet names
+MAX_SHEET_NAME_LENGTH = 31
+INVALID_SHEET_NAME_CHARS = '[]:*?/\\'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+# Header cell style of to_excel: bold, thin borders, centered at the top
+HEADER_BORDER = {'left': {'style': 'thin'}, 'right': {'style': 'thin'}, 'top': {'style': 'thin'},
+                 'bottom': {'style': 'thin'}}
+HEADER_ALIGNMENT = {'horizontal': 'center', 'vertical': 'top'}
+
+# Characters that are not allowed in XML 1.0 text
+_ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def column_letter(index):
+    """
+    Excel column letter of a 0-based column index
+    """
+
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class SheetXmlWriter():
+    """
+    Streaming writer of a worksheet XML part
+
+    Rows are written to a file as they are appended, strings are stored inline in the cells so the part does not need
+    the shared string table of the target workbook. The dimension element is written as a fixed size placeholder and
+    filled in on close.
+    """
+
+    # Room left for the dimension reference, enough for XFD1048576:XFD1048576
+    DIMENSION_WIDTH = 32
+
+    def __init__(self, path, start_col=0):
+        """
+        :param path: File path of the worksheet XML part
+        :param start_col: 0-based index of the first written column, 1 leaves column A empty like startcol=1
+        """
+        self.path = path
+        self.start_col = start_col
+        self.n_rows = 0
+        self.n_cols = 0
+        self.letters = []
+        self.f = open(path, 'w', encoding='utf8', newline='')
+        self.f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                     '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                     f'xmlns:r="{RELATIONSHIPS_NS}">')
+        self.dimension_offset = self.f.tell()
+        self.f.write(' ' * (self.DIMENSION_WIDTH + 20))
+        self.f.write('<sheetData>')
+
+    def append(self, row, style=None):
+        """
+        Append a row of values, None, NaN and empty strings are left as empty cells
+        :param row: Sequence of values
+        :param style: Cell style index of the written cells, see get_header_style
+        """
+
+        self.n_rows += 1
+        r = str(self.n_rows)
+        s = '' if style is None else f' s="{style}"'
+        while len(self.letters) < len(row):
+            self.letters.append(column_letter(self.start_col + len(self.letters)))
+
+        cells = []
+        for letter, value in zip(self.letters, row):
+            if value is None:
+                continue
+            if isinstance(value, bool) or type(value).__name__ == 'bool_':
+                cells.append(f'<c r="{letter}{r}"{s} t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, numbers.Integral):
+                cells.append(f'<c r="{letter}{r}"{s}><v>{int(value)}</v></c>')
+            elif isinstance(value, numbers.Real):
+                value = float(value)
+                if not math.isfinite(value):
+                    continue
+                cells.append(f'<c r="{letter}{r}"{s}><v>{value!r}</v></c>')
+            else:
+                text = _ILLEGAL_XML_CHARS.sub('', str(value))
+                if not text:
+                    continue
+                space = ' xml:space="preserve"' if text != text.strip() else ''
+                cells.append(f'<c r="{letter}{r}"{s} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>')
+        self.n_cols = max(self.n_cols, len(row))
+        self.f.write(f'<row r="{r}">' + ''.join(cells) + '</row>')
+
+    def append_frame(self, df, header=True, header_style=None):
+        """
+        Append the rows of a data frame
+        :param df: Data frame
+        :param header: Write the column names as first row
+        :param header_style: Cell style index of the column names, see get_header_style
+        """
+
+        if header:
+            self.append(list(df.columns), style=header_style)
+        for row in df.itertuples(index=False, name=None):
+            self.append(row)
+
+    def close(self):
+        """
+        Finish the part and fill in the dimension
+        """
+
+        self.f.write('</sheetData></worksheet>')
+        if self.n_rows:
+            last = column_letter(self.start_col + max(self.n_cols, 1) - 1)
+            ref = f'{column_letter(self.start_col)}1:{last}{self.n_rows}'
+        else:
+            ref = 'A1'
+        self.f.seek(self.dimension_offset)
+        self.f.write(f'<dimension ref="{ref}"/>')
+        self.f.close()
+
+
+def write_sheet_parts(output_file, sheet_parts, replace=False, header_style=None):
+    """
+    Add or replace worksheets of an existing xlsx package
+
+    Only the new worksheet parts, the workbook part, its relationships, the content types and, for a header style, the
+    styles part are written. Every other part, including the other worksheets, is copied with its compressed bytes
+    untouched, so neither their XML nor the shared strings are loaded.
+
+    Sheet names are compared without case like Excel does, a replaced sheet keeps its name. Names Excel cannot store
+    raise ValueError before anything is written.
+    :param output_file: Existing xlsx file
+    :param sheet_parts: {sheet_name: file path of a worksheet XML part}
+    :param replace: Replace the sheets that exist, raise ValueError otherwise
+    :param header_style: Cell style index of the header rows of the parts, from get_header_style, None if unstyled
+    """
+
+    seen = set()
+    for sheet_name in sheet_parts:
+        check_sheet_name(sheet_name)
+        if sheet_name.casefold() in seen:
+            raise ValueError(f"Sheet '{sheet_name}' is given twice, sheet names are not case sensitive")
+        seen.add(sheet_name.casefold())
+
+    with zipfile.ZipFile(output_file) as zin:
+        workbook_part = _get_workbook_part(zin)
+        workbook_dir = posixpath.dirname(workbook_part)
+        rels_part = posixpath.join(workbook_dir, '_rels', posixpath.basename(workbook_part) + '.rels')
+        workbook = _parse_part(zin.read(workbook_part))
+        rels = _parse_part(zin.read(rels_part))
+        types = _parse_part(zin.read('[Content_Types].xml'))
+        names = set(zin.namelist())
+
+        targets = _get_rel_targets(rels[0], workbook_dir)
+        sheets = {name.casefold(): (name, rel_id) for name, rel_id in _get_sheets(workbook[0])}
+
+        new_parts = {}
+        dropped_parts = set()
+        for sheet_name, part_path in sheet_parts.items():
+            if sheet_name.casefold() in sheets:
+                existing_name, rel_id = sheets[sheet_name.casefold()]
+                if not replace:
+                    raise ValueError(f"Sheet '{existing_name}' already exists and if_sheet_exists is set to 'error'.")
+                # Overwrite the existing part, its own relationships refer to content of the old sheet
+                part_name = targets[rel_id]
+                dropped_parts.add(posixpath.join(posixpath.dirname(part_name), '_rels',
+                                                 posixpath.basename(part_name) + '.rels'))
+                # The calculation chain may refer to cells of the old sheet, Excel rebuilds it when missing
+                if CALC_CHAIN_PART in names:
+                    dropped_parts.add(CALC_CHAIN_PART)
+                    _remove_children(rels[0], 'Relationship',
+                                     lambda element: element.get('Target', '').endswith('calcChain.xml'))
+                    _remove_children(types[0], 'Override',
+                                     lambda element: element.get('PartName') == '/' + CALC_CHAIN_PART)
+            else:
+                part_name = _new_part_name(names | set(new_parts), workbook_dir)
+                rel_id = _new_rel_id(rels[0])
+                ET.SubElement(rels[0], _qualify(rels[0], 'Relationship'),
+                              {'Id': rel_id, 'Type': WORKSHEET_REL_TYPE,
+                               'Target': posixpath.relpath(part_name, workbook_dir)})
+                ET.SubElement(types[0], _qualify(types[0], 'Override'),
+                              {'PartName': '/' + part_name, 'ContentType': WORKSHEET_CONTENT_TYPE})
+                _add_sheet(workbook, sheet_name, rel_id)
+            new_parts[part_name] = part_path
+
+        replaced = {workbook_part: _serialize_part(*workbook), rels_part: _serialize_part(*rels),
+                    '[Content_Types].xml': _serialize_part(*types)}
+        if header_style is not None:
+            styles_part = _get_styles_part(rels[0], workbook_dir)
+            styles = _parse_part(zin.read(styles_part))
+            if _add_header_style(styles[0]) != header_style:
+                raise ValueError('xlsx package: Styles part changed since the header style was read')
+            replaced[styles_part] = _serialize_part(*styles)
+
+        fd, tmp_file = tempfile.mkstemp(suffix='.xlsx', dir=os.path.dirname(os.path.abspath(output_file)))
+        try:
+            with os.fdopen(fd, 'w+b') as out, open(output_file, 'rb') as raw:
+                writer = _RawZipWriter(out)
+                for info in zin.infolist():
+                    if info.filename in dropped_parts:
+                        continue
+                    if info.filename in replaced:
+                        writer.write_bytes(info.filename, replaced[info.filename], info)
+                    elif info.filename in new_parts:
+                        writer.write_file(info.filename, new_parts.pop(info.filename), info)
+                    else:
+                        writer.copy_raw(raw, info)
+                for part_name, part_path in new_parts.items():
+                    writer.write_file(part_name, part_path)
+                writer.close()
+            shutil.copymode(output_file, tmp_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    os.replace(tmp_file, output_file)
+
+
+def check_sheet_name(sheet_name):
+    """
+    Raise ValueError if Excel cannot store a sheet name: empty, longer than 31 characters, holding one of []:*?/\ or
+    starting or ending with an apostrophe
+    :param sheet_name: Sheet name
+    """
+
+    if not sheet_name or len(sheet_name) > MAX_SHEET_NAME_LENGTH:
+        raise ValueError(f"Sheet name '{sheet_name}' must have 1 to {MAX_SHEET_NAME_LENGTH} characters")
+    invalid = sorted(set(sheet_name) & set(INVALID_SHEET_NAME_CHARS))
+    if invalid:
+        raise ValueError(f"Sheet name '{sheet_name}' holds characters Excel does not allow: {''.join(invalid)}")
+    if sheet_name[0] == "'" or sheet_name[-1] == "'":
+        raise ValueError(f"Sheet name '{sheet_name}' cannot start or end with an apostrophe")
+
+
+def get_header_style(output_file):
+    """
+    Cell style index of the header rows written into an xlsx package: bold, thin borders, centered, like the header
+    of to_excel. The style is added to the styles part by write_sheet_parts when the package does not have it yet
+    :param output_file: Existing xlsx file
+    :return: Cell style index, None if the package has no usable styles part
+    """
+
+    with zipfile.ZipFile(output_file) as zin:
+        workbook_part = _get_workbook_part(zin)
+        rels_part = posixpath.join(posixpath.dirname(workbook_part), '_rels',
+                                   posixpath.basename(workbook_part) + '.rels')
+        styles_part = _get_styles_part(_parse_part(zin.read(rels_part))[0], posixpath.dirname(workbook_part))
+        if styles_part is None or styles_part not in zin.namelist():
+            return None
+        return _add_header_style(_parse_part(zin.read(styles_part))[0])
+
+
+def _parse_part(data):
+    """
+    Parse an XML part
+    :param data: Part bytes
+    :return: (root element, [(prefix, namespace)] declared in the part)
+    """
+
+    namespaces = []
+    events = ET.iterparse(io.BytesIO(data), events=('start-ns',))
+    for _, namespace in events:
+        if namespace not in namespaces:
+            namespaces.append(namespace)
+    return events.root, namespaces
+
+
+def _serialize_part(root, namespaces):
+    """
+    Serialize an XML part with the namespace prefixes it was parsed with
+    :return: Part bytes
+    """
+
+    for prefix, uri in namespaces:
+        try:
+            ET.register_namespace(prefix, uri)
+        except ValueError:
+            # Prefixes like ns0 are reserved, ElementTree picks its own
+            pass
+    xml = ET.tostring(root, encoding='unicode')
+    # ElementTree only declares the namespaces used by elements and attributes, keep the others, e.g. the prefixes
+    # listed in mc:Ignorable
+    end = xml.index('>')
+    if xml[end - 1] == '/':
+        end -= 1
+    start_tag = xml[:end]
+    declarations = ''.join(f' xmlns{":" + prefix if prefix else ""}={quoteattr(uri)}' for prefix, uri in namespaces
+                           if f'xmlns{":" + prefix if prefix else ""}=' not in start_tag)
+    return (XML_DECLARATION + start_tag + declarations + xml[end:]).encode('utf8')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _qualify(parent, name):
+    """
+    Tag of a child element in the namespace of its parent
+    """
+
+    return parent.tag[:parent.tag.index('}') + 1] + name if parent.tag.startswith('{') else name
+
+
+def _children(parent, name):
+    return [element for element in parent if _local_name(element.tag) == name]
+
+
+def _remove_children(parent, name, predicate):
+    for element in _children(parent, name):
+        if predicate(element):
+            parent.remove(element)
+
+
+def _get_workbook_part(zin):
+    """
+    Find the workbook part through the package relationships
+    """
+
+    root_rels = _parse_part(zin.read('_rels/.rels'))[0]
+    for element in _children(root_rels, 'Relationship'):
+        if element.get('Type', '').endswith('/officeDocument'):
+            return element.get('Target').lstrip('/')
+    return 'xl/workbook.xml'
+
+
+def _get_rel_targets(rels, base_dir):
+    """
+    {relationship id: part name} of a relationships part
+    """
+
+    targets = {}
+    for element in _children(rels, 'Relationship'):
+        target = element.get('Target')
+        if element.get('TargetMode') == 'External':
+            continue
+        targets[element.get('Id')] = target.lstrip('/') if target.startswith('/') else \
+            posixpath.normpath(posixpath.join(base_dir, target))
+    return targets
+
+
+def _get_styles_part(rels, base_dir):
+    """
+    Part name of the styles of a workbook, None if it has none
+    """
+
+    for element in _children(rels, 'Relationship'):
+        if element.get('Type', '').endswith('/styles'):
+            return _get_rel_targets(rels, base_dir).get(element.get('Id'))
+    return None
+
+
+def _get_sheets(workbook):
+    """
+    (sheet name, relationship id) of the worksheets of a workbook part
+    """
+
+    return [(sheet.get('name'), sheet.get(f'{{{RELATIONSHIPS_NS}}}id'))
+            for sheets in _children(workbook, 'sheets') for sheet in _children(sheets, 'sheet')]
+
+
+def _add_sheet(workbook, sheet_name, rel_id):
+    """
+    Add a sheet element at the end of the sheets element of a workbook part
+    :param workbook: (root element, namespaces) of the workbook part
+    """
+
+    root, namespaces = workbook
+    sheets = _children(root, 'sheets')
+    if not sheets:
+        raise ValueError('xlsx package: missing sheets element')
+    sheet_ids = [int(sheet.get('sheetId')) for sheet in _children(sheets[0], 'sheet')]
+    ET.SubElement(sheets[0], _qualify(sheets[0], 'sheet'),
+                  {'name': sheet_name, 'sheetId': str(max(sheet_ids, default=0) + 1),
+                   f'{{{RELATIONSHIPS_NS}}}id': rel_id})
+    if all(uri != RELATIONSHIPS_NS for _, uri in namespaces):
+        namespaces.append(('r', RELATIONSHIPS_NS))
+
+
+def _same_element(left, right):
+    """
+    True if two elements have the same tag, attributes and children
+    """
+
+    return left.tag == right.tag and left.attrib == right.attrib and len(left) == len(right) and \
+        all(_same_element(a, b) for a, b in zip(left, right))
+
+
+def _find_or_append(parent, element):
+    """
+    Position of an element among the children of the same tag of parent, appended if missing, count kept up to date
+    """
+
+    children = _children(parent, _local_name(element.tag))
+    for position, child in enumerate(children):
+        if _same_element(child, element):
+            return position
+    parent.append(element)
+    parent.set('count', str(len(children) + 1))
+    return len(children)
+
+
+def _add_header_style(styles):
+    """
+    Find or add the header cell style in the root element of a styles part
+    :return: Cell style index, None if the styles part lacks the fonts, borders or cell formats
+    """
+
+    def element(parent, name, attrib=None, children=()):
+        node = ET.Element(_qualify(parent, name), attrib or {})
+        node.extend(children)
+        return node
+
+    parts = {}
+    for name in ('fonts', 'borders', 'cellXfs'):
+        found = _children(styles, name)
+        if not found:
+            return None
+        parts[name] = found[0]
+
+    font = element(parts['fonts'], 'font', children=[element(parts['fonts'], 'b', {'val': '1'})])
+    border = element(parts['borders'], 'border',
+                     children=[element(parts['borders'], side, HEADER_BORDER.get(side))
+                               for side in ('left', 'right', 'top', 'bottom', 'diagonal')])
+    font_id = _find_or_append(parts['fonts'], font)
+    border_id = _find_or_append(parts['borders'], border)
+    xf = element(parts['cellXfs'], 'xf',
+                 {'numFmtId': '0', 'fontId': str(font_id), 'fillId': '0', 'borderId': str(border_id), 'xfId': '0',
+                  'applyFont': '1', 'applyBorder': '1', 'applyAlignment': '1'},
+                 children=[element(parts['cellXfs'], 'alignment', HEADER_ALIGNMENT)])
+    return _find_or_append(parts['cellXfs'], xf)
+
+
+def _new_part_name(names, base_dir):
+    index = 1
+    while posixpath.join(base_dir, 'worksheets', f'sheet{index}.xml') in names:
+        index += 1
+    return posixpath.join(base_dir, 'worksheets', f'sheet{index}.xml')
+
+
+def _new_rel_id(rels):
+    ids = {element.get('Id') for element in _children(rels, 'Relationship')}
+    index = len(ids) + 1
+    while f'rId{index}' in ids:
+        index += 1
+    return f'rId{index}'
+
+
+class _RawZipWriter():
+    """
+    Minimal zip writer able to copy entries of another archive without decompressing them
+
+    zipfile has no public way to copy compressed bytes, which is what keeps appending a sheet independent of the
+    size of the other sheets. Archives needing ZIP64 (over 4 GB or 65535 entries) are not supported.
+    """
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+
+    def copy_raw(self, raw, info):
+        """
+        Copy an entry of another archive with its compressed bytes
+        :param raw: Binary file object of the source archive
+        :param info: ZipInfo of the entry
+        """
+
+        raw.seek(info.header_offset)
+        header = raw.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        raw.seek(info.header_offset + 30 + name_length + extra_length)
+        offset = self._write_header(info.filename, info.compress_type, info.CRC, info.compress_size,
+                                    info.file_size, info.date_time)
+        remaining = info.compress_size
+        while remaining:
+            chunk = raw.read(min(self.CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError('xlsx package: truncated entry ' + info.filename)
+            self.f.write(chunk)
+            remaining -= len(chunk)
+        self._add_entry(info.filename, info.compress_type, info.CRC, info.compress_size, info.file_size,
+                        info.date_time, offset, info.external_attr)
+
+    def write_bytes(self, name, data, info=None):
+        """
+        Write a new entry from bytes
+        """
+
+        date_time = info.date_time if info else time.localtime()[:6]
+        compressed = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data_compressed = compressed.compress(data) + compressed.flush()
+        offset = self._write_header(name, zipfile.ZIP_DEFLATED, zlib.crc32(data), len(data_compressed), len(data),
+                                    date_time)
+        self.f.write(data_compressed)
+        self._add_entry(name, zipfile.ZIP_DEFLATED, zlib.crc32(data), len(data_compressed), len(data), date_time,
+                        offset, info.external_attr if info else 0o600 << 16)
+
+    def write_file(self, name, path, info=None):
+        """
+        Write a new entry from a file, compressed in chunks, the header is patched once the sizes are known
+        """
+
+        date_time = info.date_time if info else time.localtime()[:6]
+        offset = self._write_header(name, zipfile.ZIP_DEFLATED, 0, 0, 0, date_time)
+        compressed = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(self.CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                data = compressed.compress(chunk)
+                compress_size += len(data)
+                self.f.write(data)
+        data = compressed.flush()
+        compress_size += len(data)
+        self.f.write(data)
+
+        end = self.f.tell()
+        self.f.seek(offset)
+        self._write_header(name, zipfile.ZIP_DEFLATED, crc, compress_size, file_size, date_time)
+        self.f.seek(end)
+        self._add_entry(name, zipfile.ZIP_DEFLATED, crc, compress_size, file_size, date_time, offset,
+                        info.external_attr if info else 0o600 << 16)
+
+    def close(self):
+        """
+        Write the central directory
+        """
+
+        if len(self.entries) >= 0xFFFF or self.f.tell() >= 0xFFFFFFFF:
+            raise ValueError('xlsx package: archives needing ZIP64 are not supported')
+        start = self.f.tell()
+        for name, method, crc, compress_size, file_size, date_time, offset, external_attr in self.entries:
+            encoded, flags = _encode_name(name)
+            dos_time, dos_date = _dos_date_time(date_time)
+            self.f.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, method, dos_time, dos_date,
+                                     crc, compress_size, file_size, len(encoded), 0, 0, 0, 0, external_attr,
+                                     offset))
+            self.f.write(encoded)
+        size = self.f.tell() - start
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries), size, start,
+                                 0))
+
+    def _write_header(self, name, method, crc, compress_size, file_size, date_time):
+        offset = self.f.tell()
+        encoded, flags = _encode_name(name)
+        dos_time, dos_date = _dos_date_time(date_time)
+        self.f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dos_time, dos_date, crc,
+                                 compress_size, file_size, len(encoded), 0))
+        self.f.write(encoded)
+        return offset
+
+    def _add_entry(self, *entry):
+        self.entries.append(entry)
+
+
+def _encode_name(name):
+    """
+    Encode an entry name, flag bit 11 marks UTF-8 names
+    """
+
+    try:
+        return name.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return name.encode('utf8'), 0x800
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), (max(year, 1980) - 1980) << 9 | (month << 5) | day